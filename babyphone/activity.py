@@ -0,0 +1,139 @@
+import asyncio
+import logging
+import time
+
+log = logging.getLogger("babyphone")
+
+
+class ActivityFusion(object):
+    """Combines the audio level and the motion scores into one activity estimate.
+
+    Audio and motion each get a strength between 0 and 1 that decays over
+    `window` seconds, the confidence combines both (noisy-or), so either one
+    alone can indicate activity but both together are more certain.
+
+    A spike in the audio level triggers a priority capture of the motion
+    detection, to see what the noise was about. Recent motion lowers the level
+    needed for an audio spike. Captures are only triggered by spikes and at
+    most every `captureCooldown` seconds, so a quiet room costs nothing extra.
+
+    Broadcasts an "activity" event when the confidence crosses `threshold` in
+    either direction, or changes by more than `step` while active. Activity
+    also records a clip.
+    """
+
+    def __init__(
+        self,
+        babyphone,
+        window=10.0,
+        audioSpike=3.0,
+        motionSensitivity=0.5,
+        minLevel=0.02,
+        captureCooldown=5.0,
+        threshold=0.5,
+        step=0.1,
+    ):
+        self._bp = babyphone
+        self.window = window
+        self.audioSpike = audioSpike
+        self.motionSensitivity = motionSensitivity
+        self.minLevel = minLevel
+        self.captureCooldown = captureCooldown
+        self.threshold = threshold
+        self.step = step
+
+        # (strength, time) of the last audio and motion observation
+        self._audio = (0.0, 0.0)
+        self._motion = (0.0, 0.0)
+        self._motionSource = None
+        self._lastTrigger = 0.0
+        self._active = False
+        self._lastConfidence = 0.0
+
+    def _decayed(self, observation):
+        strength, at = observation
+        age = time.time() - at
+        if age >= self.window:
+            return 0.0
+        return strength * (1.0 - age / self.window)
+
+    def audioStrength(self):
+        return self._decayed(self._audio)
+
+    def motionStrength(self):
+        return self._decayed(self._motion)
+
+    def confidence(self):
+        return 1.0 - (1.0 - self.audioStrength()) * (1.0 - self.motionStrength())
+
+    def spikeFactor(self):
+        """How much louder than usual the audio has to be to count as spike"""
+        return 1.0 + (self.audioSpike - 1.0) * (
+            1.0 - self.motionSensitivity * self.motionStrength()
+        )
+
+    def audioLevel(self, level, baseline):
+        """Called every second with the current audio level and the usual noise
+        level"""
+        self._bp.motion.scheduler.reportAudioLevel(level, baseline)
+
+        spike = self.spikeFactor()
+        if level >= self.minLevel and baseline > 0 and level / baseline >= spike:
+            ratio = level / baseline
+            # the spike itself counts half, twice as loud as needed is certain
+            strength = min(0.5 + 0.5 * (ratio - spike) / spike, 1.0)
+            if strength >= self.audioStrength():
+                self._audio = (strength, time.time())
+            self._triggerCapture(ratio)
+
+        # also notices when the activity has decayed
+        self._evaluate()
+
+    def motion(self, score, moved, stats, source):
+        """Called with each motion score and the stats it was evaluated with"""
+        # an outlier of 2 sigma is half way, 4 sigma certain
+        # unusually little motion (e.g. the lights going off) is no activity
+        strength = min(max(stats.deviation(score) / 4.0, 0.0), 1.0) if moved else 0.0
+        if strength >= self.motionStrength():
+            self._motion = (strength, time.time())
+            self._motionSource = source
+        self._evaluate()
+
+    def _triggerCapture(self, ratio):
+        motion = self._bp.motion
+        if not motion.isRunning() or self._bp.hasMotionVectors():
+            # nothing to capture, or the motion vectors are watching already
+            return
+        if time.time() - self._lastTrigger < self.captureCooldown:
+            return
+        self._lastTrigger = time.time()
+        log.info("Audio spike (%.1fx the usual level), taking a picture", ratio)
+        motion.scheduler.requestCapture()
+
+    def _evaluate(self):
+        confidence = self.confidence()
+        active = confidence >= self.threshold
+        if active == self._active and (
+            not active or abs(confidence - self._lastConfidence) < self.step
+        ):
+            return
+
+        self._active = active
+        self._lastConfidence = confidence
+        if active:
+            # records what happened before and, while active, after
+            self._bp.recorder.trigger()
+        asyncio.ensure_future(
+            self._bp.broadcast(
+                {
+                    "action": "activity",
+                    "activity": dict(
+                        active=active,
+                        confidence=confidence,
+                        audio=self.audioStrength(),
+                        motion=self.motionStrength(),
+                        motion_source=self._motionSource,
+                    ),
+                }
+            )
+        )
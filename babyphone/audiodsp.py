@@ -0,0 +1,215 @@
+import collections
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+INT32_MIN = -(1 << 31)
+INT32_MAX = (1 << 31) - 1
+
+
+def _alawTable():
+    """A-law codes for every 16 bit sample, indexed by the sample as uint16.
+
+    Same quantization as audioop.lin2alaw, which uses the upper 13 bits.
+    """
+    pcm = np.arange(-(1 << 15), 1 << 15, dtype=np.int32) >> 3
+    mask = np.where(pcm >= 0, 0xD5, 0x55)
+    pcm = np.where(pcm >= 0, pcm, -pcm - 1)
+
+    segEnds = np.array([0x1F, 0x3F, 0x7F, 0xFF, 0x1FF, 0x3FF, 0x7FF, 0xFFF])
+    seg = np.searchsorted(segEnds, pcm)
+    shift = np.where(seg < 2, 1, seg)
+    aval = (np.minimum(seg, 7) << 4) | ((pcm >> np.minimum(shift, 7)) & 0x0F)
+    aval = np.where(seg >= 8, 0x7F, aval)
+
+    table = np.empty(1 << 16, dtype=np.uint8)
+    # index by the uint16 representation of the sample
+    table[np.arange(-(1 << 15), 1 << 15) & 0xFFFF] = (aval ^ mask).astype(np.uint8)
+    return table
+
+
+ALAW_TABLE = _alawTable()
+
+
+def lowpass(numTaps, cutoff):
+    """Windowed sinc lowpass, cutoff relative to the sample rate, unity DC gain"""
+    n = np.arange(numTaps) - (numTaps - 1) / 2.0
+    taps = np.sinc(2.0 * cutoff * n) * np.hamming(numTaps)
+    return taps / taps.sum()
+
+
+def toMono(data, channels):
+    """Sums the channels of interleaved S32_LE samples, like audioop.tomono(data, 4, 1, 1)"""
+    samples = np.frombuffer(data, dtype="<i4")
+    if channels == 1:
+        return samples.astype(np.float64)
+    return samples.reshape(-1, channels).sum(axis=1, dtype=np.float64)
+
+
+def saturate(samples):
+    return np.clip(samples, INT32_MIN, INT32_MAX)
+
+
+def rms(samples):
+    if not len(samples):
+        return 0.0
+    return float(np.sqrt(np.dot(samples, samples) / len(samples)))
+
+
+def toAlaw(samples):
+    """Encodes 32 bit linear samples to A-law, like audioop.lin2alaw(data, 4)"""
+    upper = (samples.astype(np.int64) >> 16) & 0xFFFF
+    return ALAW_TABLE[upper].tobytes()
+
+
+class Decimator(object):
+    """Lowpass filters and downsamples by an integer factor.
+
+    Only the output samples that are kept are computed (equivalent to the
+    polyphase form). Keeps the filter history between blocks, so blocks of any
+    length can be passed.
+    """
+
+    def __init__(self, factor, numTaps=48, cutoff=None):
+        self._factor = factor
+        if cutoff is None:
+            # a bit below the new nyquist frequency
+            cutoff = 0.45 / factor
+        # reversed, so the filter is a dot product with the input window
+        self._taps = lowpass(numTaps, cutoff)[::-1].copy()
+        self._pending = np.zeros(numTaps - 1)
+
+    def process(self, samples):
+        buf = np.concatenate((self._pending, samples))
+        numTaps = len(self._taps)
+        count = (len(buf) - numTaps) // self._factor + 1
+        if count <= 0:
+            self._pending = buf
+            return np.empty(0)
+
+        step = buf.strides[0]
+        windows = as_strided(
+            buf, shape=(count, numTaps), strides=(step * self._factor, step)
+        )
+        out = windows.dot(self._taps)
+        self._pending = buf[count * self._factor :]
+        return out
+
+
+class AudioPipeline(object):
+    """Converts captured S32_LE frames to A-law and measures the level.
+
+    Replaces the audioop chain tomono -> ratecv -> mul -> rms -> lin2alaw, working
+    on a single float buffer per period.
+    """
+
+    def __init__(self, channels=2, inRate=48000, outRate=8000, gain=2):
+        if inRate % outRate != 0:
+            raise ValueError(
+                "input rate %d must be a multiple of the output rate %d"
+                % (inRate, outRate)
+            )
+        self._channels = channels
+        self._gain = gain
+        self._decimator = Decimator(inRate // outRate)
+
+    def process(self, data):
+        """Returns the A-law encoded audio and the rms of the linear samples"""
+        samples = toMono(data, self._channels)
+        samples = self._decimator.process(samples)
+        samples = saturate(samples * self._gain)
+        return toAlaw(samples), rms(samples)
+
+
+class NoiseGate(object):
+    """Suppresses the audio while the room is silent.
+
+    Learns the noise floor from the levels (rms relative to full scale) of the
+    periods: it follows quieter levels within `fallTime` seconds and louder ones
+    only within `riseTime` seconds, so steady noise like a fan becomes the floor
+    but short sounds don't. While the gate is open the floor rises even slower
+    (`openRiseTime`), so it doesn't close in the middle of a long cry.
+
+    Opens as soon as a period is `openRatio` times louder than the floor (and
+    louder than `minLevel`), closes after `hangover` seconds below `closeRatio`
+    times the floor (or `minLevel`). While closed the last `preRoll` seconds
+    are kept and sent first when the gate opens, so onsets are not clipped.
+    """
+
+    def __init__(
+        self,
+        period,
+        packetSeconds,
+        openRatio=3.0,
+        closeRatio=2.0,
+        minLevel=0.0005,
+        hangover=2.0,
+        preRoll=0.3,
+        fallTime=0.5,
+        riseTime=20.0,
+        openRiseTime=300.0,
+    ):
+        """period is the duration of the periods passed to process,
+        packetSeconds the duration of one packet"""
+        self.period = period
+        self.packetSeconds = packetSeconds
+        self.openRatio = openRatio
+        self.closeRatio = closeRatio
+        self.minLevel = minLevel
+        self.hangover = hangover
+        self.preRoll = preRoll
+        self.fallTime = fallTime
+        self.riseTime = riseTime
+        self.openRiseTime = openRiseTime
+
+        self.floor = None
+        self.isOpen = False
+        self._quiet = 0.0
+        # (packets, pts, seconds) of the last periods while closed
+        self._preRoll = collections.deque()
+        self._preRollSeconds = 0.0
+
+    def process(self, packets, pts, level):
+        """Returns the chunks (packets, pts) to send: nothing while closed, the
+        pre-roll and the packets of the period when the gate opens"""
+        self._learn(level)
+
+        if self.isOpen:
+            if level < max(self.floor * self.closeRatio, self.minLevel):
+                self._quiet += self.period
+                if self._quiet >= self.hangover:
+                    self.isOpen = False
+            else:
+                self._quiet = 0.0
+        elif level > max(self.floor * self.openRatio, self.minLevel):
+            self.isOpen = True
+            self._quiet = 0.0
+            chunks = [(p, t) for p, t, _ in self._preRoll]
+            self._preRoll.clear()
+            self._preRollSeconds = 0.0
+            if packets:
+                chunks.append((packets, pts))
+            return chunks
+
+        if self.isOpen:
+            return [(packets, pts)] if packets else []
+
+        if packets:
+            seconds = len(packets) * self.packetSeconds
+            self._preRoll.append((packets, pts, seconds))
+            self._preRollSeconds += seconds
+            while self._preRollSeconds - self._preRoll[0][2] >= self.preRoll:
+                self._preRollSeconds -= self._preRoll.popleft()[2]
+        return []
+
+    def _learn(self, level):
+        if self.floor is None:
+            self.floor = level
+            return
+        if level < self.floor:
+            constant = self.fallTime
+        elif self.isOpen:
+            constant = self.openRiseTime
+        else:
+            constant = self.riseTime
+        self.floor += (level - self.floor) * min(1.0, self.period / constant)
@@ -0,0 +1,191 @@
+import logging
+import time
+import wave
+
+import numpy as np
+
+log = logging.getLogger("babyphone")
+
+# sample rate of the audio sent to the clients (A-law, one byte per sample)
+OUTPUT_RATE = 8000
+
+# duration of the audio packets sent to the clients
+PACKET_MILLIS = 20
+
+# latency targets in milliseconds. Audio is captured in periods of this duration,
+# so lower latency means more wakeups of the capture thread and more cpu.
+LATENCIES = (20, 40, 100)
+DEFAULT_LATENCY = 40
+
+
+def periodSize(rate, latencyMillis):
+    return rate * latencyMillis // 1000
+
+
+class AudioSource(object):
+    """Captured audio as interleaved S32_LE frames.
+
+    read() blocks until the next period is available and returns it, or returns
+    None if the source is exhausted.
+    """
+
+    def __init__(self, rate, channels, periodSize):
+        self.rate = rate
+        self.channels = channels
+        self.periodSize = periodSize
+
+    def open(self):
+        pass
+
+    def read(self):
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+
+class AlsaSource(AudioSource):
+    def __init__(self, device, rate=48000, channels=2, periodSize=1920):
+        AudioSource.__init__(self, rate, channels, periodSize)
+        self._device = device
+        self._pcm = None
+
+    def open(self):
+        import alsaaudio
+
+        log.debug("initializing Alsa PCM device %s", self._device)
+        self._pcm = alsaaudio.PCM(
+            alsaaudio.PCM_CAPTURE, alsaaudio.PCM_NORMAL, device=self._device
+        )
+        self._pcm.setchannels(self.channels)
+        self._pcm.setrate(self.rate)
+        self._pcm.setformat(alsaaudio.PCM_FORMAT_S32_LE)
+        self._pcm.setperiodsize(self.periodSize)
+        log.debug("...initialization done")
+
+    def read(self):
+        l, data = self._pcm.read()
+        # negative length means an overrun, let's just continue
+        if l <= 0:
+            return b""
+        return data
+
+    def close(self):
+        if self._pcm is not None:
+            self._pcm.close()
+            self._pcm = None
+
+
+class _PacedSource(AudioSource):
+    """Base for sources that are not driven by hardware.
+
+    If realtime is set, read() waits until the period would have been captured
+    by a real device (sped up by speed), otherwise the audio is delivered as fast
+    as possible.
+    """
+
+    def __init__(self, rate, channels, periodSize, realtime, speed=1.0):
+        AudioSource.__init__(self, rate, channels, periodSize)
+        self._realtime = realtime
+        self._speed = speed
+        self._start = None
+        self._frames = 0
+
+    def _pace(self, frames):
+        if self._start is None:
+            self._start = time.time()
+        self._frames += frames
+        if self._realtime:
+            delay = (
+                self._start + float(self._frames) / self.rate / self._speed - time.time()
+            )
+            if delay > 0:
+                time.sleep(delay)
+
+
+class WavSource(_PacedSource):
+    """Replays a 16 or 32 bit wav file, optionally looping"""
+
+    def __init__(self, path, periodSize=1920, realtime=True, loop=True, speed=1.0):
+        self._path = path
+        self._loop = loop
+        self._wav = wave.open(path, "rb")
+        if self._wav.getsampwidth() not in (2, 4):
+            raise ValueError("only 16 or 32 bit wav files are supported: %s" % path)
+        _PacedSource.__init__(
+            self,
+            self._wav.getframerate(),
+            self._wav.getnchannels(),
+            periodSize,
+            realtime,
+            speed,
+        )
+
+    def read(self):
+        data = self._wav.readframes(self.periodSize)
+        if not data:
+            if not self._loop:
+                return None
+            self._wav.rewind()
+            data = self._wav.readframes(self.periodSize)
+
+        if self._wav.getsampwidth() == 2:
+            data = (np.frombuffer(data, dtype="<i2").astype("<i4") << 16).tobytes()
+
+        self._pace(len(data) // (4 * self.channels))
+        return data
+
+    def close(self):
+        self._wav.close()
+
+
+class SyntheticSource(_PacedSource):
+    """A sine tone with gaussian noise. Amplitudes relative to full scale"""
+
+    def __init__(
+        self,
+        rate=48000,
+        channels=2,
+        periodSize=1920,
+        frequency=440.0,
+        amplitude=0.1,
+        noise=0.01,
+        realtime=True,
+        speed=1.0,
+        seed=0,
+    ):
+        _PacedSource.__init__(self, rate, channels, periodSize, realtime, speed)
+        self.frequency = frequency
+        self.amplitude = amplitude
+        self.noise = noise
+        self._random = np.random.RandomState(seed)
+
+    def read(self):
+        fullScale = float((1 << 31) - 1)
+        t = (self._frames + np.arange(self.periodSize)) / float(self.rate)
+        tone = np.sin(2 * np.pi * self.frequency * t) * self.amplitude
+        samples = tone[:, None] + self._random.normal(
+            0, self.noise, (self.periodSize, self.channels)
+        )
+        data = (np.clip(samples, -1, 1) * fullScale).astype("<i4").tobytes()
+        self._pace(self.periodSize)
+        return data
+
+
+class Packetizer(object):
+    """Cuts a stream of encoded audio into packets of fixed size"""
+
+    def __init__(self, packetSize):
+        self._packetSize = packetSize
+        self._buf = bytearray()
+
+    def add(self, data):
+        self._buf.extend(data)
+        count = len(self._buf) // self._packetSize
+        if not count:
+            return []
+
+        size = self._packetSize
+        packets = [bytes(self._buf[i * size : (i + 1) * size]) for i in range(count)]
+        del self._buf[: count * size]
+        return packets
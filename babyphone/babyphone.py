@@ -1,6 +1,5 @@
 import asyncio
-import audioop
-import base64
+import functools
 import json
 import logging
 import subprocess
@@ -9,14 +8,27 @@ import threading
 import time
 from concurrent.futures import CancelledError, ThreadPoolExecutor
 
-import alsaaudio
-import cv2
-import numpy as np
-import picamera
-import RPi.GPIO as gpio
 import websockets.exceptions
 import datetime as dt
-from babyphone import motiondetect
+from babyphone import (
+    activity,
+    audiodsp,
+    audiosource,
+    camera,
+    fanout,
+    hls,
+    levels,
+    looplag,
+    metrics,
+    motiondetect,
+    protocol,
+    recorder,
+    renditions,
+    sendqueue,
+    snapshot,
+    timeseries,
+)
+from babyphone import hardware as hal
 
 
 class InvalidMessageException(Exception):
@@ -41,23 +53,52 @@ class Babyphone(object):
 
     LIGHTS_GPIO = 24
 
-    def __init__(self, loop):
-        self._videoFrameData = []
+    def __init__(
+        self,
+        loop,
+        hardware=None,
+        audioLatency=audiosource.DEFAULT_LATENCY,
+        motionOptions=None,
+        noiseGate=False,
+        clipDirectory=None,
+        historyPath=None,
+    ):
+        self._hardware = hardware if hardware is not None else hal.PiHardware()
+        self._audioLatency = audioLatency
         self._loop = loop
         log.debug("starting babyphone")
         self.conns = set()
-        self.motion = motiondetect.MotionDetect(self)
+        self.fanout = fanout.Fanout(self.conns)
+        self.motion = motiondetect.MotionDetect(self, **(motionOptions or {}))
+        self.activity = activity.ActivityFusion(self)
+        self.snapshots = snapshot.SnapshotCache(self)
+        self.camera = camera.CameraArbiter(self)
+        self.recorder = recorder.ClipRecorder(self, directory=clipDirectory)
+        self.hls = hls.HlsStream(self)
+        self.history = timeseries.TimeSeriesStore(historyPath)
 
         self.nightMode = False
+        # suppress the audio while the room is silent
+        self.noiseGate = noiseGate
         self._audioEncoder = None
 
-        log.debug("configuring GPIO")
-        gpio.setmode(gpio.BCM)
-        gpio.setup(self.LIGHTS_GPIO, gpio.OUT)
+        self.lights = self._hardware.createLights(self.LIGHTS_GPIO)
 
         self.executor = ThreadPoolExecutor(max_workers=4)
         self._running = threading.Event()
-        self._streamingTask = None
+        # rendition name -> task recording it
+        self._streamingTasks = {}
+        # the rendition feeding the motion vectors and the clip recorder
+        self._primaryRendition = None
+
+        metrics.REGISTRY.register(
+            metrics.CallbackGauge(
+                "babyphone_send_queue_depth",
+                "Messages waiting to be sent, per client",
+                ["client"],
+                self._queueDepths,
+            )
+        )
 
     def start(self):
         if self._running.is_set():
@@ -78,7 +119,9 @@ class Babyphone(object):
         # log.debug("done")
 
         log.debug("starting camera")
-        self.cam = picamera.PiCamera(resolution=(320, 240), framerate=10)
+        self.cam = self._hardware.createCamera(
+            resolution=renditions.CAMERA_RESOLUTION, framerate=renditions.FRAMERATE
+        )
         self.cam.rotation = 90
         log.debug("done")
 
@@ -91,14 +134,21 @@ class Babyphone(object):
         self._running.clear()
 
         self.motion.stop()
+        for task in self._streamingTasks.values():
+            task.cancel()
         self.cam.close()
 
     def close(self):
         log.info("closing babyphone")
-        this.stop()
+        self.stop()
         log.debug("shutting down thread pool executor")
         self.executor.shutdown()
-        gpio.cleanup()
+        self.motion.close()
+        self.camera.close()
+        self.recorder.stop()
+        self.hls.close()
+        self.history.close()
+        self.lights.close()
 
     @asyncio.coroutine
     def setNightMode(self, nightMode):
@@ -130,6 +180,13 @@ class Babyphone(object):
 
         yield from self.broadcastConfig()
 
+    @asyncio.coroutine
+    def setNoiseGate(self, noiseGate):
+        if noiseGate == self.noiseGate:
+            return
+        self.noiseGate = noiseGate
+        yield from self.broadcastConfig()
+
     @asyncio.coroutine
     def setMotionDetection(self, motionDetection):
         if motionDetection == self.motion.isRunning():
@@ -143,69 +200,106 @@ class Babyphone(object):
         yield from self.broadcastConfig()
 
     def _startAudioMonitoring(self):
+        source = None
         try:
-            log.debug("initializing Alsa PCM device")
-            inp = alsaaudio.PCM(
-                alsaaudio.PCM_CAPTURE, alsaaudio.PCM_NORMAL,
-                device="dmic_sv", # babyphone
-                # cardindex=2,      # dev pi
-            )
-            inp.setchannels(2)
-            inp.setrate(48000)
-            inp.setformat(alsaaudio.PCM_FORMAT_S32_LE)
-            inp.setperiodsize(320)
-            log.debug("...initialization done")
+            source = self._hardware.createAudioSource(self._audioLatency)
+            source.open()
 
             maxRms = (1 << 31) - 1  # only 15 because it's signed
             lastSent = time.time()
 
-            start = time.time()
-
-            sampleState = None
-            samples = []
+            pipeline = audiodsp.AudioPipeline(
+                channels=source.channels,
+                inRate=source.rate,
+                outRate=audiosource.OUTPUT_RATE,
+                gain=2,
+            )
+            packetSize = audiosource.OUTPUT_RATE * audiosource.PACKET_MILLIS // 1000
+            packetizer = audiosource.Packetizer(packetSize)
+            # number of samples captured so far, used as presentation timestamp
+            sentSamples = 0
+            volume = levels.LevelEstimator(rate=1000.0 / self._audioLatency)
+            periodTime = metrics.AUDIO_PERIOD.labels()
+            gate = audiodsp.NoiseGate(
+                period=source.periodSize / float(source.rate),
+                packetSeconds=audiosource.PACKET_MILLIS / 1000.0,
+            )
+            capturedPackets = metrics.AUDIO_PACKETS.labels("captured")
+            sentPackets = metrics.AUDIO_PACKETS.labels("sent")
             while True:
                 if not self._running.is_set():
                     log.info("Stopping audio monitoring by signal")
                     break
-                l, data = inp.read()
+                data = source.read()
 
-                if not l:
+                if data is None:
+                    log.info("Audio source exhausted, stopping audio monitoring")
+                    break
+                if not data:
                     continue
 
                 try:
-                    data = audioop.tomono(data, 4, 1, 1)
-                    (data, sampleState) = audioop.ratecv(
-                        data, 4, 1, 48000, 8000, sampleState
-                    )
-                    data = audioop.mul(data, 4, 2)
-                    rms = audioop.rms(data, 4)
-
-                    asyncio.run_coroutine_threadsafe(
-                        self._multicastAudio(
-                            audioop.lin2alaw(data, 4), time.time() - start
-                        ),
-                        loop=self._loop,
-                    )
-                    samples.append(float(rms) / float(maxRms))
+                    started = time.perf_counter()
+                    alaw, rms = pipeline.process(data)
+
+                    packets = packetizer.add(alaw)
+                    periodTime.observe(time.perf_counter() - started)
+                    level = rms / float(maxRms)
+                    pts = sentSamples * 1000000 // audiosource.OUTPUT_RATE
+                    sentSamples += len(packets) * packetSize
+                    # clips get the silence as well
+                    for packet in packets:
+                        self.recorder.buffer.addAudio(packet)
+                    capturedPackets.inc(len(packets))
+
+                    wasOpen = gate.isOpen
+                    chunks = gate.process(packets, pts, level)
+                    if not self.noiseGate:
+                        chunks = [(packets, pts)] if packets else []
+                    elif gate.isOpen != wasOpen:
+                        asyncio.run_coroutine_threadsafe(
+                            self.broadcast(
+                                {"action": "audiogate", "gate": self._gateStatus(gate)}
+                            ),
+                            loop=self._loop,
+                        )
+                    if chunks:
+                        # one wakeup of the loop per period, not per packet
+                        self._loop.call_soon_threadsafe(self._multicastAudio, chunks)
+                        sentPackets.inc(sum(len(chunk) for chunk, _ in chunks))
+                    volume.add(level)
 
                     if time.time() - lastSent >= 1.0:
-                        level = np.quantile(samples, 0.75)
-                        samples = []
                         lastSent = time.time()
+                        self._loop.call_soon_threadsafe(
+                            self._audioLevel,
+                            volume.level(),
+                            volume.level(window=60, quantile=0.5),
+                        )
                         asyncio.run_coroutine_threadsafe(
-                            self.broadcast({"action": "volume", "volume": level}),
+                            self.broadcast(
+                                {
+                                    "action": "volume",
+                                    "volume": volume.level(),
+                                    "levels": volume.report(),
+                                    # the heartbeat while the gate is closed
+                                    "gate": self._gateStatus(gate),
+                                }
+                            ),
                             loop=self._loop,
                         )
-                except audioop.error as e:
-                    log.debug("error in audioop %s. continuing..." % str(e))
+                except ValueError as e:
+                    log.debug("error processing audio %s. continuing..." % str(e))
                     continue
 
-
         except (asyncio.CancelledError, CancelledError) as e:
             log.info("Stopping audio monitoring since the task was cancelled")
         except Exception as e:
             log.error("Error monitoring audio")
             log.exception(e)
+        finally:
+            if source is not None:
+                source.close()
 
     @asyncio.coroutine
     def updateConfig(self, cfg):
@@ -217,20 +311,30 @@ class Babyphone(object):
         if motionDetection is not None:
             yield from self.setMotionDetection(motionDetection)
 
+        noiseGate = cfg.get("noise_gate")
+        if noiseGate is not None:
+            yield from self.setNoiseGate(noiseGate)
+
         yield from self.broadcastConfig()
 
-    @asyncio.coroutine
-    def _multicastAudio(self, audioData, relativeTime):
-        msg = dict(
-            action="audio",
-            audio=dict(
-                data=base64.b64encode(bytes(audioData)).decode("ascii"),
-                pts=int(relativeTime * 1000000),
-            ),
+    def _audioLevel(self, level, baseline):
+        self.history.add(timeseries.SERIES_VOLUME, level)
+        self.activity.audioLevel(level, baseline)
+
+    def _gateStatus(self, gate):
+        return dict(
+            enabled=self.noiseGate,
+            open=gate.isOpen or not self.noiseGate,
+            # for clients playing comfort noise while the gate is closed
+            noise_floor=gate.floor,
         )
-        for conn in self.conns:
-            if conn.audioRequested:
-                yield from conn._send(msg)
+
+    def _multicastAudio(self, chunks):
+        for packets, pts in chunks:
+            for data in packets:
+                packet = protocol.MediaPacket(protocol.STREAM_AUDIO, data, pts=pts)
+                self.fanout.publish(fanout.AUDIO, packet)
+                pts += audiosource.PACKET_MILLIS * 1000
 
     @asyncio.coroutine
     def broadcastConfig(self):
@@ -238,77 +342,99 @@ class Babyphone(object):
             dict(
                 action="configuration",
                 configuration=dict(
-                    night_mode=self.nightMode, motion_detection=self.motion.isRunning()
+                    night_mode=self.nightMode,
+                    motion_detection=self.motion.isRunning(),
+                    noise_gate=self.noiseGate,
                 ),
             )
         )
 
     @asyncio.coroutine
     def streamStatusUpdated(self):
-        while True:
-            if self.motion.isTakingPicture():
-                log.debug("waiting for motion detection to finish")
-                yield from asyncio.sleep(0.2)
-            else:
-                break
-
-        if self.isAnyoneStreaming():
-            if self._streamingTask is None or self._streamingTask.done():
-                self._streamingTask = asyncio.ensure_future(self.startStream())
-        else:
-            if self._streamingTask and not self._streamingTask.done():
-                self._streamingTask.cancel()
+        """Records the renditions someone is streaming, and only those"""
+        wanted = set(c.rendition for c in self.conns if c.streamRequested)
+        for name in wanted:
+            task = self._streamingTasks.get(name)
+            if task is None or task.done():
+                self._streamingTasks[name] = asyncio.ensure_future(
+                    self.startStream(renditions.BY_NAME[name])
+                )
+        for name, task in list(self._streamingTasks.items()):
+            if name not in wanted:
+                task.cancel()
+                del self._streamingTasks[name]
 
     @asyncio.coroutine
-    def startStream(self):
+    def startStream(self, rendition):
+        cam = None
+        starting = None
+        primary = self._primaryRendition is None
+        if primary:
+            self._primaryRendition = rendition.name
         try:
-            self.setLights(self.nightMode)
-            log.info("Start recording with cam")
+            log.info("Start recording %s with cam", rendition.name)
+            self.fanout.resetVideo(rendition.name)
+            output = renditions.RenditionOutput(
+                self, self._loop, rendition, self.cam, primary
+            )
+            options = renditions.recordingOptions(rendition)
+            if primary:
+                # motion detection uses the vectors while the camera is busy streaming
+                options["motion_output"] = self.motion.motionVectorOutput(
+                    rendition.resolution
+                )
 
-            self.cam.start_recording(
-                self, format="h264", intra_period=10, profile="main", quality=23
+            # waits for a still being taken
+            starting = asyncio.ensure_future(
+                self.camera.startRecording(
+                    output, splitterPort=rendition.splitterPort, **options
+                )
             )
+            cam = yield from asyncio.shield(starting)
+            self.setLights(self.nightMode)
             # wait forever
             yield from asyncio.sleep(36000)
 
         except (asyncio.CancelledError, CancelledError) as e:
-            log.info("streaming cancelled, will stop recording")
+            log.info("streaming %s cancelled, will stop recording", rendition.name)
         except Exception as e:
             log.info("exception while streamcam")
             log.exception(e)
         finally:
-            log.info("stopping the recording")
-            self.cam.annotate_background = None
-            self.cam.annotate_text = ""
-            self.cam.stop_recording()
-            self.setLights(False)
-
-    def write(self, data):
-        try:
-            self._videoFrameData.extend(data)
-            if self.cam.frame.complete:
-                frame = self.cam.frame
-                msg = dict(
-                    action="vframe",
-                    pts=frame.timestamp,
-                    offset=frame.position,
-                    timestamp=frame.timestamp,
-                    now=int(time.time() * 1000),
-                    data=base64.b64encode(bytes(self._videoFrameData)).decode("ascii"),
-                    type=0,
-                )
-                if frame == picamera.PiVideoFrameType.sps_header:
-                    msg["type"] = 1
-                asyncio.run_coroutine_threadsafe(self.broadcast(msg), loop=self._loop)
-
-                self._videoFrameData = []
-        except Exception as e:
-            log.exception(e)
+            if primary:
+                self._primaryRendition = None
+            if cam is None and starting is not None:
+                # cancelled while waiting for the camera, it starts anyway
+                try:
+                    cam = yield from starting
+                except Exception:
+                    pass
+            # the camera is replaced if the babyphone is restarted while we're streaming
+            if cam is not None:
+                log.info("stopping the recording of %s", rendition.name)
+                try:
+                    yield from self.camera.stopRecording(cam, rendition.splitterPort)
+                except Exception as e:
+                    log.info("could not stop recording, camera closed already? %s", e)
+            if not self.camera.isRecording():
+                self.setLights(False)
+
+    def hasMotionVectors(self):
+        """Whether a recording delivers motion vectors to the motion detection"""
+        return self._primaryRendition is not None
+
+    def _queueDepths(self):
+        # subscribers within the server don't have a queue, closed connections
+        # have no peer but may not be removed yet
+        return dict(
+            ((c.peer,), c.queue.depth())
+            for c in self.conns
+            if hasattr(c, "queue") and c.peer is not None
+        )
 
     @asyncio.coroutine
     def broadcast(self, obj):
-        for con in self.conns:
-            yield from con._send(obj)
+        self.fanout.publish(fanout.CONTROL, obj)
 
     def isAnyoneStreaming(self):
         return any([con.streamRequested for con in self.conns])
@@ -319,7 +445,10 @@ class Babyphone(object):
         yield from self.broadcast({"action": "systemstatus", "status": "shutdown"})
         # give the clients 2 seconds to disconnect
         yield from asyncio.sleep(2)
-        subprocess.check_call(["sudo", "shutdown", "-h", "0"])
+        # blocks until the command returns, not on the loop
+        yield from self._loop.run_in_executor(
+            self.executor, subprocess.check_call, ["sudo", "shutdown", "-h", "0"]
+        )
 
     @asyncio.coroutine
     def restart(self, conn):
@@ -327,7 +456,10 @@ class Babyphone(object):
         yield from self.broadcast({"action": "systemstatus", "status": "restart"})
         # give the clients 2 seconds to disconnect
         yield from asyncio.sleep(2)
-        subprocess.check_call(["sudo", "shutdown", "-r", "0"])
+        # blocks until the command returns, not on the loop
+        yield from self._loop.run_in_executor(
+            self.executor, subprocess.check_call, ["sudo", "shutdown", "-r", "0"]
+        )
 
     @asyncio.coroutine
     def connect(self, websocket, path):
@@ -338,29 +470,40 @@ class Babyphone(object):
             self.start()
 
         self.conns.add(c)
+        self.motion.scheduler.setClientsConnected(True)
 
         yield from c.run()
 
+    def addSubscriber(self, subscriber):
+        """Adds a subscriber within the server (e.g. HLS) like a connection.
+        Removed with removeConnection"""
+        if len(self.conns) == 0:
+            self.start()
+        self.conns.add(subscriber)
+        self.motion.scheduler.setClientsConnected(True)
+        self.fanout.prime(subscriber)
+        asyncio.ensure_future(self.streamStatusUpdated())
+
     def removeConnection(self, conn):
         self.conns.remove(conn)
+        self.motion.scheduler.setClientsConnected(len(self.conns) > 0)
 
         if len(self.conns) == 0:
             self.stop()
+        elif conn.streamRequested:
+            # the connection might have been the last one streaming
+            asyncio.ensure_future(self.streamStatusUpdated())
 
     def setLights(self, on):
         log.info("turning lights %s", "on" if on else "off")
-        gpio.output(self.LIGHTS_GPIO, bool(on))
+        self.lights.set(on)
 
     @asyncio.coroutine
     def getLastPictureAsBytes(self, refresh):
-        if refresh:
-            yield from self.motion.updatePicture(highRes=True)
-        lastPicture = self.motion.lastPicture
-
-        if lastPicture is None:
+        picture = yield from self.snapshots.get(refresh=refresh)
+        if picture is None:
             return None
-
-        return cv2.imencode(".png", lastPicture)[1].tostring()
+        return picture.body
 
     def getLastPictureTimestamp(self):
         return self.motion.lastPictureTimestamp
@@ -378,9 +521,26 @@ class Connection(object):
         self.useLights = False
         self.streamRequested = False
         self.audioRequested = False
+        # got the cached start of the current group of pictures
+        self.videoPrimed = False
+
+        # the video quality, chosen by the server from the send queue and the
+        # round trip time unless the client picks one
+        self.rendition = renditions.DEFAULT
+        self._autoRendition = True
+        self._policy = renditions.AdaptivePolicy()
+        # smoothed round trip time of the pings in seconds
+        self.rtt = None
+        self._unansweredPings = set()
+
+        # clients have to ask for binary media frames, old clients get json
+        self.mediaMode = protocol.MODE_JSON
+
+        self.queue = sendqueue.SendQueue()
 
         log.info("Client connected")
 
+        self._writer = asyncio.ensure_future(self._writeQueue())
         self._heartbeat = asyncio.ensure_future(self.heartbeat())
 
     @asyncio.coroutine
@@ -404,16 +564,97 @@ class Connection(object):
     def heartbeat(self):
         log.info("Starting heartbeating to client")
         while True:
-            try:
-                yield from self._send({"action": "heartbeat"})
-            except websockets.exceptions.ConnectionClosed as e:
-                return
-
+            yield from self._send({"action": "heartbeat"})
+            yield from self._ping()
+            if self.streamRequested and self._autoRendition:
+                yield from self._adaptRendition()
             yield from asyncio.sleep(1)
 
+    @asyncio.coroutine
+    def _ping(self):
+        try:
+            pong = yield from self._ws.ping()
+        except websockets.exceptions.ConnectionClosed:
+            return
+        sent = time.time()
+        self._unansweredPings.add(sent)
+        pong.add_done_callback(functools.partial(self._onPong, sent))
+
+    def _onPong(self, sent, pong):
+        self._unansweredPings.discard(sent)
+        if pong.cancelled() or pong.exception() is not None:
+            return
+        rtt = time.time() - sent
+        self.rtt = rtt if self.rtt is None else 0.7 * self.rtt + 0.3 * rtt
+
+    def roundTripTime(self):
+        """The smoothed round trip time, at least as long as the oldest ping is
+        unanswered"""
+        if not self._unansweredPings:
+            return self.rtt
+        return max(self.rtt or 0.0, time.time() - min(self._unansweredPings))
+
+    @asyncio.coroutine
+    def _adaptRendition(self):
+        stats = self.queue.stats()
+        rendition = self._policy.evaluate(
+            self.rendition,
+            stats["queued"][fanout.VIDEO],
+            stats["dropped"][fanout.VIDEO],
+            self.roundTripTime(),
+        )
+        if rendition != self.rendition:
+            log.info(
+                "switching %s from %s to %s, queue %s, rtt %s",
+                self,
+                self.rendition,
+                rendition,
+                stats,
+                self.roundTripTime(),
+            )
+            yield from self.setRendition(rendition)
+
+    @asyncio.coroutine
+    def setRendition(self, name):
+        if name != self.rendition:
+            self.rendition = name
+            self.videoPrimed = False
+            # frames of the former rendition are useless now
+            self.queue.dropVideo()
+        yield from self._send(
+            dict(
+                action="rendition",
+                rendition=name,
+                resolution=list(renditions.BY_NAME[name].resolution),
+                auto=self._autoRendition,
+            )
+        )
+        if self.streamRequested and not self.videoPrimed:
+            self.bp.fanout.prime(self)
+            yield from self.bp.streamStatusUpdated()
+
+    @asyncio.coroutine
+    def _writeQueue(self):
+        try:
+            while True:
+                data = yield from self.queue.get()
+                yield from self._ws.send(data)
+        except websockets.exceptions.ConnectionClosed as e:
+            log.info("websocket closed, stop sending. Queue stats: %s", self.queue.stats())
+
     @asyncio.coroutine
     def _send(self, obj):
-        yield from self._ws.send(json.dumps(obj))
+        self.enqueue(fanout.CONTROL, json.dumps(obj))
+
+    def enqueue(self, kind, data, sps=False):
+        self.queue.put(kind, data, sps)
+
+    def subscribes(self, kind):
+        if kind == fanout.VIDEO:
+            return self.streamRequested
+        if kind == fanout.AUDIO:
+            return self.audioRequested
+        return True
 
     @asyncio.coroutine
     def handleMessage(self, message):
@@ -421,6 +662,11 @@ class Connection(object):
         if "action" not in msg:
             raise InvalidMessageException("action not in message")
 
+        with looplag.label("websocket action %s" % msg["action"]):
+            yield from self._handleAction(msg, message)
+
+    @asyncio.coroutine
+    def _handleAction(self, msg, message):
         if msg["action"] == "shutdown":
             yield from self.bp.shutdown(self)
         elif msg["action"] == "restart":
@@ -436,10 +682,14 @@ class Connection(object):
         elif msg["action"] == "lightsoff":  # deprecated, remove
             self.bp.setLights(False)
         elif msg["action"] == "_startstream":
-            self.streamRequested = True
+            if not self.streamRequested:
+                self.streamRequested = True
+                # decodable right away if the camera is recording already
+                self.bp.fanout.prime(self)
             yield from self.bp.streamStatusUpdated()
         elif msg["action"] == "_stopstream":
             self.streamRequested = False
+            self.videoPrimed = False
             yield from self.bp.streamStatusUpdated()
         elif msg["action"] == "startaudio":
             self.audioRequested = True
@@ -456,6 +706,26 @@ class Connection(object):
 
         elif msg["action"] == "configuration_request":
             yield from self.bp.broadcastConfig()
+        elif msg["action"] == "rendition":
+            name = msg.get("rendition", renditions.AUTO)
+            if name == renditions.AUTO:
+                # clients asking for it can handle all resolutions
+                self._autoRendition = True
+                self._policy.maxRendition = renditions.NAMES[-1]
+                yield from self.setRendition(self.rendition)
+            elif name in renditions.BY_NAME:
+                self._autoRendition = False
+                yield from self.setRendition(name)
+            else:
+                raise InvalidMessageException("unknown rendition %s" % name)
+        elif msg["action"] == "protocol":
+            mode = msg.get("media", protocol.MODE_JSON)
+            if mode not in protocol.MODES:
+                raise InvalidMessageException("unsupported media mode %s" % mode)
+            self.mediaMode = mode
+            yield from self._send(
+                dict(action="protocol", media=mode, version=protocol.VERSION)
+            )
         else:
             log.error("Unhandled message from connection %s: %s", self, message)
 
@@ -464,11 +734,20 @@ class Connection(object):
         log.info("disconnecting websocket")
         try:
             self._heartbeat.cancel()
+            self._writer.cancel()
             # idempotent
-            self._ws.close()
+            yield from self._ws.close()
         finally:
             # remove from set of cnnections
             self.bp.removeConnection(self)
 
+    @property
+    def peer(self):
+        """host:port of the client, None once the connection is closed"""
+        address = self._ws.remote_address
+        if address is None:
+            return None
+        return "%s:%d" % address[:2]
+
     def __str__(self):
         return "Connection {ws.host}".format(ws=self._ws)
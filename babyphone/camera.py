@@ -0,0 +1,255 @@
+import asyncio
+import functools
+import heapq
+import io
+import itertools
+import logging
+import time
+
+log = logging.getLogger("babyphone")
+
+# lower is more important
+PRIORITY_STREAM = 0
+PRIORITY_REFRESH = 1
+# motion captures requested by an audio spike
+PRIORITY_ACTIVITY = 2
+PRIORITY_MOTION = 3
+
+PRIORITY_NAMES = {
+    PRIORITY_STREAM: "stream",
+    PRIORITY_REFRESH: "refresh",
+    PRIORITY_ACTIVITY: "activity",
+    PRIORITY_MOTION: "motion",
+}
+
+
+class _Request(object):
+    def __init__(self, priority, key, func, args):
+        self.priority = priority
+        self.key = key
+        self.func = func
+        self.args = args
+        self.future = asyncio.Future()
+        self.queued = time.time()
+        self.started = False
+
+
+class CameraArbiter(object):
+    """Serializes everything that uses the camera.
+
+    Stills and starting/stopping the recording are queued by priority
+    (stream > refresh > motion) and executed one at a time, so a capture never
+    changes the resolution or the lights under another one. Requests for the
+    same still join the one queued or being taken.
+
+    Several recordings can run at the same time, on different splitter ports.
+    While recording, stills come from the video port, so the streams keep
+    running. Stills are taken at pictureResolution, high resolution stills at
+    stillResolution (at the camera resolution while recording).
+    """
+
+    def __init__(
+        self, babyphone, pictureResolution=(320, 240), stillResolution=(800, 600)
+    ):
+        self._bp = babyphone
+        self.pictureResolution = pictureResolution
+        self.stillResolution = stillResolution
+
+        self._queue = []
+        self._seq = itertools.count()
+        # key -> queued request, for coalescing
+        self._pending = {}
+        self._current = None
+        self._wakeup = asyncio.Event()
+        self._worker = None
+        # splitter port -> recording camera
+        self._recordings = {}
+
+        self._stats = dict(
+            (
+                name,
+                dict(requests=0, coalesced=0, wait_ms_total=0.0, max_wait_ms=0.0),
+            )
+            for name in PRIORITY_NAMES.values()
+        )
+
+    def isRecording(self):
+        # the camera is replaced when the babyphone restarts
+        return any(cam is self._bp.cam for cam in self._recordings.values())
+
+    def isBusy(self):
+        return self._current is not None or bool(self._pending)
+
+    @asyncio.coroutine
+    def capture(self, priority, highRes=False, nightMode=False):
+        """Takes a still and returns it as jpeg"""
+        return (
+            yield from self._submit(
+                priority,
+                ("still", highRes, nightMode),
+                self._capture,
+                highRes,
+                nightMode,
+            )
+        )
+
+    @asyncio.coroutine
+    def startRecording(self, output, splitterPort=1, **kwargs):
+        """Starts recording to output, returns the recording camera"""
+        return (
+            yield from self._submit(
+                PRIORITY_STREAM,
+                None,
+                self._startRecording,
+                output,
+                splitterPort,
+                kwargs,
+            )
+        )
+
+    @asyncio.coroutine
+    def stopRecording(self, cam, splitterPort=1):
+        yield from self._submit(
+            PRIORITY_STREAM, None, self._stopRecording, cam, splitterPort
+        )
+
+    def stats(self):
+        stats = {}
+        for name, s in self._stats.items():
+            started = s["requests"] - s["coalesced"]
+            stats[name] = dict(
+                requests=s["requests"],
+                coalesced=s["coalesced"],
+                mean_wait_ms=s["wait_ms_total"] / started if started else 0.0,
+                max_wait_ms=s["max_wait_ms"],
+            )
+        stats["queued"] = len(self._pending)
+        return stats
+
+    def close(self):
+        if self._worker is not None:
+            self._worker.cancel()
+            self._worker = None
+        for _, _, request in self._queue:
+            if not request.future.done():
+                request.future.cancel()
+        self._queue = []
+        self._pending = {}
+
+    @asyncio.coroutine
+    def _submit(self, priority, key, func, *args):
+        stats = self._stats[PRIORITY_NAMES[priority]]
+        stats["requests"] += 1
+
+        request = None
+        if key is not None:
+            if self._current is not None and self._current.key == key:
+                request = self._current
+            else:
+                request = self._pending.get(key)
+
+        if request is not None:
+            stats["coalesced"] += 1
+            if priority < request.priority and not request.started:
+                # requeue with the higher priority, the old entry is skipped
+                request.priority = priority
+                heapq.heappush(self._queue, (priority, next(self._seq), request))
+        else:
+            request = _Request(priority, key, func, args)
+            heapq.heappush(self._queue, (priority, next(self._seq), request))
+            if key is not None:
+                self._pending[key] = request
+            self._wakeup.set()
+            if self._worker is None:
+                self._worker = asyncio.ensure_future(self._work())
+
+        # shielded, a waiter going away must not cancel it for the others
+        return (yield from asyncio.shield(request.future))
+
+    @asyncio.coroutine
+    def _work(self):
+        while True:
+            while not self._queue:
+                self._wakeup.clear()
+                yield from self._wakeup.wait()
+
+            _, _, request = heapq.heappop(self._queue)
+            if request.started:
+                continue
+            request.started = True
+            if self._pending.get(request.key) is request:
+                del self._pending[request.key]
+
+            name = PRIORITY_NAMES[request.priority]
+            waitMs = (time.time() - request.queued) * 1000.0
+            stats = self._stats[name]
+            stats["wait_ms_total"] += waitMs
+            stats["max_wait_ms"] = max(stats["max_wait_ms"], waitMs)
+            log.debug("camera: %s request waited %.1fms", name, waitMs)
+
+            self._current = request
+            try:
+                result = yield from request.func(*request.args)
+                request.future.set_result(result)
+            except asyncio.CancelledError:
+                request.future.cancel()
+                raise
+            except Exception as e:
+                request.future.set_exception(e)
+            finally:
+                self._current = None
+
+    @asyncio.coroutine
+    def _inExecutor(self, func, *args, **kwargs):
+        return (
+            yield from asyncio.get_event_loop().run_in_executor(
+                self._bp.executor, functools.partial(func, *args, **kwargs)
+            )
+        )
+
+    @asyncio.coroutine
+    def _capture(self, highRes, nightMode):
+        cam = self._bp.cam
+        stream = io.BytesIO()
+
+        resize = None if highRes else self.pictureResolution
+        if self.isRecording():
+            # the lights are on already if needed
+            yield from self._inExecutor(
+                cam.capture, stream, "jpeg", use_video_port=True, resize=resize
+            )
+            return stream.getvalue()
+
+        oldRes = cam.resolution
+        try:
+            if nightMode:
+                self._bp.setLights(True)
+                # let the camera adjust to the new light settings
+                yield from asyncio.sleep(0.2)
+            if highRes:
+                cam.resolution = self.stillResolution
+            # capturing blocks until the camera delivers the picture
+            yield from self._inExecutor(cam.capture, stream, "jpeg", resize=resize)
+            return stream.getvalue()
+        finally:
+            cam.resolution = oldRes
+            if nightMode:
+                self._bp.setLights(False)
+
+    @asyncio.coroutine
+    def _startRecording(self, output, splitterPort, kwargs):
+        cam = self._bp.cam
+        yield from self._inExecutor(
+            cam.start_recording, output, splitter_port=splitterPort, **kwargs
+        )
+        self._recordings[splitterPort] = cam
+        return cam
+
+    @asyncio.coroutine
+    def _stopRecording(self, cam, splitterPort):
+        if self._recordings.get(splitterPort) is cam:
+            del self._recordings[splitterPort]
+        if not self.isRecording():
+            cam.annotate_background = None
+            cam.annotate_text = ""
+        yield from self._inExecutor(cam.stop_recording, splitter_port=splitterPort)
@@ -1,13 +1,19 @@
 import asyncio
+import functools
 import json
 import socket
 
+DISCOVERY_PORT = 31634
+
 
 class DiscoveryServer(asyncio.DatagramProtocol):
 
-    def __init__(self, *args, **kwargs):
-        asyncio.DatagramProtocol.__init__(self, *args, **kwargs)
+    def __init__(self, port=8080, hub=False):
+        asyncio.DatagramProtocol.__init__(self)
         self._host = socket.gethostbyaddr(self._get_ip())
+        # the websocket port, and whether we're a hub rather than a node
+        self._port = port
+        self._hub = hub
 
     def _get_ip(self):
         s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
@@ -32,17 +38,23 @@ class DiscoveryServer(asyncio.DatagramProtocol):
             self.advertise()
 
     def advertise(self):
-        self._transport.sendto(json.dumps(dict(
+        message = dict(
             action='advertise',
             host=self._host[0],
-            ip = self._host[2][0])).encode('utf-8'),
-            ('<broadcast>', 31634))
-
-def createDiscoveryServer(loop):
+            ip = self._host[2][0],
+            port=self._port)
+        if self._hub:
+            message['hub'] = True
+        self._transport.sendto(json.dumps(message).encode('utf-8'),
+            ('<broadcast>', DISCOVERY_PORT))
+
+def createDiscoveryServer(loop, port=8080):
     print("creating socket")
+    # shared with a hub running on the same machine
     endpoint = loop.create_datagram_endpoint(
-        DiscoveryServer, local_addr=('0.0.0.0', 31634),
-        allow_broadcast=True,)
+        functools.partial(DiscoveryServer, port=port),
+        local_addr=('0.0.0.0', DISCOVERY_PORT),
+        allow_broadcast=True, reuse_port=True)
     print("endpoint", endpoint)
     transport, protocol = loop.run_until_complete(endpoint)
     print("started endpoint successfully")
@@ -0,0 +1,104 @@
+import json
+
+# kinds of messages a subscriber can be interested in
+CONTROL = "control"
+VIDEO = "video"
+AUDIO = "audio"
+
+
+class Fanout(object):
+    """Distributes messages to a set of subscribers.
+
+    Every message is encoded at most once per wire format, no matter how many
+    subscribers receive it. The resulting buffers are immutable (str/bytes) and
+    shared between all subscribers. Publishing only enqueues the buffers, each
+    subscriber sends from its own queue, so a slow client does not hold back the
+    others.
+
+    Video is published per rendition (see renditions), subscribers get the
+    video of the rendition they're set to. The video since the last SPS header
+    is cached per rendition. A subscriber that starts receiving video in the
+    middle of a group of pictures first gets this prefix (it's primed), so it
+    can decode right away instead of waiting for the next keyframe. The
+    replayed messages are marked as primed (see protocol.FLAG_PRIMED).
+
+    Subscribers have to provide
+     - subscribes(kind): whether they want messages of this kind
+     - mediaMode: the wire format media is encoded with (see protocol.MODES)
+     - enqueue(kind, data, sps): queue an encoded message for sending
+     - rendition: the name of the rendition it receives video of
+     - videoPrimed: whether the subscriber got the cached prefix, to be reset
+       when it stops receiving video or changes the rendition
+    """
+
+    def __init__(self, subscribers, maxCachedFrames=30):
+        self._subscribers = subscribers
+        self._maxCachedFrames = maxCachedFrames
+        # rendition -> [message, {mode: encoded}, {mode: encoded as primed}]
+        # since the last SPS header
+        self._gops = {}
+
+    def publish(self, kind, message, rendition=None):
+        """Publishes a message to all subscribers of kind.
+
+        message is either a json-serializable dict (control messages) or
+        a protocol.MediaPacket, video of the given rendition. Must be called
+        from the event loop.
+        """
+        encoded = {}
+        sps = kind == VIDEO and message.isSps()
+        if kind == VIDEO:
+            self._cacheVideo(rendition, message, encoded, sps)
+        for target in self._subscribers:
+            if not target.subscribes(kind):
+                continue
+            if kind == VIDEO:
+                if target.rendition != rendition:
+                    continue
+                if not target.videoPrimed:
+                    # the cached prefix includes this message
+                    self.prime(target)
+                    continue
+            mode = target.mediaMode if kind != CONTROL else None
+            data = encoded.get(mode)
+            if data is None:
+                data = encoded[mode] = self._encode(message, mode)
+            target.enqueue(kind, data, sps)
+
+    def prime(self, target):
+        """Sends the cached video since the last SPS header to the target.
+
+        Without a cached header the target stays unprimed and will be primed by
+        the next header published.
+        """
+        gop = self._gops.get(target.rendition)
+        if not gop:
+            return
+        mode = target.mediaMode
+        for message, _, primed in gop:
+            data = primed.get(mode)
+            if data is None:
+                data = primed[mode] = message.encode(mode, primed=True)
+            target.enqueue(VIDEO, data, message.isSps())
+        target.videoPrimed = True
+
+    def resetVideo(self, rendition=None):
+        """Forgets the cached video of the rendition, e.g. when its encoder
+        restarts"""
+        self._gops.pop(rendition, None)
+
+    def _cacheVideo(self, rendition, message, encoded, sps):
+        gop = self._gops.get(rendition)
+        if sps:
+            self._gops[rendition] = [[message, encoded, {}]]
+        elif gop:
+            if len(gop) >= self._maxCachedFrames:
+                # too long to be useful, wait for the next header
+                del self._gops[rendition]
+            else:
+                gop.append([message, encoded, {}])
+
+    def _encode(self, message, mode):
+        if mode is None:
+            return json.dumps(message)
+        return message.encode(mode)
@@ -0,0 +1,42 @@
+class FrameAssembler(object):
+    """Collects the chunks the camera encoder writes into complete frames.
+
+    The chunks are copied into a preallocated buffer, which only grows if a frame
+    does not fit. Taking a frame costs one copy into an immutable bytes object,
+    which is needed anyway as the frame is queued for the clients after the
+    buffer has been reused for the next frame.
+    """
+
+    def __init__(self, capacity=128 * 1024):
+        self._buf = bytearray(capacity)
+        self._view = memoryview(self._buf)
+        self._size = 0
+
+    def append(self, data):
+        end = self._size + len(data)
+        if end > len(self._buf):
+            self._grow(end)
+        self._view[self._size : end] = data
+        self._size = end
+
+    def take(self):
+        """Returns the collected frame and resets the assembler for the next one"""
+        frame = bytes(self._view[: self._size])
+        self._size = 0
+        return frame
+
+    def reset(self):
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def _grow(self, minSize):
+        capacity = len(self._buf)
+        while capacity < minSize:
+            capacity *= 2
+        buf = bytearray(capacity)
+        buf[: self._size] = self._view[: self._size]
+        self._view.release()
+        self._buf = buf
+        self._view = memoryview(buf)
@@ -0,0 +1,328 @@
+import collections
+import logging
+import os
+import threading
+import time
+
+import numpy as np
+
+from babyphone import audiosource, motionvectors, protocol
+
+log = logging.getLogger("babyphone")
+
+
+class Hardware(object):
+    """Creates the devices the babyphone uses: camera, audio capture and lights"""
+
+    def createCamera(self, resolution, framerate):
+        raise NotImplementedError()
+
+    def createAudioSource(self, latency):
+        raise NotImplementedError()
+
+    def createLights(self, pin):
+        raise NotImplementedError()
+
+
+class PiHardware(Hardware):
+    """The raspberry pi camera, the I2S microphone and lights on a GPIO pin"""
+
+    def __init__(self, audioDevice="dmic_sv"):
+        self._audioDevice = audioDevice
+
+    def createCamera(self, resolution, framerate):
+        import picamera
+
+        return picamera.PiCamera(resolution=resolution, framerate=framerate)
+
+    def createAudioSource(self, latency):
+        return audiosource.AlsaSource(
+            device=self._audioDevice,
+            rate=48000,
+            channels=2,
+            periodSize=audiosource.periodSize(48000, latency),
+        )
+
+    def createLights(self, pin):
+        return GpioLights(pin)
+
+
+class SimulatedHardware(Hardware):
+    """Replays recorded media or generates test patterns, to run off the Pi.
+
+    video is a raw h264 file (e.g. recorded with raspivid), audio a wav file and
+    motion the encoder's motion vectors (recorded with `raspivid -x`).
+    Without them, synthetic data is used. speed > 1 replays faster than real time.
+    """
+
+    def __init__(self, video=None, audio=None, motion=None, speed=1.0):
+        self._video = video
+        self._audio = audio
+        self._motion = motion
+        self._speed = speed
+
+    def createCamera(self, resolution, framerate):
+        return SimulatedCamera(
+            resolution,
+            framerate,
+            video=self._video,
+            motion=self._motion,
+            speed=self._speed,
+        )
+
+    def createAudioSource(self, latency):
+        if self._audio:
+            source = audiosource.WavSource(self._audio, speed=self._speed)
+            source.periodSize = audiosource.periodSize(source.rate, latency)
+            return source
+        return audiosource.SyntheticSource(
+            periodSize=audiosource.periodSize(48000, latency), speed=self._speed
+        )
+
+    def createLights(self, pin):
+        return SimulatedLights()
+
+
+class GpioLights(object):
+    def __init__(self, pin):
+        import RPi.GPIO as gpio
+
+        log.debug("configuring GPIO")
+        self._gpio = gpio
+        self._pin = pin
+        gpio.setmode(gpio.BCM)
+        gpio.setup(pin, gpio.OUT)
+
+    def set(self, on):
+        self._gpio.output(self._pin, bool(on))
+
+    def close(self):
+        self._gpio.cleanup()
+
+
+class SimulatedLights(object):
+    def __init__(self):
+        self.on = False
+
+    def set(self, on):
+        self.on = bool(on)
+
+    def close(self):
+        pass
+
+
+def currentFrame(camera, splitterPort=1):
+    """The PiVideoFrame of the recording on a splitter port.
+
+    camera.frame is the frame of any of the recordings, so with several
+    recordings the frame has to come from the port's encoder.
+    """
+    return camera._encoders[splitterPort].frame
+
+
+# the attributes of picamera.PiVideoFrame the babyphone uses
+SimulatedFrame = collections.namedtuple(
+    "SimulatedFrame", ["index", "frame_type", "timestamp", "complete", "position"]
+)
+
+_NAL_START = b"\x00\x00\x00\x01"
+_NAL_SPS = 7
+_NAL_PPS = 8
+_NAL_IDR = 5
+
+
+def splitH264(stream):
+    """Splits a raw h264 stream into frames like picamera reports them.
+
+    Returns a list of (frame_type, data), SPS and PPS are combined into one
+    sps header frame.
+    """
+    nals = []
+    start = stream.find(_NAL_START)
+    while start >= 0:
+        end = stream.find(_NAL_START, start + 4)
+        nals.append(stream[start : end if end >= 0 else len(stream)])
+        start = end
+
+    frames = []
+    header = b""
+    for nal in nals:
+        nalType = nal[4] & 0x1F if len(nal) > 4 else 0
+        if nalType in (_NAL_SPS, _NAL_PPS):
+            header += nal
+            continue
+        if header:
+            frames.append((protocol.FRAME_TYPE_SPS_HEADER, header))
+            header = b""
+        if nalType == _NAL_IDR:
+            frames.append((protocol.FRAME_TYPE_KEY_FRAME, nal))
+        else:
+            frames.append((protocol.FRAME_TYPE_FRAME, nal))
+    return frames
+
+
+def syntheticH264(intraPeriod=10, iFrameSize=12000, pFrameSize=2000, gops=10):
+    """Frames with valid NAL headers and random payload.
+
+    Not decodable, but sized and typed like the real stream, which is enough
+    for load testing.
+    """
+    frames = []
+    for _ in range(gops):
+        frames.append(
+            (
+                protocol.FRAME_TYPE_SPS_HEADER,
+                _NAL_START + b"\x67" + os.urandom(12) + _NAL_START + b"\x68" + os.urandom(4),
+            )
+        )
+        frames.append(
+            (protocol.FRAME_TYPE_KEY_FRAME, _NAL_START + b"\x65" + os.urandom(iFrameSize))
+        )
+        for _ in range(intraPeriod - 1):
+            frames.append(
+                (protocol.FRAME_TYPE_FRAME, _NAL_START + b"\x41" + os.urandom(pFrameSize))
+            )
+    return frames
+
+
+class SimulatedCamera(object):
+    """Stands in for picamera.PiCamera.
+
+    Recording replays h264 frames to the output in a thread, like the encoder
+    does, and motion vectors to the motion_output. Every splitter port records
+    independently, synthetic frames are sized by the resolution. Captures
+    return a jpeg of a test pattern with a moving square, so motion detection
+    has something to detect.
+    """
+
+    def __init__(self, resolution, framerate, video=None, motion=None, speed=1.0):
+        self.resolution = resolution
+        self.framerate = framerate
+        self.rotation = 0
+        self.brightness = 50
+        self.iso = 0
+        self.contrast = 0
+        self.awb_mode = "auto"
+        self.awb_gains = (1, 1)
+        self.exposure_mode = "auto"
+        self.annotate_background = None
+        self.annotate_text = ""
+
+        self._speed = speed
+        self._video = None
+        if video:
+            with open(video, "rb") as f:
+                self._video = splitH264(f.read())
+
+        self._motion = None
+        if motion:
+            with open(motion, "rb") as f:
+                self._motion = f.read()
+
+        # splitter port -> (thread, stop event)
+        self._recordings = {}
+        # splitter port -> encoder with the current frame, like picamera's
+        self._encoders = {}
+        self._captures = 0
+
+    @property
+    def frame(self):
+        # like picamera, the frame of whichever recording comes first
+        for encoder in self._encoders.values():
+            return encoder.frame
+        return None
+
+    def start_recording(
+        self,
+        output,
+        format="h264",
+        motion_output=None,
+        splitter_port=1,
+        resize=None,
+        **kwargs
+    ):
+        if splitter_port in self._recordings:
+            raise RuntimeError("camera is already recording on port %d" % splitter_port)
+        resolution = tuple(resize or self.resolution)
+        if self._video:
+            frames = self._video
+        else:
+            scale = resolution[0] * resolution[1] / (320.0 * 240.0)
+            frames = syntheticH264(
+                iFrameSize=int(12000 * scale), pFrameSize=int(2000 * scale)
+            )
+        motion = self._motion or motionvectors.syntheticMotion(resolution, 200)
+
+        encoder = _SimulatedEncoder()
+        self._encoders[splitter_port] = encoder
+        stop = threading.Event()
+        thread = threading.Thread(
+            target=self._replay,
+            args=(output, motion_output, motion, frames, resolution, encoder, stop),
+            name="simulated-camera-%d" % splitter_port,
+        )
+        thread.daemon = True
+        self._recordings[splitter_port] = (thread, stop)
+        thread.start()
+
+    def stop_recording(self, splitter_port=1):
+        recording = self._recordings.pop(splitter_port, None)
+        if recording is None:
+            return
+        thread, stop = recording
+        stop.set()
+        thread.join()
+        self._encoders.pop(splitter_port, None)
+
+    def capture(self, output, format="jpeg", resize=None, **kwargs):
+        import cv2
+
+        width, height = resize or self.resolution
+        image = np.zeros((height, width, 3), dtype=np.uint8)
+        image[:] = np.linspace(40, 200, width, dtype=np.uint8)[None, :, None]
+        size = max(min(width, height) // 6, 1)
+        x = (self._captures * size // 2) % max(width - size, 1)
+        image[height // 2 - size // 2 : height // 2 + size // 2, x : x + size] = 255
+        self._captures += 1
+
+        ok, encoded = cv2.imencode(".jpg", image)
+        if not ok:
+            raise RuntimeError("could not encode simulated capture")
+        output.write(encoded.tobytes())
+
+    def close(self):
+        for port in list(self._recordings):
+            self.stop_recording(port)
+
+    def _replay(self, output, motionOutput, motion, frames, resolution, encoder, stop):
+        interval = 1.0 / self.framerate / self._speed
+        motionSize = motionvectors.frameSize(resolution)
+        motionFrames = max(len(motion) // motionSize, 1)
+        start = time.time()
+        position = 0
+        index = 0
+        frameNumber = 0
+        while not stop.is_set():
+            frameType, data = frames[index % len(frames)]
+            index += 1
+            timestamp = None
+            if frameType != protocol.FRAME_TYPE_SPS_HEADER:
+                frameNumber += 1
+                # wait until the frame would have been encoded
+                delay = start + frameNumber * interval - time.time()
+                if delay > 0 and stop.wait(delay):
+                    break
+                timestamp = int(frameNumber * 1000000.0 / self.framerate)
+
+            encoder.frame = SimulatedFrame(index, frameType, timestamp, True, position)
+            position += len(data)
+            output.write(data)
+
+            if motionOutput is not None and timestamp is not None:
+                offset = (frameNumber % motionFrames) * motionSize
+                motionOutput.write(motion[offset : offset + motionSize])
+
+
+class _SimulatedEncoder(object):
+    def __init__(self):
+        self.frame = None
@@ -0,0 +1,340 @@
+import asyncio
+import collections
+import logging
+import math
+import struct
+import time
+
+from babyphone import fanout, protocol, renditions
+
+log = logging.getLogger("babyphone")
+
+TS_PACKET_SIZE = 188
+PID_PAT = 0x0000
+PID_PMT = 0x1000
+PID_VIDEO = 0x0100
+STREAM_TYPE_H264 = 0x1B
+
+# 90kHz clock of the transport stream
+CLOCK = 90000
+# the decoder gets the frames this long before they're due
+PTS_OFFSET = CLOCK * 7 // 10
+
+# access unit delimiter, recommended in front of every frame
+_AUD = b"\x00\x00\x00\x01\x09\xf0"
+
+
+def _crc32Table():
+    table = []
+    for i in range(256):
+        crc = i << 24
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x04C11DB7) if crc & 0x80000000 else crc << 1
+        table.append(crc & 0xFFFFFFFF)
+    return table
+
+
+_CRC32_TABLE = _crc32Table()
+
+
+def crc32Mpeg(data):
+    crc = 0xFFFFFFFF
+    for byte in bytearray(data):
+        crc = ((crc << 8) & 0xFFFFFFFF) ^ _CRC32_TABLE[(crc >> 24) ^ byte]
+    return crc
+
+
+def _timestamp(marker, ts):
+    """33 bit PTS/DTS in the 5 byte PES format"""
+    ts &= 0x1FFFFFFFF
+    return struct.pack(
+        ">BHH",
+        (marker << 4) | ((ts >> 29) & 0x0E) | 1,
+        ((ts >> 14) & 0xFFFE) | 1,
+        ((ts << 1) & 0xFFFE) | 1,
+    )
+
+
+def _pcr(ts):
+    ts &= 0x1FFFFFFFF
+    return struct.pack(">IH", ts >> 1, ((ts & 1) << 15) | 0x7E00)
+
+
+class TsMuxer(object):
+    """Packs H.264 access units into an MPEG transport stream with one video
+    stream. Keeps the continuity counters, so segments muxed one after the
+    other form a continuous stream."""
+
+    def __init__(self):
+        self._counters = collections.defaultdict(int)
+
+    def tables(self):
+        """PAT and PMT, at the start of every segment"""
+        pat = struct.pack(">HBBBHH", 0x0001, 0xC1, 0, 0, 0x0001, 0xE000 | PID_PMT)
+        pmt = struct.pack(
+            ">HBBBHHBHH",
+            0x0001,
+            0xC1,
+            0,
+            0,
+            0xE000 | PID_VIDEO,
+            0xF000,
+            STREAM_TYPE_H264,
+            0xE000 | PID_VIDEO,
+            0xF000,
+        )
+        return self._section(PID_PAT, 0x00, pat) + self._section(PID_PMT, 0x02, pmt)
+
+    def _section(self, pid, tableId, body):
+        # section_syntax_indicator, reserved bits and the length incl. the crc
+        section = struct.pack(">BH", tableId, 0xB000 | (len(body) + 4)) + body
+        section += struct.pack(">I", crc32Mpeg(section))
+        # pointer field
+        payload = b"\x00" + section
+        header = self._header(pid, True, False)
+        stuffing = TS_PACKET_SIZE - len(header) - len(payload)
+        return header + payload + b"\xff" * stuffing
+
+    def _header(self, pid, start, adaptation):
+        counter = self._counters[pid]
+        self._counters[pid] = (counter + 1) & 0x0F
+        return struct.pack(
+            ">BHB",
+            0x47,
+            (0x4000 if start else 0) | pid,
+            (0x30 if adaptation else 0x10) | counter,
+        )
+
+    def videoFrame(self, data, pts, keyframe):
+        """One access unit as PES in TS packets. pts in 90kHz"""
+        pes = (
+            b"\x00\x00\x01\xe0\x00\x00\x80\x80\x05"
+            + _timestamp(0x2, pts + PTS_OFFSET)
+            + data
+        )
+        packets = []
+        pos = 0
+        first = True
+        while pos < len(pes):
+            # adaptation field after its length byte
+            adaptation = None
+            if first:
+                # the clock reference, and where players can start decoding
+                flags = 0x10 | (0x40 if keyframe else 0)
+                adaptation = struct.pack(">B", flags) + _pcr(pts)
+            room = TS_PACKET_SIZE - 4
+            if adaptation is not None:
+                room -= 1 + len(adaptation)
+
+            remaining = len(pes) - pos
+            if remaining < room:
+                # fill the last packet up with stuffing in the adaptation field
+                stuffing = room - remaining
+                if adaptation is None:
+                    stuffing -= 1
+                    adaptation = b"\x00" + b"\xff" * (stuffing - 1) if stuffing else b""
+                else:
+                    adaptation += b"\xff" * stuffing
+                room = remaining
+
+            header = self._header(PID_VIDEO, first, adaptation is not None)
+            if adaptation is not None:
+                header += struct.pack(">B", len(adaptation)) + adaptation
+            packets.append(header + pes[pos : pos + room])
+            pos += room
+            first = False
+        return b"".join(packets)
+
+
+Segment = collections.namedtuple(
+    "Segment", ["sequence", "duration", "data", "discontinuity"]
+)
+
+
+class HlsStream(object):
+    """Live HLS of one rendition as MPEG-TS segments, for standard players.
+
+    While players request the playlist, it subscribes to the video like a
+    connection does, so the rendition is recorded. Every segment starts with a
+    keyframe and is muxed once, players get the same bytes from memory. After
+    `idleTimeout` seconds without requests it unsubscribes again.
+
+    Video only, players don't support the A-law audio.
+    """
+
+    def __init__(
+        self,
+        babyphone,
+        rendition=renditions.DEFAULT,
+        targetDuration=2.0,
+        windowSize=5,
+        idleTimeout=30.0,
+    ):
+        self._bp = babyphone
+        self.targetDuration = targetDuration
+        self.windowSize = windowSize
+        self.idleTimeout = idleTimeout
+
+        # what the fanout needs from a subscriber
+        self.rendition = rendition
+        self.mediaMode = protocol.MODE_PACKET
+        self.streamRequested = False
+        self.audioRequested = False
+        self.videoPrimed = False
+
+        self._muxer = TsMuxer()
+        self._segments = collections.deque()
+        self._sequence = 0
+        self._discontinuitySequence = 0
+        self._discontinuity = False
+        self._playlist = None
+        self._newSegment = asyncio.Event()
+
+        # the segment being muxed, as list of chunks
+        self._current = None
+        self._startPts = None
+        self._lastPts = None
+        self._header = None
+
+        self._lastRequest = 0.0
+        self._watchdog = None
+
+    def subscribes(self, kind):
+        return kind == fanout.VIDEO and self.streamRequested
+
+    def enqueue(self, kind, packet, sps=False):
+        self._addFrame(packet)
+
+    @asyncio.coroutine
+    def playlist(self):
+        """The live playlist, None if no segment got ready in time"""
+        self._touch()
+        if not self._segments:
+            # the camera has to start and record a segment first
+            try:
+                yield from asyncio.wait_for(
+                    self._newSegment.wait(), self.targetDuration * 3 + 5
+                )
+            except asyncio.TimeoutError:
+                return None
+        return self._playlist
+
+    def segment(self, sequence):
+        """The bytes of the segment, None if it's not in the playlist (anymore)"""
+        self._touch()
+        for segment in self._segments:
+            if segment.sequence == sequence:
+                return segment.data
+        return None
+
+    def close(self):
+        if self._watchdog is not None:
+            self._watchdog.cancel()
+            self._watchdog = None
+
+    def _touch(self):
+        self._lastRequest = time.time()
+        if self.streamRequested:
+            return
+        log.info("HLS requested, subscribing to the %s video", self.rendition)
+        self.streamRequested = True
+        self._bp.addSubscriber(self)
+        self._watchdog = asyncio.ensure_future(self._watch())
+
+    @asyncio.coroutine
+    def _watch(self):
+        while time.time() - self._lastRequest < self.idleTimeout:
+            yield from asyncio.sleep(self._lastRequest + self.idleTimeout - time.time())
+        log.info("no HLS requests anymore, unsubscribing")
+        self._watchdog = None
+        self._bp.removeConnection(self)
+        self.streamRequested = False
+        self.videoPrimed = False
+        self._reset()
+
+    def _reset(self):
+        if self._segments:
+            self._discontinuity = True
+        self._segments.clear()
+        self._playlist = None
+        self._newSegment.clear()
+        self._current = None
+        self._startPts = None
+        self._lastPts = None
+        self._header = None
+
+    def _pts(self, packet):
+        if packet.pts is None:
+            if self._lastPts is None:
+                return 0
+            return self._lastPts + CLOCK // renditions.FRAMERATE
+        # micros to 90kHz
+        return packet.pts * 9 // 100
+
+    def _duration(self):
+        frames = (self._lastPts - self._startPts) / float(CLOCK)
+        # the last frame lasts until the next one
+        return frames + 1.0 / renditions.FRAMERATE
+
+    def _addFrame(self, packet):
+        if packet.isSps():
+            if self._current is not None and self._duration() >= self.targetDuration:
+                self._finishSegment()
+            # sent with the keyframe following it
+            self._header = packet.data
+            return
+
+        pts = self._pts(packet)
+        if self._current is not None and pts < self._lastPts:
+            # the encoder restarted, the timestamps start over
+            self._finishSegment()
+            self._discontinuity = True
+
+        if self._current is None:
+            if self._header is None:
+                # not decodable without the header
+                return
+            self._current = [self._muxer.tables()]
+            self._startPts = pts
+
+        data = packet.data
+        if self._header is not None:
+            data = self._header + data
+            self._header = None
+        keyframe = packet.frameType == protocol.FRAME_TYPE_KEY_FRAME
+        self._current.append(self._muxer.videoFrame(_AUD + data, pts, keyframe))
+        self._lastPts = pts
+
+    def _finishSegment(self):
+        self._segments.append(
+            Segment(
+                self._sequence,
+                self._duration(),
+                b"".join(self._current),
+                self._discontinuity,
+            )
+        )
+        self._sequence += 1
+        self._discontinuity = False
+        self._current = None
+        while len(self._segments) > self.windowSize:
+            if self._segments.popleft().discontinuity:
+                self._discontinuitySequence += 1
+        self._playlist = self._renderPlaylist()
+        self._newSegment.set()
+
+    def _renderPlaylist(self):
+        longest = max(segment.duration for segment in self._segments)
+        lines = [
+            "#EXTM3U",
+            "#EXT-X-VERSION:3",
+            "#EXT-X-TARGETDURATION:%d" % math.ceil(max(longest, self.targetDuration)),
+            "#EXT-X-MEDIA-SEQUENCE:%d" % self._segments[0].sequence,
+            "#EXT-X-DISCONTINUITY-SEQUENCE:%d" % self._discontinuitySequence,
+        ]
+        for segment in self._segments:
+            if segment.discontinuity:
+                lines.append("#EXT-X-DISCONTINUITY")
+            lines.append("#EXTINF:%.3f," % segment.duration)
+            lines.append("%d.ts" % segment.sequence)
+        return ("\n".join(lines) + "\n").encode("ascii")
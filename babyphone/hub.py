@@ -0,0 +1,443 @@
+import asyncio
+import functools
+import json
+import logging
+import time
+
+import websockets
+import websockets.exceptions
+
+from babyphone import discovery, fanout, protocol, renditions
+from babyphone.babyphone import Connection
+
+log = logging.getLogger("babyphone")
+
+# upstream messages the hub handles itself instead of passing them on
+_HUB_ACTIONS = ("heartbeat", "protocol", "rendition")
+
+
+class Node(object):
+    """A babyphone node as seen by the hub.
+
+    Keeps one upstream websocket connection to the node while local clients
+    are connected, and fans the node's media and messages out to them. The
+    upstream only streams video/audio while at least one local client wants
+    it, so the node serves the hub as its only consumer.
+
+    Duck-types the parts of the Babyphone a Connection uses, so local clients
+    are handled by the regular Connection.
+    """
+
+    def __init__(self, name, ip, port, linger=10.0, maxRetryDelay=30.0):
+        self.name = name
+        self.ip = ip
+        self.port = port
+        self.linger = linger
+        self.maxRetryDelay = maxRetryDelay
+        self.lastSeen = time.time()
+
+        self.conns = set()
+        self.fanout = fanout.Fanout(self.conns)
+        # the node chooses the rendition for the hub's upstream, all local
+        # clients get that one. It goes above the default only if all of them
+        # can decode that
+        self.rendition = renditions.DEFAULT
+
+        self._ws = None
+        self._upstream = None
+        self._closer = None
+        # what we asked the node for on the current upstream
+        self._streaming = False
+        self._audio = False
+        self._autoRendition = False
+        # the node's last configuration, for clients connecting later
+        self._configuration = None
+
+    @property
+    def url(self):
+        return "ws://%s:%d" % (self.ip, self.port)
+
+    def isConnected(self):
+        return self._ws is not None
+
+    def info(self):
+        return dict(
+            name=self.name,
+            ip=self.ip,
+            port=self.port,
+            connected=self.isConnected(),
+            clients=len(self.conns),
+        )
+
+    def addConnection(self, conn):
+        self.conns.add(conn)
+        if self._closer is not None:
+            self._closer.cancel()
+            self._closer = None
+        if self._configuration is not None:
+            conn.enqueue(fanout.CONTROL, json.dumps(self._configuration))
+        if self._upstream is None or self._upstream.done():
+            self._upstream = asyncio.ensure_future(self._run())
+        else:
+            asyncio.ensure_future(self.renditionUpdated())
+
+    def removeConnection(self, conn):
+        self.conns.discard(conn)
+        if conn.streamRequested or conn.audioRequested:
+            asyncio.ensure_future(self.streamStatusUpdated())
+        asyncio.ensure_future(self.renditionUpdated())
+        if not self.conns and self._closer is None:
+            self._closer = asyncio.ensure_future(self._closeLater())
+
+    def close(self):
+        for task in (self._closer, self._upstream):
+            if task is not None:
+                task.cancel()
+        self._closer = None
+        self._upstream = None
+
+    @asyncio.coroutine
+    def _closeLater(self):
+        # clients often reconnect right away, e.g. when the app resumes
+        yield from asyncio.sleep(self.linger)
+        self._closer = None
+        if not self.conns and self._upstream is not None:
+            log.info("no clients for %s anymore, closing the upstream", self.name)
+            self._upstream.cancel()
+            self._upstream = None
+
+    @asyncio.coroutine
+    def streamStatusUpdated(self):
+        """Asks the node for video and audio as long as a client wants them"""
+        if self._ws is None:
+            # asked for when the upstream connects
+            return
+        streaming = any(c.streamRequested for c in self.conns)
+        if streaming != self._streaming:
+            self._streaming = streaming
+            if not streaming:
+                self.fanout.resetVideo(self.rendition)
+            yield from self._send(
+                {"action": "_startstream" if streaming else "_stopstream"}
+            )
+        audio = any(c.audioRequested for c in self.conns)
+        if audio != self._audio:
+            self._audio = audio
+            yield from self._send({"action": "startaudio" if audio else "stopaudio"})
+
+    @asyncio.coroutine
+    def renditionUpdated(self):
+        """Lets the node adapt the upstream up to the highest rendition if all
+        clients can decode it, otherwise asks for the default one. A fresh
+        upstream adapts up to the default by itself"""
+        if self._ws is None:
+            return
+        auto = bool(self.conns) and all(c.acceptsAnyRendition() for c in self.conns)
+        if auto != self._autoRendition:
+            self._autoRendition = auto
+            yield from self._send(
+                {
+                    "action": "rendition",
+                    "rendition": renditions.AUTO if auto else renditions.DEFAULT,
+                }
+            )
+
+    @asyncio.coroutine
+    def updateConfig(self, cfg):
+        yield from self._send({"action": "configuration_update", "configuration": cfg})
+
+    @asyncio.coroutine
+    def broadcastConfig(self):
+        # the node broadcasts it, to all clients of the hub
+        yield from self._send({"action": "configuration_request"})
+
+    @asyncio.coroutine
+    def shutdown(self, conn):
+        log.info("Shutting down %s as requested by %s", self.name, str(conn))
+        yield from self._send({"action": "shutdown"})
+
+    @asyncio.coroutine
+    def restart(self, conn):
+        log.info("Restarting %s as requested by %s", self.name, str(conn))
+        yield from self._send({"action": "restart"})
+
+    def setLights(self, on):
+        asyncio.ensure_future(self._send({"action": "lightson" if on else "lightsoff"}))
+
+    @asyncio.coroutine
+    def _send(self, obj):
+        if self._ws is None:
+            return
+        try:
+            yield from self._ws.send(json.dumps(obj))
+        except websockets.exceptions.ConnectionClosed:
+            pass
+
+    @asyncio.coroutine
+    def _run(self):
+        delay = 1.0
+        while self.conns:
+            try:
+                ws = yield from websockets.connect(self.url, max_size=None)
+            except (OSError, asyncio.TimeoutError, websockets.exceptions.InvalidHandshake) as e:
+                log.info("could not connect to %s, retrying in %ds: %s", self.name, delay, e)
+                yield from asyncio.sleep(delay)
+                delay = min(delay * 2, self.maxRetryDelay)
+                continue
+
+            log.info("connected upstream to %s at %s", self.name, self.url)
+            delay = 1.0
+            self._ws = ws
+            try:
+                yield from self._send({"action": "protocol", "media": protocol.MODE_BINARY})
+                # the node adapts the rendition to the hub's connection
+                yield from self.renditionUpdated()
+                yield from self._send({"action": "configuration_request"})
+                yield from self.streamStatusUpdated()
+                while True:
+                    message = yield from ws.recv()
+                    self._received(message)
+            except websockets.exceptions.ConnectionClosed:
+                log.info("upstream to %s closed", self.name)
+            finally:
+                self._ws = None
+                self._streaming = False
+                self._audio = False
+                self._autoRendition = False
+                # the node starts over with a new header, in the default
+                # rendition
+                self.fanout.resetVideo(self.rendition)
+                self._renditionChanged(renditions.DEFAULT)
+                yield from ws.close()
+
+    def _received(self, message):
+        if isinstance(message, bytes):
+            header, payload = protocol.decodeBinary(message)
+            packet = protocol.MediaPacket(
+                header["stream"],
+                bytes(payload),
+                pts=header["pts"],
+                frameType=header["frameType"],
+                now=header["now"],
+            )
+            if packet.stream == protocol.STREAM_VIDEO:
+                self.fanout.publish(fanout.VIDEO, packet, self.rendition)
+            else:
+                self.fanout.publish(fanout.AUDIO, packet)
+            return
+
+        msg = json.loads(message)
+        action = msg.get("action")
+        if action == "rendition":
+            self._renditionChanged(msg.get("rendition", renditions.DEFAULT))
+        elif action not in _HUB_ACTIONS:
+            if action == "configuration":
+                self._configuration = msg
+            self.fanout.publish(fanout.CONTROL, msg)
+
+    def _renditionChanged(self, name):
+        if name == self.rendition:
+            return
+        log.info("%s switched the hub from %s to %s", self.name, self.rendition, name)
+        self.fanout.resetVideo(self.rendition)
+        self.rendition = name
+        for conn in self.conns:
+            asyncio.ensure_future(conn.setRendition(name))
+
+    def __str__(self):
+        return "Node %s (%s)" % (self.name, self.url)
+
+
+class HubConnection(Connection):
+    """A local client of one node, the rendition is the node's choice.
+
+    Clients that did not ask for auto or the highest rendition never get more
+    than the default one, they get no video while the node switches down.
+    """
+
+    def __init__(self, node, websocket):
+        Connection.__init__(self, node, websocket)
+        # what the client asked for, None if it did not negotiate
+        self.requestedRendition = None
+        self.rendition = self._allowedRendition(node.rendition)
+
+    def acceptsAnyRendition(self):
+        return self.requestedRendition in (renditions.AUTO, renditions.NAMES[-1])
+
+    def _allowedRendition(self, name):
+        if self.acceptsAnyRendition() or renditions.NAMES.index(
+            name
+        ) <= renditions.NAMES.index(renditions.DEFAULT):
+            return name
+        return renditions.DEFAULT
+
+    @asyncio.coroutine
+    def _adaptRendition(self):
+        # the node adapts the upstream, the local network is not the bottleneck
+        pass
+
+    @asyncio.coroutine
+    def setRendition(self, name):
+        yield from Connection.setRendition(
+            self, self._allowedRendition(self.bp.rendition)
+        )
+
+    @asyncio.coroutine
+    def handleMessage(self, message):
+        action = json.loads(message).get("action")
+        if action == "rendition":
+            self.requestedRendition = json.loads(message).get(
+                "rendition", renditions.AUTO
+            )
+        yield from Connection.handleMessage(self, message)
+        if action in ("startaudio", "stopaudio"):
+            yield from self.bp.streamStatusUpdated()
+        elif action == "rendition":
+            yield from self.bp.renditionUpdated()
+
+
+class HubDiscovery(discovery.DiscoveryServer):
+    """Finds the nodes by their advertisements and advertises the hub"""
+
+    def __init__(self, hub, port):
+        discovery.DiscoveryServer.__init__(self, port=port, hub=True)
+        self._hubInstance = hub
+
+    def datagram_received(self, data, addr):
+        try:
+            message = json.loads(data.decode("utf-8"))
+        except ValueError:
+            return
+        action = message.get("action")
+        if action == "discover":
+            self.advertise()
+        elif action == "advertise" and not message.get("hub"):
+            self._hubInstance.nodeAdvertised(
+                message.get("host") or message.get("ip", addr[0]),
+                message.get("ip", addr[0]),
+                message.get("port"),
+            )
+
+    def discover(self):
+        self._transport.sendto(
+            json.dumps(dict(action="discover")).encode("utf-8"),
+            ("<broadcast>", discovery.DISCOVERY_PORT),
+        )
+
+
+class Hub(object):
+    """Aggregates several babyphone nodes, e.g. one per room.
+
+    Discovers the nodes and connects to each of them once, no matter how many
+    clients are watching. Clients connect to the hub at /nodes/<name> and are
+    served like by the node itself, at / they get the list of nodes.
+    """
+
+    def __init__(
+        self, loop, port=8090, nodePort=8080, discoverInterval=30.0, nodeTimeout=120.0
+    ):
+        self._loop = loop
+        self.port = port
+        self.nodePort = nodePort
+        self.discoverInterval = discoverInterval
+        self.nodeTimeout = nodeTimeout
+
+        # name -> Node
+        self.nodes = {}
+        # websockets of the clients listening to the list of nodes
+        self._listeners = set()
+        self._discovery = None
+        self._discoverer = None
+
+    @asyncio.coroutine
+    def start(self):
+        _, self._discovery = yield from self._loop.create_datagram_endpoint(
+            functools.partial(HubDiscovery, self, self.port),
+            local_addr=("0.0.0.0", discovery.DISCOVERY_PORT),
+            allow_broadcast=True,
+            reuse_port=True,
+        )
+        self._discoverer = asyncio.ensure_future(self._discover())
+
+    def close(self):
+        if self._discoverer is not None:
+            self._discoverer.cancel()
+            self._discoverer = None
+        for node in self.nodes.values():
+            node.close()
+
+    @asyncio.coroutine
+    def _discover(self):
+        while True:
+            self._discovery.discover()
+            yield from asyncio.sleep(self.discoverInterval)
+            self._expire()
+
+    def _expire(self):
+        oldest = time.time() - self.nodeTimeout
+        for name, node in list(self.nodes.items()):
+            if node.lastSeen < oldest and not node.conns:
+                log.info("%s was not seen for a while, forgetting it", node)
+                node.close()
+                del self.nodes[name]
+                self._nodesChanged()
+
+    def nodeAdvertised(self, name, ip, port):
+        node = self.nodes.get(name)
+        if node is not None:
+            node.lastSeen = time.time()
+            if node.ip == ip:
+                return
+            log.info("%s moved to %s", node, ip)
+            node.ip = ip
+        else:
+            node = self.nodes[name] = Node(name, ip, port or self.nodePort)
+            log.info("discovered %s", node)
+        self._nodesChanged()
+
+    def _nodesChanged(self):
+        message = json.dumps(self._nodesMessage())
+        for websocket in list(self._listeners):
+            asyncio.ensure_future(self._sendQuietly(websocket, message))
+
+    def _nodesMessage(self):
+        return dict(
+            action="nodes",
+            nodes=[node.info() for _, node in sorted(self.nodes.items())],
+        )
+
+    @asyncio.coroutine
+    def _sendQuietly(self, websocket, message):
+        try:
+            yield from websocket.send(message)
+        except websockets.exceptions.ConnectionClosed:
+            self._listeners.discard(websocket)
+
+    @asyncio.coroutine
+    def connect(self, websocket, path):
+        parts = [part for part in path.split("/") if part]
+        if not parts:
+            yield from self._listNodes(websocket)
+            return
+
+        node = None
+        if len(parts) == 2 and parts[0] == "nodes":
+            node = self.nodes.get(parts[1])
+        if node is None:
+            log.info("client asked for unknown node %s", path)
+            yield from websocket.close(code=4404, reason="unknown node")
+            return
+
+        conn = HubConnection(node, websocket)
+        node.addConnection(conn)
+        yield from conn.run()
+
+    @asyncio.coroutine
+    def _listNodes(self, websocket):
+        self._listeners.add(websocket)
+        try:
+            yield from websocket.send(json.dumps(self._nodesMessage()))
+            # nothing to receive, just wait for the client to go away
+            yield from websocket.wait_closed()
+        finally:
+            self._listeners.discard(websocket)
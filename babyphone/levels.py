@@ -0,0 +1,71 @@
+import math
+
+import numpy as np
+
+DEFAULT_WINDOWS = (1, 10, 60)
+DEFAULT_QUANTILES = (0.5, 0.75, 0.95)
+
+
+class LevelEstimator(object):
+    """Quantiles of the volume level over sliding time windows.
+
+    The levels are kept in a ring buffer sized for the largest window, so memory
+    is constant. Quantiles are calculated with partial selection over the most
+    recent values of each window, interpolated like numpy.quantile.
+    """
+
+    def __init__(self, rate, windows=DEFAULT_WINDOWS, quantiles=DEFAULT_QUANTILES):
+        """rate is the number of values added per second"""
+        self._rate = float(rate)
+        self._windows = sorted(windows)
+        self._quantiles = quantiles
+        self._ring = np.zeros(int(math.ceil(self._windows[-1] * self._rate)))
+        self._pos = 0
+        self._count = 0
+
+    def add(self, value):
+        self._ring[self._pos] = value
+        self._pos = (self._pos + 1) % len(self._ring)
+        self._count = min(self._count + 1, len(self._ring))
+
+    def quantiles(self, window, quantiles=None):
+        if quantiles is None:
+            quantiles = self._quantiles
+        values = self._recent(int(math.ceil(window * self._rate)))
+        if not len(values):
+            return [0.0] * len(quantiles)
+
+        positions = [q * (len(values) - 1) for q in quantiles]
+        kth = sorted(
+            set([int(math.floor(p)) for p in positions] + [int(math.ceil(p)) for p in positions])
+        )
+        values = np.partition(values, kth)
+
+        result = []
+        for p in positions:
+            lower, upper = values[int(math.floor(p))], values[int(math.ceil(p))]
+            result.append(float(lower + (upper - lower) * (p - math.floor(p))))
+        return result
+
+    def level(self, window=1, quantile=0.75):
+        return self.quantiles(window, [quantile])[0]
+
+    def report(self):
+        """All windows and quantiles, e.g. {"10s": {"p75": 0.1, ...}, ...}"""
+        return dict(
+            (
+                "%ds" % window,
+                dict(
+                    ("p%d" % round(q * 100), value)
+                    for q, value in zip(self._quantiles, self.quantiles(window))
+                ),
+            )
+            for window in self._windows
+        )
+
+    def _recent(self, n):
+        n = min(n, self._count)
+        start = self._pos - n
+        if start >= 0:
+            return self._ring[start : self._pos]
+        return np.concatenate((self._ring[start:], self._ring[: self._pos]))
@@ -0,0 +1,197 @@
+import asyncio
+import collections
+import contextlib
+import logging
+import sys
+import threading
+import time
+import traceback
+import weakref
+
+from babyphone import metrics
+
+log = logging.getLogger("babyphone")
+
+# task -> what it's doing, see label()
+_labels = weakref.WeakKeyDictionary()
+
+STALLS = metrics.REGISTRY.register(
+    metrics.Counter(
+        "babyphone_loop_stalls_total",
+        "Times the event loop was blocked longer than the watchdog threshold",
+    )
+)
+
+
+@contextlib.contextmanager
+def label(description):
+    """Names what the current task is doing (e.g. the websocket action or the
+    http route), for the reports of the LoopWatchdog"""
+    try:
+        task = asyncio.current_task()
+    except RuntimeError:
+        task = None
+    if task is None:
+        yield
+        return
+    previous = _labels.get(task)
+    _labels[task] = description
+    try:
+        yield
+    finally:
+        if previous is None:
+            _labels.pop(task, None)
+        else:
+            _labels[task] = previous
+
+
+class LoopLagProbe(object):
+    """Measures how late the event loop runs callbacks.
+
+    Sleeps for a short interval over and over and records how much later than
+    scheduled it woke up. Anything blocking the loop shows up as lag.
+    """
+
+    def __init__(self, interval=0.01):
+        self._interval = interval
+        self._lags = []
+        self._task = None
+        self._expected = None
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        """Stops the probe and returns the lag statistics in milliseconds"""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._expected is not None:
+            # the loop might have been blocked while our last sleep was due
+            lag = asyncio.get_event_loop().time() - self._expected
+            if lag > 0:
+                self._lags.append(lag)
+            self._expected = None
+        return self.stats()
+
+    def stats(self):
+        if not self._lags:
+            return dict(samples=0, mean_ms=0.0, max_ms=0.0)
+        return dict(
+            samples=len(self._lags),
+            mean_ms=sum(self._lags) * 1000.0 / len(self._lags),
+            max_ms=max(self._lags) * 1000.0,
+        )
+
+    @asyncio.coroutine
+    def _run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            self._expected = loop.time() + self._interval
+            yield from asyncio.sleep(self._interval)
+            self._lags.append(max(0.0, loop.time() - self._expected))
+
+
+class LoopWatchdog(object):
+    """Watches the event loop for stalls and reports what blocked it.
+
+    A task on the loop beats every `interval` seconds and records the loop lag.
+    A thread checks the beats; when a beat is overdue, it takes the stack of the
+    loop's thread, i.e. of the code blocking it, and the label of the running
+    task (see label()). When the loop runs again after a lag of more than
+    `threshold` seconds, the stall is logged and kept with the last
+    `maxReports` ones.
+    """
+
+    def __init__(self, loop, threshold=0.2, interval=0.1, maxReports=20):
+        self._loop = loop
+        self.threshold = threshold
+        self.interval = interval
+        self.reports = collections.deque(maxlen=maxReports)
+        self.stalls = 0
+
+        self._beat = time.monotonic()
+        # the stall the thread captured, finished by the loop
+        self._pending = None
+        self._loopThread = None
+        self._task = None
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def start(self):
+        self._loopThread = threading.get_ident()
+        self._beat = time.monotonic()
+        self._task = asyncio.ensure_future(self._heartbeat())
+        self._stopped.clear()
+        self._thread = threading.Thread(
+            target=self._watch, name="loop-watchdog", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def stats(self):
+        return dict(
+            threshold_ms=self.threshold * 1000.0,
+            stalls=self.stalls,
+            reports=list(self.reports),
+        )
+
+    @asyncio.coroutine
+    def _heartbeat(self):
+        while True:
+            expected = self._loop.time() + self.interval
+            yield from asyncio.sleep(self.interval)
+            lag = max(self._loop.time() - expected, 0.0)
+            self._beat = time.monotonic()
+            metrics.LOOP_LAG.observe(lag)
+            if lag >= self.threshold:
+                self._stalled(lag)
+            else:
+                # captured just when the loop got going again
+                self._pending = None
+
+    def _stalled(self, lag):
+        report, self._pending = self._pending, None
+        if report is None:
+            # over before the thread looked
+            report = dict(time=time.time() - lag, context=None, task=None, stack=None)
+        report["lag_ms"] = round(lag * 1000.0, 1)
+        self.stalls += 1
+        STALLS.inc()
+        self.reports.append(report)
+        log.warning(
+            "event loop blocked for %.0fms by %s (%s)%s",
+            lag * 1000.0,
+            report["context"] or "a callback",
+            report["task"] or "no task",
+            "\n" + "".join(report["stack"]) if report["stack"] else "",
+        )
+
+    def _watch(self):
+        while not self._stopped.wait(self.threshold / 4):
+            if self._pending is not None:
+                continue
+            blocked = time.monotonic() - self._beat - self.interval
+            # early, so short stalls are caught while they last. Dropped by
+            # the loop if the lag stays below the threshold
+            if blocked >= self.threshold / 2:
+                self._pending = self._capture()
+
+    def _capture(self):
+        frame = sys._current_frames().get(self._loopThread)
+        task = None
+        try:
+            task = asyncio.current_task(self._loop)
+        except RuntimeError:
+            pass
+        return dict(
+            time=time.time(),
+            context=_labels.get(task) if task is not None else None,
+            task=repr(task.get_coro()) if task is not None else None,
+            stack=traceback.format_stack(frame) if frame is not None else None,
+        )
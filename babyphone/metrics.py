@@ -0,0 +1,330 @@
+import bisect
+import os
+import threading
+import time
+
+# seconds, for durations from a fraction of a millisecond to seconds
+DEFAULT_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+)
+
+
+def _formatLabels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{%s}" % ",".join(
+        '%s="%s"'
+        % (
+            name,
+            str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"),
+        )
+        for name, value in pairs
+    )
+
+
+def _formatValue(value):
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return "%d" % value
+    return repr(float(value))
+
+
+class _Metric(object):
+    type = None
+
+    def __init__(self, name, help, labelNames=()):
+        self.name = name
+        self.help = help
+        self.labelNames = tuple(labelNames)
+        # label values -> child
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelNames):
+                raise ValueError(
+                    "%s expects the labels %s" % (self.name, ", ".join(self.labelNames))
+                )
+            with self._lock:
+                child = self._children.setdefault(values, self._newChild())
+        return child
+
+    def _newChild(self):
+        raise NotImplementedError()
+
+    def render(self):
+        lines = [
+            "# HELP %s %s" % (self.name, self.help),
+            "# TYPE %s %s" % (self.name, self.type),
+        ]
+        for values, child in sorted(self._children.items()):
+            lines.extend(self._renderChild(values, child))
+        return lines
+
+    def _renderChild(self, values, child):
+        return [
+            "%s%s %s"
+            % (self.name, _formatLabels(self.labelNames, values), _formatValue(child.value))
+        ]
+
+
+class _Value(object):
+    def __init__(self):
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        # called from the camera and audio threads as well
+        with self._lock:
+            self.value += amount
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def _newChild(self):
+        return _Value()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+
+class CallbackGauge(_Metric):
+    """A gauge whose values are read when rendering. func returns a dict of
+    label values (tuples) to values"""
+
+    type = "gauge"
+
+    def __init__(self, name, help, labelNames, func):
+        _Metric.__init__(self, name, help, labelNames)
+        self.func = func
+
+    def render(self):
+        lines = [
+            "# HELP %s %s" % (self.name, self.help),
+            "# TYPE %s %s" % (self.name, self.type),
+        ]
+        for values, value in sorted(self.func().items()):
+            lines.append(
+                "%s%s %s"
+                % (self.name, _formatLabels(self.labelNames, values), _formatValue(value))
+            )
+        return lines
+
+
+class CallbackCounter(CallbackGauge):
+    """A counter whose values are read when rendering, for totals kept
+    elsewhere. func returns a dict of label values (tuples) to values"""
+
+    type = "counter"
+
+
+class _HistogramValue(object):
+    def __init__(self, buckets):
+        self._buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self._buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def time(self):
+        return _Timer(self)
+
+
+class _Timer(object):
+    def __init__(self, histogram):
+        self._histogram = histogram
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self._histogram.observe(time.perf_counter() - self._start)
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, labelNames=(), buckets=DEFAULT_BUCKETS):
+        _Metric.__init__(self, name, help, labelNames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _newChild(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def time(self):
+        return self.labels().time()
+
+    def _renderChild(self, values, child):
+        with child._lock:
+            counts = list(child.counts)
+            total = child.sum
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            lines.append(
+                "%s_bucket%s %d"
+                % (
+                    self.name,
+                    _formatLabels(self.labelNames, values, ("le", _formatValue(bound))),
+                    cumulative,
+                )
+            )
+        labels = _formatLabels(self.labelNames, values)
+        lines.append("%s_sum%s %s" % (self.name, labels, repr(total)))
+        lines.append("%s_count%s %d" % (self.name, labels, cumulative))
+        return lines
+
+
+class Registry(object):
+    """The metrics, rendered in the Prometheus text format"""
+
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        """Adds the metric, replacing one with the same name"""
+        self._metrics[metric.name] = metric
+        return metric
+
+    def render(self):
+        lines = []
+        for _, metric in sorted(self._metrics.items()):
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+VIDEO_FRAMES = REGISTRY.register(
+    Counter(
+        "babyphone_video_frames_encoded_total",
+        "Video frames delivered by the encoder",
+        ["rendition"],
+    )
+)
+VIDEO_BYTES = REGISTRY.register(
+    Counter(
+        "babyphone_video_bytes_encoded_total",
+        "Bytes of encoded video",
+        ["rendition"],
+    )
+)
+MESSAGES_ENQUEUED = REGISTRY.register(
+    Counter(
+        "babyphone_messages_enqueued_total",
+        "Messages queued for sending to the clients",
+        ["kind"],
+    )
+)
+MESSAGES_SENT = REGISTRY.register(
+    Counter(
+        "babyphone_messages_sent_total",
+        "Messages sent to the clients",
+        ["kind"],
+    )
+)
+MESSAGES_DROPPED = REGISTRY.register(
+    Counter(
+        "babyphone_messages_dropped_total",
+        "Messages dropped because a client could not keep up",
+        ["kind"],
+    )
+)
+AUDIO_PACKETS = REGISTRY.register(
+    Counter(
+        "babyphone_audio_packets_total",
+        "Audio packets captured and sent, fewer are sent while the noise gate is closed",
+        ["stage"],
+    )
+)
+AUDIO_PERIOD = REGISTRY.register(
+    Histogram(
+        "babyphone_audio_period_seconds",
+        "Time to process one captured audio period",
+    )
+)
+MOTION_ANALYSIS = REGISTRY.register(
+    Histogram(
+        "babyphone_motion_analysis_seconds",
+        "Duration of the motion detection's analyses, incl. waiting for the executor",
+        ["analysis"],
+    )
+)
+SNAPSHOT_ENCODE = REGISTRY.register(
+    Histogram(
+        "babyphone_snapshot_encode_seconds",
+        "Time to encode a snapshot",
+        ["format"],
+    )
+)
+LOOP_LAG = REGISTRY.register(
+    Histogram(
+        "babyphone_loop_lag_seconds",
+        "How much later than scheduled the event loop ran the watchdog's heartbeat",
+        buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0),
+    )
+)
+
+
+def _processCpu():
+    times = os.times()
+    return {(): times.user + times.system}
+
+
+def _processMemory():
+    try:
+        import psutil
+    except ImportError:
+        return {}
+    return {
+        ("resident_bytes",): psutil.Process().memory_info().rss,
+        ("system_available_bytes",): psutil.virtual_memory().available,
+    }
+
+
+REGISTRY.register(
+    CallbackCounter(
+        "babyphone_process_cpu_seconds_total",
+        "CPU time of the process, user and system",
+        [],
+        _processCpu,
+    )
+)
+REGISTRY.register(
+    CallbackGauge(
+        "babyphone_process",
+        "Memory of the process and the system. Requires psutil",
+        ["stat"],
+        _processMemory,
+    )
+)
+
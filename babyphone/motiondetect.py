@@ -1,35 +1,86 @@
 import base64
-import io
 import logging
-import math
 import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
 
 import asyncio
 import cv2
 import numpy as np
-import picamera
-from skimage.measure import compare_ssim
+
+from babyphone import (
+    camera,
+    metrics,
+    motionengine,
+    motionschedule,
+    motionvectors,
+    timeseries,
+)
+
+
+class AnalysisBusyException(Exception):
+    pass
+
+
+def _timedCall(func, *args):
+    """Calls func and returns the cpu time it took and its result. Runs in the
+    analysis executor"""
+    start = time.process_time()
+    result = func(*args)
+    return time.process_time() - start, result
+
+
+def decodePicture(data):
+    """Decodes a jpeg to a grayscale image. Runs in the analysis executor"""
+    image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), 1)
+    return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
 
 
 class MotionDetect(object):
-    def __init__(self, babyphone):
-        self._takingPicture = False
+    def __init__(
+        self,
+        babyphone,
+        useProcesses=True,
+        maxPendingAnalyses=4,
+        metric=motionengine.METRIC_SSIM,
+        pyramidLevels=2,
+        roi=None,
+    ):
         self._runner = None
         self._bp = babyphone
         self.log = logging.getLogger("babyphone")
 
-        # poll every 500ms
-        self._pollInterval = 0.5
+        self.scheduler = motionschedule.MotionScheduler()
 
         self.lastPicture = None
         self.lastPictureTimestamp = 0
         self._moved = False
 
-        self._counter = 0
         self._maxVals = 20
-        self._movementValues = []
-
+        self._pictureStats = motionengine.RunningStats(self._maxVals)
+
+        # pictures are compared downscaled, in the region of interest only
+        # (list of relative (x, y, width, height), e.g. the crib)
+        self._metric = metric
+        self._pyramidLevels = pyramidLevels
+        self.roi = roi
+        # downscaled version of the last picture of the motion detection
+        self._previousSmall = None
+
+        # motion scores from the encoder's motion vectors while streaming,
+        # they're not comparable with the picture based values.
+        self._vectorStats = motionengine.RunningStats(self._maxVals)
+        self._loop = asyncio.get_event_loop()
+
+        # decoding and comparing pictures is done off the event loop. With
+        # processes we don't compete for the GIL with the loop.
+        self._useProcesses = useProcesses
+        self._analysisExecutor = None
+        self._pendingAnalyses = 0
+        self._maxPendingAnalyses = maxPendingAnalyses
+        self.lastAnalysisStats = None
+        # cpu time of the analyses since the last reset, for the scheduler
+        self.analysisCpu = 0.0
 
     def start(self):
         self._runner = asyncio.ensure_future(self._run())
@@ -44,43 +95,89 @@ class MotionDetect(object):
     def isRunning(self):
         return self._runner is not None
 
-    @asyncio.coroutine
-    def _takePicture(self, nightMode, highRes=False):
+    def close(self):
+        self.stop()
+        if self._analysisExecutor is not None:
+            self._analysisExecutor.shutdown(wait=False)
+            self._analysisExecutor = None
 
-        oldRes = self._bp.cam.resolution
+    @asyncio.coroutine
+    def _analyse(self, func, *args):
+        """Runs func in the analysis executor. The loop lag is measured by the
+        watchdog (see looplag.LoopWatchdog)"""
+        if self._pendingAnalyses >= self._maxPendingAnalyses:
+            raise AnalysisBusyException(
+                "%d analyses pending, skipping %s"
+                % (self._pendingAnalyses, func.__name__)
+            )
+
+        if self._analysisExecutor is None:
+            if self._useProcesses:
+                self._analysisExecutor = ProcessPoolExecutor(max_workers=1)
+            else:
+                self._analysisExecutor = ThreadPoolExecutor(max_workers=1)
+
+        self._pendingAnalyses += 1
+        start = time.time()
+        cpu = 0.0
         try:
-            stream = io.BytesIO()
-
-            self._takingPicture = True
-            if nightMode:
-                self._bp.setLights(True)
-                yield from asyncio.sleep(0.2)
+            cpu, result = yield from asyncio.get_event_loop().run_in_executor(
+                self._analysisExecutor, _timedCall, func, *args
+            )
+            self.analysisCpu += cpu
+            return result
+        finally:
+            self._pendingAnalyses -= 1
+            duration = time.time() - start
+            metrics.MOTION_ANALYSIS.labels(func.__name__).observe(duration)
+            self.lastAnalysisStats = dict(
+                analysis=func.__name__,
+                duration_ms=duration * 1000.0,
+                cpu_ms=cpu * 1000.0,
+            )
+            self.log.debug(
+                "%s took %.1fms, %.1fms cpu",
+                func.__name__,
+                duration * 1000.0,
+                cpu * 1000.0,
+            )
 
-            # let the camera adjust to the new light settings
-            if highRes:
-                self._bp.cam.resolution=(800, 600)
-            self._bp.cam.capture(stream, format="jpeg")
+    @asyncio.coroutine
+    def _takePicture(self, nightMode, highRes=False, priority=camera.PRIORITY_MOTION):
+        data = yield from self._bp.camera.capture(priority, highRes, nightMode)
+        image = yield from self._analyse(decodePicture, data)
 
-            # Construct a numpy array from the stream
-            data = np.fromstring(stream.getvalue(), dtype=np.uint8)
-            # "Decode" the image from the array, preserving color
-            image = cv2.cvtColor(cv2.imdecode(data, 1), cv2.COLOR_BGR2GRAY)
+        self.log.info("Took picture")
+        return image
 
-            self.log.info("Took picture")
-            return image
-        finally:
-            self._takingPicture = False
-            self._bp.cam.resolution = oldRes
+    def motionVectorOutput(self, resolution):
+        """Output for the motion vectors of a recording on the camera"""
+        return motionvectors.MotionVectorAnalyzer(resolution, self._onVectorScore)
 
-            if nightMode:
-                self._bp.setLights(False)
+    def _onVectorScore(self, score):
+        # called from the camera thread
+        self._loop.call_soon_threadsafe(self._vectorMovement, score)
 
+    def _vectorMovement(self, score):
+        if not self.isRunning():
+            return
 
+        moved = self._evaluateMovement(score, self._vectorStats)
+        self._bp.activity.motion(score, moved, self._vectorStats, "vectors")
+        asyncio.ensure_future(self._broadcastMovement(score, moved, "vectors"))
 
     @asyncio.coroutine
-    def _calcMovement(self, img1, img2):
-        s = 1.0 - compare_ssim(img1, img2)
-        return s
+    def _calcMovement(self, picture):
+        """Compares the picture with the previous one, None if there is none"""
+        self._previousSmall, movement = yield from self._analyse(
+            motionengine.analyse,
+            self._previousSmall,
+            picture,
+            self._metric,
+            self._pyramidLevels,
+            self.roi,
+        )
+        return movement
 
     @asyncio.coroutine
     def _run(self):
@@ -88,32 +185,39 @@ class MotionDetect(object):
         self.log.info("Starting motion detection")
 
         while True:
-            self._counter += 1
-            yield from asyncio.sleep(self._pollInterval)
+            self.scheduler.night = self._bp.nightMode
+            yield from self.scheduler.waitForNextCapture()
 
-            if self.lastPictureTimestamp is not None and time.time() < self.lastPictureTimestamp+self._nextPictureDelay():
-                continue
-
-            if self._bp.isAnyoneStreaming():
-                self.log.info(
-                    "at least one connection is streaming, camera is busy, cannot do motion detection"
-                )
+            if self._bp.hasMotionVectors():
+                self.log.info("the camera is streaming, using the motion vectors")
+                self.scheduler.captured()
                 continue
 
             try:
-                oldPicture, newPicture = yield from self.updatePicture()
+                # only what the analysis costs, not waiting for the camera or
+                # the lights
+                self.analysisCpu = 0.0
+                priority = (
+                    camera.PRIORITY_ACTIVITY
+                    if self.scheduler.requested
+                    else camera.PRIORITY_MOTION
+                )
+                oldPicture, newPicture = yield from self.updatePicture(priority=priority)
                 if newPicture is not None:
                     yield from self._detectMovement(oldPicture, newPicture)
+                self.scheduler.captured(self.analysisCpu)
 
             except asyncio.CancelledError:
                 self.log.info("Stopping motion detection as the task was cancelled")
                 return
             except Exception as e:
                 self.log.info("Error taking picture: %s", e)
+                # don't retry right away
+                self.scheduler.captured()
 
     @asyncio.coroutine
-    def updatePicture(self, highRes=False):
-        picture = yield from self._takePicture(self._bp.nightMode, highRes)
+    def updatePicture(self, highRes=False, priority=camera.PRIORITY_MOTION):
+        picture = yield from self._takePicture(self._bp.nightMode, highRes, priority)
 
         # taking picture failed for some reason
         if picture is None:
@@ -138,47 +242,39 @@ class MotionDetect(object):
 
         return oldPicture, self.lastPicture
 
-    def _nextPictureDelay(self):
-        if self._moved:
-            return 4
-        else:
-            return 20
-
     @asyncio.coroutine
     def _detectMovement(self, oldPicture, newPicture):
-        movement = yield from self._calcMovement(self.lastPicture, newPicture)
+        movement = yield from self._calcMovement(newPicture)
+        if movement is None:
+            return False
 
-        if len(self._movementValues) < self._maxVals:
-            self._movementValues.append(movement)
-        else:
-            self._movementValues[self._counter % self._maxVals] = movement
+        moved = self._evaluateMovement(movement, self._pictureStats)
+        self._bp.activity.motion(movement, moved, self._pictureStats, "picture")
+        yield from self._broadcastMovement(movement, moved, "picture")
 
-        avg = sum(self._movementValues) / float(len(self._movementValues))
-        stddev = math.sqrt(
-            sum(map(lambda x: pow(abs(x - avg), 2), self._movementValues))
-            / float(len(self._movementValues))
-        )
+        return moved
 
-        moved = False
-        if abs(movement - avg) > 2 * stddev:
-            self._moved = True
-        else:
-            self._moved = False
+    def _evaluateMovement(self, movement, stats):
+        stats.add(movement)
+        self.scheduler.reportMotion(movement, stats)
+        self._moved = stats.isOutlier(movement, 2.0)
+        return self._moved
 
+    @asyncio.coroutine
+    def _broadcastMovement(self, movement, moved, source):
+        self._bp.history.add(timeseries.SERIES_MOVEMENT, movement)
         yield from self._bp.broadcast(
             {
                 "action": "movement",
                 "movement": dict(
                     value=movement,
                     moved=moved,
-                    interval_millis=self._nextPictureDelay()*1000,
+                    interval_millis=int(self.scheduler.nextInterval() * 1000),
+                    source=source,
                 ),
             }
         )
 
-        return moved
-
-
     def _imageBrightness(self, img):
         hist = cv2.calcHist([img], [0], None, [10], [0, 256])
 
@@ -191,6 +287,3 @@ class MotionDetect(object):
             return 1
 
         return 0
-
-    def isTakingPicture(self):
-        return self._takingPicture
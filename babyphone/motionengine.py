@@ -0,0 +1,159 @@
+import math
+
+import cv2
+import numpy as np
+from skimage.measure import compare_ssim
+
+# mean absolute difference of the pixels
+METRIC_DIFF = "diff"
+# fraction of blocks whose mean absolute difference exceeds a threshold,
+# compensating global brightness changes
+METRIC_SAD = "sad"
+# structural dissimilarity of the region of interest
+METRIC_SSIM = "ssim"
+METRICS = (METRIC_DIFF, METRIC_SAD, METRIC_SSIM)
+
+
+def downscale(image, levels):
+    """Goes down the gaussian pyramid, halving the size per level"""
+    for _ in range(levels):
+        image = cv2.pyrDown(image)
+    return image
+
+
+def roiMask(shape, roi):
+    """Boolean mask of an image for a list of (x, y, width, height) rectangles.
+
+    The rectangles are relative to the image size (0.0 - 1.0), so the same
+    region works for all resolutions. None means the whole image.
+    """
+    if not roi:
+        return None
+    height, width = shape[:2]
+    mask = np.zeros((height, width), dtype=bool)
+    for x, y, w, h in roi:
+        mask[
+            int(y * height) : int(math.ceil((y + h) * height)),
+            int(x * width) : int(math.ceil((x + w) * width)),
+        ] = True
+    return mask
+
+
+def frameDifference(old, new, mask=None):
+    diff = cv2.absdiff(old, new)
+    if mask is not None:
+        diff = diff[mask]
+    return float(np.mean(diff)) / 255.0 if diff.size else 0.0
+
+
+def blockSad(old, new, mask=None, blockSize=8, threshold=12):
+    diff = new.astype(np.float32) - old.astype(np.float32)
+    # the camera adjusting exposure or flickering light changes all pixels alike
+    diff = np.abs(diff - np.median(diff if mask is None else diff[mask]))
+    if mask is not None:
+        diff[~mask] = 0
+    rows, cols = diff.shape[0] // blockSize, diff.shape[1] // blockSize
+    if not rows or not cols:
+        return 0.0
+    blocks = diff[: rows * blockSize, : cols * blockSize].reshape(
+        rows, blockSize, cols, blockSize
+    )
+    means = blocks.mean(axis=(1, 3))
+    if mask is not None:
+        weights = (
+            mask[: rows * blockSize, : cols * blockSize]
+            .reshape(rows, blockSize, cols, blockSize)
+            .mean(axis=(1, 3))
+        )
+        considered = weights > 0
+        if not np.any(considered):
+            return 0.0
+        # mean over the masked pixels of the block only
+        means = means[considered] / weights[considered]
+    return float(np.count_nonzero(means > threshold)) / means.size
+
+
+def ssimDissimilarity(old, new, mask=None):
+    if mask is not None:
+        ys, xs = np.nonzero(mask)
+        if not len(ys):
+            return 0.0
+        old = old[ys.min() : ys.max() + 1, xs.min() : xs.max() + 1]
+        new = new[ys.min() : ys.max() + 1, xs.min() : xs.max() + 1]
+    # compare_ssim needs at least a 7x7 window
+    if min(old.shape) < 7:
+        return frameDifference(old, new)
+    return 1.0 - compare_ssim(old, new)
+
+
+_METRIC_FUNCTIONS = {
+    METRIC_DIFF: frameDifference,
+    METRIC_SAD: blockSad,
+    METRIC_SSIM: ssimDissimilarity,
+}
+
+
+def analyse(previous, picture, metric=METRIC_SAD, levels=2, roi=None):
+    """Scores the movement between the previous, already downscaled picture and a
+    new full size picture.
+
+    Returns the downscaled new picture, to be passed as previous next time, and
+    the score, which is None if there's no previous picture to compare with.
+    Runs in the analysis executor.
+    """
+    small = downscale(picture, levels)
+    if previous is None or previous.shape != small.shape:
+        return small, None
+    return small, _METRIC_FUNCTIONS[metric](previous, small, roiMask(small.shape, roi))
+
+
+class RunningStats(object):
+    """Mean and standard deviation over the last `window` values.
+
+    Uses Welford's algorithm with removal of the value dropping out of the
+    window, so every update is O(1).
+    """
+
+    def __init__(self, window=20):
+        self._values = [0.0] * window
+        self._pos = 0
+        self.count = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+
+    def add(self, value):
+        if self.count == len(self._values):
+            self._remove(self._values[self._pos])
+        self._values[self._pos] = value
+        self._pos = (self._pos + 1) % len(self._values)
+
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (value - self.mean)
+
+    def stddev(self):
+        if self.count == 0:
+            return 0.0
+        # clamp rounding errors
+        return math.sqrt(max(self._m2, 0.0) / self.count)
+
+    def deviation(self, value):
+        """Distance of value from the mean in standard deviations, negative
+        below the mean"""
+        stddev = self.stddev()
+        if stddev <= 0:
+            return 0.0
+        return (value - self.mean) / stddev
+
+    def isOutlier(self, value, factor=2.0):
+        return abs(value - self.mean) > factor * self.stddev()
+
+    def _remove(self, value):
+        if self.count == 1:
+            self.count, self.mean, self._m2 = 0, 0.0, 0.0
+            return
+        delta = value - self.mean
+        self.mean = (self.mean * self.count - value) / (self.count - 1)
+        self._m2 -= delta * (value - self.mean)
+        self.count -= 1
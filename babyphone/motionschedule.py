@@ -0,0 +1,116 @@
+import asyncio
+import time
+
+
+class MotionScheduler(object):
+    """Decides when the motion detection takes the next picture.
+
+    The interval shrinks with activity, which is raised by unusual motion scores
+    and loud audio and decays with a half life, so the detection reacts quickly
+    when something happens and calms down afterwards. While clients are connected
+    the interval is capped lower. A cpu budget (fraction of one core, lower at
+    night) bounds the interval from below, based on the cpu time the analyses of
+    the last captures took, but never above the maximum interval.
+
+    waitForNextCapture() sleeps until the capture is due and is woken up early if
+    new input makes it due sooner. requestCapture() makes the next capture due
+    immediately, until the capture is taken by the motion detection.
+    """
+
+    def __init__(
+        self,
+        minInterval=2.0,
+        maxInterval=60.0,
+        connectedMaxInterval=20.0,
+        halfLife=60.0,
+        cpuBudget=0.05,
+        nightCpuBudget=0.02,
+    ):
+        self.minInterval = minInterval
+        self.maxInterval = maxInterval
+        self.connectedMaxInterval = connectedMaxInterval
+        self.halfLife = halfLife
+        self.cpuBudget = cpuBudget
+        self.nightCpuBudget = nightCpuBudget
+
+        self.night = False
+        self._clientsConnected = False
+        self._activity = 0.0
+        self._activityTime = time.time()
+        # exponential moving average of the cost of a capture in seconds
+        self._cost = 0.0
+        self._lastCapture = 0.0
+        self._requested = False
+        self._wakeup = asyncio.Event()
+
+    def activity(self):
+        """Current activity between 0 (nothing happening) and 1"""
+        age = time.time() - self._activityTime
+        return self._activity * 0.5 ** (age / self.halfLife)
+
+    def reportActivity(self, activity):
+        activity = min(max(activity, 0.0), 1.0)
+        if activity > self.activity():
+            self._activity = activity
+            self._activityTime = time.time()
+            self._wakeup.set()
+
+    def reportMotion(self, score, stats):
+        """Raises the activity by how much the score exceeds the usual ones
+        (2 sigma => 1.0). Scores below the usual don't count"""
+        self.reportActivity(stats.deviation(score) / 2.0)
+
+    def reportAudioLevel(self, level, baseline):
+        """Raises the activity if the level exceeds the usual noise level"""
+        if baseline > 0:
+            self.reportActivity((level / baseline - 1.0) / 3.0)
+
+    def setClientsConnected(self, connected):
+        if connected != self._clientsConnected:
+            self._clientsConnected = connected
+            self._wakeup.set()
+
+    def requestCapture(self):
+        self._requested = True
+        self._wakeup.set()
+
+    @property
+    def requested(self):
+        """Whether the next capture was requested, rather than scheduled"""
+        return self._requested
+
+    def captured(self, cost=None):
+        """cost is the cpu time of the capture's analysis in seconds"""
+        self._lastCapture = time.time()
+        self._requested = False
+        if cost is not None:
+            self._cost = cost if not self._cost else 0.8 * self._cost + 0.2 * cost
+
+    def nextInterval(self):
+        maxInterval = self.maxInterval
+        if self._clientsConnected:
+            maxInterval = min(maxInterval, self.connectedMaxInterval)
+
+        interval = maxInterval - (maxInterval - self.minInterval) * self.activity()
+
+        budget = self.nightCpuBudget if self.night else self.cpuBudget
+        if budget > 0:
+            interval = max(interval, min(self._cost / budget, maxInterval))
+        return interval
+
+    def nextCapture(self):
+        if self._requested:
+            return time.time()
+        return self._lastCapture + self.nextInterval()
+
+    @asyncio.coroutine
+    def waitForNextCapture(self):
+        while True:
+            timeout = self.nextCapture() - time.time()
+            if timeout <= 0:
+                return
+            self._wakeup.clear()
+            try:
+                yield from asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                return
@@ -0,0 +1,98 @@
+import time
+
+import numpy as np
+
+# layout of the motion data the h264 encoder writes per macroblock,
+# see picamera.array.motion_dtype
+MOTION_DTYPE = np.dtype([("x", "i1"), ("y", "i1"), ("sad", "u2")])
+
+
+def macroblocks(resolution):
+    """Rows and columns of the motion data of a frame.
+
+    The encoder adds one extra column per row.
+    """
+    width, height = resolution
+    return (height + 15) // 16, (width + 15) // 16 + 1
+
+
+def frameSize(resolution):
+    rows, cols = macroblocks(resolution)
+    return rows * cols * MOTION_DTYPE.itemsize
+
+
+def motionScore(vectors, threshold=2.0):
+    """Fraction of macroblocks that moved more than threshold pixels"""
+    # ignore the extra column
+    vectors = vectors[:, :-1]
+    magnitude = np.sqrt(
+        np.square(vectors["x"].astype(np.float32))
+        + np.square(vectors["y"].astype(np.float32))
+    )
+    return float(np.count_nonzero(magnitude > threshold)) / magnitude.size
+
+
+class MotionVectorAnalyzer(object):
+    """Output for the encoder's motion data (start_recording's motion_output).
+
+    Computes a motion score for every frame and reports the highest score of each
+    interval to callback, which is called from the camera's thread.
+    """
+
+    def __init__(self, resolution, callback, threshold=2.0, interval=1.0):
+        self._shape = macroblocks(resolution)
+        self._frameSize = frameSize(resolution)
+        self._callback = callback
+        self._threshold = threshold
+        self._interval = interval
+
+        self._pending = b""
+        self._maxScore = 0.0
+        self._lastReport = time.time()
+
+    def write(self, data):
+        if self._pending:
+            data = self._pending + data
+            self._pending = b""
+
+        offset = 0
+        while len(data) - offset >= self._frameSize:
+            self._analyseFrame(data[offset : offset + self._frameSize])
+            offset += self._frameSize
+        if offset < len(data):
+            self._pending = bytes(data[offset:])
+
+    def flush(self):
+        pass
+
+    def _analyseFrame(self, frame):
+        vectors = np.frombuffer(frame, dtype=MOTION_DTYPE).reshape(self._shape)
+        self._maxScore = max(self._maxScore, motionScore(vectors, self._threshold))
+
+        now = time.time()
+        if now - self._lastReport >= self._interval:
+            self._callback(self._maxScore)
+            self._maxScore = 0.0
+            self._lastReport = now
+
+
+def syntheticMotion(resolution, frames, moveEvery=50, moveFrames=10, seed=0):
+    """Motion data with little noise and a moving object from time to time.
+
+    Creates a fixture in the format the encoder writes (e.g. `raspivid -x`),
+    which the simulated camera can replay.
+    """
+    rows, cols = macroblocks(resolution)
+    random = np.random.RandomState(seed)
+    data = []
+    for i in range(frames):
+        vectors = np.zeros((rows, cols), dtype=MOTION_DTYPE)
+        vectors["x"] = random.randint(-1, 2, (rows, cols))
+        vectors["sad"] = random.randint(0, 200, (rows, cols))
+        if i % moveEvery < moveFrames:
+            row = random.randint(0, max(rows - 3, 1))
+            col = random.randint(0, max(cols - 4, 1))
+            vectors["x"][row : row + 3, col : col + 3] = 6
+            vectors["y"][row : row + 3, col : col + 3] = -4
+        data.append(vectors.tobytes())
+    return b"".join(data)
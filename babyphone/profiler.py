@@ -0,0 +1,62 @@
+import collections
+import os
+import sys
+import threading
+import time
+
+
+class ProfilerBusy(Exception):
+    pass
+
+
+class SamplingProfiler(object):
+    """Samples the stacks of all threads for a while, on demand.
+
+    Nothing runs unless a profile is requested, so it costs nothing otherwise.
+    While sampling, a thread of its own looks at the stacks every `interval`
+    seconds. The result is in the collapsed format of flame graph tools, one
+    line per distinct stack with the number of samples.
+    """
+
+    def __init__(self, interval=0.005, maxSeconds=60.0):
+        self.interval = interval
+        self.maxSeconds = maxSeconds
+        self._lock = threading.Lock()
+
+    def profile(self, seconds):
+        """Samples for the given seconds and returns the number of samples and
+        the collapsed stacks. Blocks, run it in an executor"""
+        if not self._lock.acquire(False):
+            raise ProfilerBusy("a profile is being taken already")
+        try:
+            return self._sample(min(seconds, self.maxSeconds))
+        finally:
+            self._lock.release()
+
+    def _sample(self, seconds):
+        me = threading.get_ident()
+        names = dict((t.ident, t.name) for t in threading.enumerate())
+        stacks = collections.Counter()
+        samples = 0
+        end = time.time() + seconds
+        while time.time() < end:
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                if ident not in names:
+                    names = dict((t.ident, t.name) for t in threading.enumerate())
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(
+                        "%s (%s:%d)"
+                        % (code.co_name, os.path.basename(code.co_filename), frame.f_lineno)
+                    )
+                    frame = frame.f_back
+                stack.append(names.get(ident, "thread-%d" % ident))
+                stacks[";".join(reversed(stack))] += 1
+            samples += 1
+            time.sleep(self.interval)
+
+        lines = ["%s %d" % item for item in stacks.most_common()]
+        return samples, "\n".join(lines) + "\n"
@@ -0,0 +1,111 @@
+import base64
+import json
+import struct
+
+# Media can be sent to a client in two ways:
+#  - json: the original protocol, the payload is base64 encoded inside a json
+#    message ("vframe" or "audio" action). Kept for old clients.
+#  - binary: a websocket binary frame, starting with a fixed header followed by
+#    the raw payload. Control messages stay json in both modes.
+MODE_JSON = "json"
+MODE_BINARY = "binary"
+MODES = (MODE_JSON, MODE_BINARY)
+# the packet itself, for subscribers within the server. Not for clients.
+MODE_PACKET = "packet"
+
+VERSION = 1
+
+# version, stream, frame type, flags, pts (micros), server time (millis)
+HEADER = struct.Struct("!BBBBqq")
+
+STREAM_VIDEO = 1
+STREAM_AUDIO = 2
+
+# the payload is a SPS header, i.e. the decoder configuration
+FLAG_SPS = 0x01
+# replayed from the cache when the client started receiving video, so the
+# server time is when it was captured, not sent
+FLAG_PRIMED = 0x02
+
+# mirrors picamera.PiVideoFrameType, so we don't need picamera to encode
+FRAME_TYPE_FRAME = 0
+FRAME_TYPE_KEY_FRAME = 1
+FRAME_TYPE_SPS_HEADER = 2
+
+
+class MediaPacket(object):
+    """A chunk of encoded video or audio, independent of the wire format"""
+
+    __slots__ = ("stream", "data", "pts", "frameType", "now", "offset")
+
+    def __init__(self, stream, data, pts, frameType=FRAME_TYPE_FRAME, now=0, offset=0):
+        self.stream = stream
+        self.data = data
+        self.pts = pts
+        self.frameType = frameType
+        self.now = now
+        self.offset = offset
+
+    def isSps(self):
+        return self.frameType == FRAME_TYPE_SPS_HEADER
+
+    def encode(self, mode, primed=False):
+        if mode == MODE_BINARY:
+            return self.toBinary(primed)
+        if mode == MODE_PACKET:
+            return self
+        return self.toJson(primed)
+
+    def toBinary(self, primed=False):
+        flags = FLAG_SPS if self.isSps() else 0
+        if primed:
+            flags |= FLAG_PRIMED
+        header = HEADER.pack(
+            VERSION,
+            self.stream,
+            self.frameType,
+            flags,
+            self.pts if self.pts is not None else -1,
+            self.now,
+        )
+        return header + self.data
+
+    def toJson(self, primed=False):
+        data = base64.b64encode(self.data).decode("ascii")
+        if self.stream == STREAM_AUDIO:
+            return json.dumps(
+                dict(action="audio", audio=dict(data=data, pts=self.pts))
+            )
+
+        message = dict(
+            action="vframe",
+            pts=self.pts,
+            offset=self.offset,
+            timestamp=self.pts,
+            now=self.now,
+            data=data,
+            type=1 if self.isSps() else 0,
+        )
+        if primed:
+            message["primed"] = True
+        return json.dumps(message)
+
+
+def decodeBinary(buf):
+    """Parses a binary media frame, returns the header fields as dict and the payload"""
+    if len(buf) < HEADER.size:
+        raise ValueError("binary frame too short: %d bytes" % len(buf))
+
+    version, stream, frameType, flags, pts, now = HEADER.unpack_from(buf)
+    if version != VERSION:
+        raise ValueError("unsupported binary frame version %d" % version)
+
+    header = dict(
+        stream=stream,
+        frameType=frameType,
+        sps=bool(flags & FLAG_SPS),
+        primed=bool(flags & FLAG_PRIMED),
+        pts=pts if pts >= 0 else None,
+        now=now,
+    )
+    return header, memoryview(buf)[HEADER.size :]
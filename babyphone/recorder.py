@@ -0,0 +1,262 @@
+import asyncio
+import collections
+import logging
+import os
+import shutil
+import struct
+import subprocess
+import tempfile
+import threading
+import time
+
+from babyphone import audiosource, renditions
+
+log = logging.getLogger("babyphone")
+
+# extensions of the files a clip consists of
+CLIP_EXTENSIONS = (".mkv", ".h264", ".wav")
+
+
+def alawWav(data, rate=audiosource.OUTPUT_RATE):
+    """A-law samples in a wav container (format tag 6), no re-encoding needed"""
+    fmt = struct.pack("<HHIIHHH", 6, 1, rate, rate, 1, 8, 0)
+    fact = struct.pack("<I", len(data))
+    pad = b"\x00" if len(data) % 2 else b""
+    chunks = b"".join(
+        [
+            b"fmt ",
+            struct.pack("<I", len(fmt)),
+            fmt,
+            b"fact",
+            struct.pack("<I", len(fact)),
+            fact,
+            b"data",
+            struct.pack("<I", len(data)),
+            data,
+            pad,
+        ]
+    )
+    return b"RIFF" + struct.pack("<I", 4 + len(chunks)) + b"WAVE" + chunks
+
+
+class RingBuffer(object):
+    """The last seconds of encoded video and audio, within a memory limit.
+
+    Video is evicted by whole groups of pictures, so the buffer always starts
+    with an SPS header and everything taken from it is decodable. Video is
+    added from the camera thread, hence the lock.
+    """
+
+    def __init__(self, maxBytes=16 * 1024 * 1024, maxSeconds=60):
+        self.maxBytes = maxBytes
+        self.maxSeconds = maxSeconds
+        # (time, data, sps)
+        self._video = collections.deque()
+        # (time, data)
+        self._audio = collections.deque()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return self._bytes
+
+    def addVideo(self, data, sps, now=None):
+        with self._lock:
+            if not self._video and not sps:
+                # can't be decoded without the header
+                return
+            self._video.append((now or time.time(), data, sps))
+            self._bytes += len(data)
+            self._evict()
+
+    def addAudio(self, data, now=None):
+        with self._lock:
+            self._audio.append((now or time.time(), data))
+            self._bytes += len(data)
+            self._evict()
+
+    def _evict(self):
+        oldest = time.time() - self.maxSeconds
+        while True:
+            overfull = self._bytes > self.maxBytes
+            if self._video and (
+                self._video[0][0] < oldest
+                or overfull
+                and (not self._audio or self._video[0][0] <= self._audio[0][0])
+            ):
+                self._dropGop()
+            elif self._audio and (self._audio[0][0] < oldest or overfull):
+                self._bytes -= len(self._audio.popleft()[1])
+            else:
+                break
+
+    def _dropGop(self):
+        self._bytes -= len(self._video.popleft()[1])
+        while self._video and not self._video[0][2]:
+            self._bytes -= len(self._video.popleft()[1])
+
+    def take(self, start, end):
+        """Video from the last SPS header before start until end and the audio
+        from the start of that video until end. Returns both and the seconds
+        the audio starts after the video"""
+        with self._lock:
+            video = []
+            videoStart = start
+            for at, data, sps in self._video:
+                if at > end:
+                    break
+                if sps and at <= start:
+                    # a later header to start from
+                    video = []
+                if not video and sps:
+                    videoStart = at
+                if video or sps:
+                    video.append(data)
+            audio = [
+                (at, data) for at, data in self._audio if videoStart <= at <= end
+            ]
+        offset = audio[0][0] - videoStart if video and audio else 0.0
+        return b"".join(video), b"".join(data for _, data in audio), offset
+
+    def stats(self):
+        with self._lock:
+            heads = [queue[0][0] for queue in (self._video, self._audio) if queue]
+            return dict(
+                bytes=self._bytes,
+                video_frames=len(self._video),
+                audio_packets=len(self._audio),
+                seconds=time.time() - min(heads) if heads else 0.0,
+            )
+
+
+class ClipRecorder(object):
+    """Exports clips around activity from the ring buffer.
+
+    A trigger exports the `before` seconds before it and the `after` seconds
+    after it, triggers while a clip is pending extend it. Clips are remuxed to
+    mkv if ffmpeg is installed, otherwise they're stored as raw h264 and wav.
+    Only the latest `maxClips` are kept.
+    """
+
+    def __init__(
+        self,
+        babyphone,
+        directory=None,
+        before=10.0,
+        after=10.0,
+        maxClips=20,
+        buffer=None,
+    ):
+        self._bp = babyphone
+        self.directory = directory or os.path.join(
+            tempfile.gettempdir(), "babyphone-clips"
+        )
+        self.before = before
+        self.after = after
+        self.maxClips = maxClips
+        self.buffer = buffer if buffer is not None else RingBuffer()
+        self._ffmpeg = shutil.which("ffmpeg")
+        # [start, end] of the clip waiting for its end
+        self._pending = None
+        self._exporter = None
+
+    def trigger(self, reason="activity"):
+        now = time.time()
+        if self._pending is not None:
+            self._pending[1] = now + self.after
+            return
+        log.info("recording a clip of the %s", reason)
+        self._pending = [now - self.before, now + self.after]
+        self._exporter = asyncio.ensure_future(self._export())
+
+    def stop(self):
+        if self._exporter is not None and not self._exporter.done():
+            self._exporter.cancel()
+        self._pending = None
+
+    @asyncio.coroutine
+    def _export(self):
+        try:
+            while time.time() < self._pending[1]:
+                yield from asyncio.sleep(self._pending[1] - time.time())
+            start, end = self._pending
+            self._pending = None
+
+            video, audio, audioOffset = self.buffer.take(start, end)
+            if not video and not audio:
+                log.info("nothing recorded for the clip")
+                return
+            name = time.strftime("clip-%Y%m%d-%H%M%S", time.localtime(start))
+            files = yield from asyncio.get_event_loop().run_in_executor(
+                self._bp.executor, self._write, name, video, audio, audioOffset
+            )
+            log.info("exported clip %s", ", ".join(files))
+            yield from self._bp.broadcast(
+                {
+                    "action": "clip",
+                    "clip": dict(name=name, files=files, start=start, end=end),
+                }
+            )
+        except asyncio.CancelledError:
+            return
+        except Exception as e:
+            log.error("could not export clip")
+            log.exception(e)
+
+    def _write(self, name, video, audio, audioOffset=0.0):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        base = os.path.join(self.directory, name)
+
+        files = []
+        if video:
+            with open(base + ".h264", "wb") as f:
+                f.write(video)
+            files.append(name + ".h264")
+        if audio:
+            with open(base + ".wav", "wb") as f:
+                f.write(alawWav(audio))
+            files.append(name + ".wav")
+
+        if self._ffmpeg and video:
+            cmd = [self._ffmpeg, "-y", "-loglevel", "error"]
+            cmd += ["-framerate", str(renditions.FRAMERATE)]
+            cmd += ["-f", "h264", "-i", base + ".h264"]
+            if audio:
+                # the audio may start later if it was evicted or not captured
+                cmd += ["-itsoffset", "%.3f" % audioOffset, "-i", base + ".wav"]
+            cmd += ["-c", "copy", base + ".mkv"]
+            try:
+                subprocess.check_call(cmd)
+                for f in files:
+                    os.remove(os.path.join(self.directory, f))
+                files = [name + ".mkv"]
+            except (OSError, subprocess.CalledProcessError) as e:
+                log.info("could not remux clip, keeping the raw files: %s", e)
+
+        self._cleanup()
+        return files
+
+    def _cleanup(self):
+        names = sorted(set(os.path.splitext(f)[0] for f in self.clips()))
+        for name in names[: max(len(names) - self.maxClips, 0)]:
+            for extension in CLIP_EXTENSIONS:
+                path = os.path.join(self.directory, name + extension)
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def clips(self):
+        """File names of the exported clips"""
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(
+            f
+            for f in os.listdir(self.directory)
+            if os.path.splitext(f)[1] in CLIP_EXTENSIONS
+        )
+
+    def clipPath(self, fileName):
+        """Path of an exported clip file, None if there's no such clip"""
+        if fileName not in self.clips():
+            return None
+        return os.path.join(self.directory, fileName)
@@ -0,0 +1,160 @@
+import collections
+import logging
+import time
+
+from babyphone import fanout, frameassembler, metrics, protocol
+from babyphone import hardware as hal
+
+log = logging.getLogger("babyphone")
+
+# bitrate None leaves the bitrate to the encoder, limited by the quality only
+Rendition = collections.namedtuple(
+    "Rendition", ["name", "resolution", "quality", "bitrate", "splitterPort"]
+)
+
+# ordered from the least to the most bandwidth
+RENDITIONS = [
+    Rendition("low", (320, 240), quality=35, bitrate=150000, splitterPort=2),
+    Rendition("standard", (320, 240), quality=23, bitrate=None, splitterPort=1),
+    Rendition("high", (640, 480), quality=20, bitrate=None, splitterPort=3),
+]
+BY_NAME = dict((r.name, r) for r in RENDITIONS)
+NAMES = [r.name for r in RENDITIONS]
+
+# what clients get unless they ask for something else
+DEFAULT = "standard"
+# let the server choose by the connection quality
+AUTO = "auto"
+
+# the camera records at the largest resolution, the others are resized
+CAMERA_RESOLUTION = max(r.resolution for r in RENDITIONS)
+
+FRAMERATE = 10
+INTRA_PERIOD = 10
+
+
+def recordingOptions(rendition):
+    """Options of camera.start_recording for the rendition"""
+    options = dict(
+        format="h264",
+        intra_period=INTRA_PERIOD,
+        profile="main",
+        quality=rendition.quality,
+    )
+    if rendition.resolution != CAMERA_RESOLUTION:
+        options["resize"] = rendition.resolution
+    if rendition.bitrate is not None:
+        options["bitrate"] = rendition.bitrate
+    return options
+
+
+class RenditionOutput(object):
+    """Output of the recording of one rendition, called by the camera thread.
+
+    Assembles the encoder's writes to frames and publishes them to the
+    subscribers of the rendition. The primary rendition also feeds the clip
+    recorder.
+    """
+
+    def __init__(self, babyphone, loop, rendition, cam, primary=False):
+        self._bp = babyphone
+        self._loop = loop
+        self._cam = cam
+        self.rendition = rendition
+        self.primary = primary
+        self._frame = frameassembler.FrameAssembler()
+        self._frames = metrics.VIDEO_FRAMES.labels(rendition.name)
+        self._bytes = metrics.VIDEO_BYTES.labels(rendition.name)
+
+    def write(self, data):
+        try:
+            self._frame.append(data)
+            frame = hal.currentFrame(self._cam, self.rendition.splitterPort)
+            if frame.complete:
+                packet = protocol.MediaPacket(
+                    protocol.STREAM_VIDEO,
+                    self._frame.take(),
+                    pts=frame.timestamp,
+                    frameType=frame.frame_type,
+                    now=int(time.time() * 1000),
+                    offset=frame.position,
+                )
+                self._frames.inc()
+                self._bytes.inc(len(packet.data))
+                if self.primary:
+                    self._bp.recorder.buffer.addVideo(packet.data, packet.isSps())
+                # only enqueues, so we don't need to track a future per frame
+                self._loop.call_soon_threadsafe(
+                    self._bp.fanout.publish, fanout.VIDEO, packet, self.rendition.name
+                )
+        except Exception as e:
+            log.exception(e)
+
+
+class AdaptivePolicy(object):
+    """Chooses the rendition for a client by how well its connection keeps up.
+
+    Goes down one rendition as soon as video is dropped for the client, the
+    video backlog grows over `maxBacklog` frames or the round trip time over
+    `maxRtt` seconds. Goes up one rendition (not beyond `maxRendition`) after
+    `upAfter` seconds without any of that and a round trip time below
+    `goodRtt`. Waits `holdTime` seconds after a switch before switching again.
+    """
+
+    def __init__(
+        self,
+        maxRendition=DEFAULT,
+        maxBacklog=5,
+        maxRtt=0.5,
+        goodRtt=0.15,
+        upAfter=10.0,
+        holdTime=5.0,
+    ):
+        self.maxRendition = maxRendition
+        self.maxBacklog = maxBacklog
+        self.maxRtt = maxRtt
+        self.goodRtt = goodRtt
+        self.upAfter = upAfter
+        self.holdTime = holdTime
+
+        self._dropped = 0
+        self._lastSwitch = 0.0
+        self._goodSince = None
+
+    def evaluate(self, current, backlog, dropped, rtt, now=None):
+        """Returns the rendition the client should get.
+
+        backlog are the video frames queued for the client, dropped the total
+        number of video frames dropped for it so far, rtt the round trip time in
+        seconds or None if unknown.
+        """
+        now = now if now is not None else time.time()
+        newDrops = dropped > self._dropped
+        self._dropped = dropped
+
+        index = NAMES.index(current)
+        bad = newDrops or backlog > self.maxBacklog or (rtt or 0) > self.maxRtt
+        good = not newDrops and backlog <= 1 and rtt is not None and rtt < self.goodRtt
+
+        if not good:
+            self._goodSince = None
+        elif self._goodSince is None:
+            self._goodSince = now
+
+        if now - self._lastSwitch < self.holdTime:
+            return current
+
+        if bad and index > 0:
+            target = NAMES[index - 1]
+        elif (
+            self._goodSince is not None
+            and now - self._goodSince >= self.upAfter
+            and index < NAMES.index(self.maxRendition)
+        ):
+            target = NAMES[index + 1]
+        else:
+            return current
+
+        self._lastSwitch = now
+        self._goodSince = None
+        return target
@@ -0,0 +1,107 @@
+import asyncio
+import collections
+
+from babyphone import fanout, metrics
+
+
+class SendQueue(object):
+    """Bounded queue of encoded messages waiting to be sent to one client.
+
+    The bounds are per kind of message, each with its own policy if the client
+    cannot keep up:
+     - video: the queued frames are dropped and all following frames are
+       dropped as well until the next SPS header, because the decoder could not
+       decode the P-frames anyway.
+     - audio: the oldest queued packet is dropped, so the newest audio is kept.
+     - control: the oldest queued message is dropped.
+    """
+
+    def __init__(self, maxVideo=20, maxAudio=50, maxControl=100):
+        self._items = collections.deque()
+        self._limits = {
+            fanout.VIDEO: maxVideo,
+            fanout.AUDIO: maxAudio,
+            fanout.CONTROL: maxControl,
+        }
+        self._counts = dict.fromkeys(self._limits, 0)
+        self._ready = asyncio.Event()
+        self._waitForSps = False
+
+        self.enqueued = dict.fromkeys(self._limits, 0)
+        self.dropped = dict.fromkeys(self._limits, 0)
+        self.maxDepth = 0
+
+    def put(self, kind, data, sps=False):
+        """Enqueues the encoded message, returns False if it was dropped"""
+        if kind == fanout.VIDEO:
+            if sps:
+                self._waitForSps = False
+            elif self._waitForSps:
+                self._countDropped(kind)
+                return False
+
+            if self._counts[kind] >= self._limits[kind]:
+                self._dropAll(kind)
+                if not sps:
+                    self._waitForSps = True
+                    self._countDropped(kind)
+                    return False
+        elif self._counts[kind] >= self._limits[kind]:
+            self._dropOldest(kind)
+
+        self._items.append((kind, data))
+        self._counts[kind] += 1
+        self.enqueued[kind] += 1
+        metrics.MESSAGES_ENQUEUED.labels(kind).inc()
+        self.maxDepth = max(self.maxDepth, len(self._items))
+        self._ready.set()
+        return True
+
+    @asyncio.coroutine
+    def get(self):
+        while not self._items:
+            self._ready.clear()
+            yield from self._ready.wait()
+
+        kind, data = self._items.popleft()
+        self._counts[kind] -= 1
+        metrics.MESSAGES_SENT.labels(kind).inc()
+        return data
+
+    def dropVideo(self):
+        """Drops the queued video and all following until the next SPS header,
+        e.g. when the client switches to another rendition"""
+        self._dropAll(fanout.VIDEO)
+        self._waitForSps = True
+
+    def depth(self):
+        return len(self._items)
+
+    def waitingForKeyframe(self):
+        return self._waitForSps
+
+    def stats(self):
+        return dict(
+            depth=len(self._items),
+            max_depth=self.maxDepth,
+            queued=dict(self._counts),
+            enqueued=dict(self.enqueued),
+            dropped=dict(self.dropped),
+        )
+
+    def _countDropped(self, kind, count=1):
+        self.dropped[kind] += count
+        metrics.MESSAGES_DROPPED.labels(kind).inc(count)
+
+    def _dropAll(self, kind):
+        self._countDropped(kind, self._counts[kind])
+        self._counts[kind] = 0
+        self._items = collections.deque(item for item in self._items if item[0] != kind)
+
+    def _dropOldest(self, kind):
+        for item in self._items:
+            if item[0] == kind:
+                self._items.remove(item)
+                self._counts[kind] -= 1
+                self._countDropped(kind)
+                return
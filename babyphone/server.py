@@ -5,10 +5,22 @@ import asyncio
 import logging
 import signal
 import sys
-from datetime import datetime
+import time
 
 import websockets
-from babyphone import babyphone, discovery
+from babyphone import (
+    audiosource,
+    babyphone,
+    discovery,
+    hardware,
+    hub,
+    looplag,
+    metrics,
+    motionengine,
+    profiler,
+    snapshot,
+    timeseries,
+)
 
 loop = asyncio.get_event_loop()
 
@@ -27,55 +39,175 @@ def signalStop():
 
 
 @asyncio.coroutine
-def writeStats():
-    import psutil
+def runWebserver(bp, watchdog, port=8081):
+    from aiohttp import web
 
-    logFormatter = logging.Formatter("%(asctime)s [%(levelname)-5.5s]  %(message)s")
-    fileHandler = logging.FileHandler(
-        datetime.now().strftime("babyphone-%Y-%m-%d-stats.log")
-    )
-    fileHandler.setFormatter(logFormatter)
+    log.info("starting application server")
 
-    MB = 1024 * 1024
-    statLogger = logging.Logger("stats", logging.INFO)
-    statLogger.addHandler(fileHandler)
+    @asyncio.coroutine
+    def latest(request):
+        """The last picture. Query parameters: refresh to take a new one,
+        format=png|jpeg|webp and thumbnail for a small version"""
+        refresh = request.query.get("refresh") is not None
+        log.info("%s is requesting the image with refresh=%s", request.remote, refresh)
+        format = request.query.get("format", snapshot.FORMAT_PNG)
+        if format not in snapshot.FORMATS:
+            raise web.HTTPBadRequest(text="unsupported format %s" % format)
+        width = None
+        if request.query.get("thumbnail") is not None:
+            width = snapshot.THUMBNAIL_WIDTH
 
-    while True:
-        cpu = psutil.cpu_percent(interval=None)
+        picture = yield from bp.snapshots.get(format, width, refresh)
+        if picture is None:
+            return web.Response(status=404, text="no picture yet")
 
-        memory = psutil.virtual_memory()
-        statLogger.info("CPU: %.2f Memory left: %sMb", cpu, memory.available / MB)
-        yield from asyncio.sleep(10)
+        headers = {
+            "ETag": picture.etag,
+            "Last-Modified": picture.lastModified,
+            "Cache-Control": "no-cache",
+            "picture-time": "%s" % picture.timestamp,
+        }
+        etags = request.headers.get("If-None-Match")
+        if etags is not None:
+            tags = [tag.strip() for tag in etags.split(",")]
+            notModified = picture.etag in tags or "*" in tags
+        else:
+            since = request.if_modified_since
+            notModified = since is not None and picture.timestamp <= since.timestamp()
+        if notModified:
+            return web.Response(status=304, headers=headers)
 
+        return web.Response(
+            body=picture.body, content_type=picture.contentType, headers=headers
+        )
 
-@asyncio.coroutine
-def runWebserver(bp):
-    from aiohttp import web
+    def clips(request):
+        return web.json_response(bp.recorder.clips())
 
-    log.info("starting application server")
+    def clip(request):
+        path = bp.recorder.clipPath(request.match_info["name"])
+        if path is None:
+            raise web.HTTPNotFound()
+        # answers range requests
+        return web.FileResponse(path)
 
     @asyncio.coroutine
-    def latest(request):
-        log.info(request.remote + " is refreshing the image with reload="+str(request.query.get('refresh', False)))
-        refresh = request.query.get("refresh") is not None
-        body = yield from bp.getLastPictureAsBytes(refresh)
+    def hlsPlaylist(request):
+        playlist = yield from bp.hls.playlist()
+        if playlist is None:
+            raise web.HTTPServiceUnavailable(text="no video yet")
         return web.Response(
-            body=body,
-            content_type="image/png",
-            headers={"picture-time": "%s" % bp.getLastPictureTimestamp(),},
+            body=playlist,
+            content_type="application/vnd.apple.mpegurl",
+            headers={"Cache-Control": "no-cache"},
         )
 
+    def hlsSegment(request):
+        data = bp.hls.segment(int(request.match_info["sequence"]))
+        if data is None:
+            raise web.HTTPNotFound()
+        # segments never change, the bytes are shared by all players
+        return web.Response(
+            body=data,
+            content_type="video/mp2t",
+            headers={"Cache-Control": "max-age=60"},
+        )
+
+    @asyncio.coroutine
+    def history(request):
+        """Volume or movement over time. Query parameters: series, start and end
+        (unix time, default the last 12 hours), resolution in seconds per point
+        (default: chosen by the range) and format=json|binary"""
+        series = request.query.get("series", timeseries.SERIES_VOLUME)
+        if series not in timeseries.SERIES:
+            raise web.HTTPBadRequest(text="unknown series %s" % series)
+        try:
+            end = float(request.query.get("end", time.time()))
+            start = float(request.query.get("start", end - 12 * 3600))
+            resolution = request.query.get("resolution")
+            if resolution is not None:
+                resolution = int(resolution)
+                if resolution not in timeseries.LEVELS:
+                    raise ValueError("unsupported resolution %s" % resolution)
+        except ValueError as e:
+            raise web.HTTPBadRequest(text=str(e))
+
+        resolution, points = yield from bp.history.query(
+            series, start, end, resolution
+        )
+        if request.query.get("format") == "binary":
+            return web.Response(
+                body=timeseries.toBinary(points),
+                content_type="application/octet-stream",
+                headers={"Series-Resolution": str(resolution)},
+            )
+        return web.json_response(
+            dict(
+                series=series,
+                resolution=resolution,
+                t=[point[0] for point in points],
+                mean=[round(point[1], 4) for point in points],
+                min=[round(point[2], 4) for point in points],
+                max=[round(point[3], 4) for point in points],
+            )
+        )
+
+    def metricsText(request):
+        return web.Response(
+            body=metrics.REGISTRY.render().encode("utf-8"),
+            headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+        )
+
+    sampler = profiler.SamplingProfiler()
+
+    @asyncio.coroutine
+    def profile(request):
+        """Samples the stacks of all threads for ?seconds (default 10) and
+        returns them collapsed, for flame graph tools. The number of samples
+        is in the X-Profile-Samples header"""
+        try:
+            seconds = float(request.query.get("seconds", 10))
+        except ValueError as e:
+            raise web.HTTPBadRequest(text=str(e))
+        try:
+            samples, stacks = yield from asyncio.get_event_loop().run_in_executor(
+                None, sampler.profile, seconds
+            )
+        except profiler.ProfilerBusy as e:
+            raise web.HTTPConflict(text=str(e))
+        return web.Response(text=stacks, headers={"X-Profile-Samples": str(samples)})
+
     def imok(request):
         return web.Response(body="imok")
 
-    app = web.Application()
+    @web.middleware
+    @asyncio.coroutine
+    def labelRequests(request, handler):
+        with looplag.label("http %s %s" % (request.method, request.path)):
+            return (yield from handler(request))
+
+    def stalls(request):
+        return web.json_response(watchdog.stats())
+
+    app = web.Application(middlewares=[labelRequests])
     app.add_routes([web.get("/latest", latest)])
     app.add_routes([web.get("/ruok", imok)])
+    app.add_routes([web.get("/clips", clips), web.get("/clips/{name}", clip)])
+    app.add_routes([web.get("/history", history)])
+    app.add_routes([web.get("/metrics", metricsText)])
+    app.add_routes([web.get("/debug/profile", profile)])
+    app.add_routes([web.get("/debug/stalls", stalls)])
+    app.add_routes(
+        [
+            web.get("/hls/stream.m3u8", hlsPlaylist),
+            web.get(r"/hls/{sequence:\d+}.ts", hlsSegment),
+        ]
+    )
 
     runner = web.AppRunner(app)
     log.info("setup runner")
     yield from runner.setup()
-    site = web.TCPSite(runner, "0.0.0.0", 8081)
+    site = web.TCPSite(runner, "0.0.0.0", port)
     log.info("starting site")
     yield from site.start()
 
@@ -86,22 +218,153 @@ if __name__ == "__main__":
         "--write-stats",
         dest="writeStats",
         action="store_true",
-        help="Enable writing stats to separate file for performance debugging. Requires psutil package",
+        help="Deprecated, the stats are served at /metrics of the http server",
+    )
+    parser.add_argument(
+        "--audio-latency",
+        dest="audioLatency",
+        type=int,
+        choices=audiosource.LATENCIES,
+        default=audiosource.DEFAULT_LATENCY,
+        help="Audio capture period in milliseconds. Lower latency costs more CPU",
+    )
+    parser.add_argument(
+        "--motion-metric",
+        dest="motionMetric",
+        choices=motionengine.METRICS,
+        default=motionengine.METRIC_SSIM,
+        help="How pictures are compared for motion detection",
+    )
+    parser.add_argument(
+        "--motion-roi",
+        dest="motionRoi",
+        type=float,
+        nargs=4,
+        action="append",
+        metavar=("X", "Y", "W", "H"),
+        help="Region of interest for motion detection relative to the picture size "
+        "(0.0-1.0), e.g. the crib. Can be repeated. Default is the whole picture",
+    )
+    parser.add_argument(
+        "--noise-gate",
+        dest="noiseGate",
+        action="store_true",
+        help="Only send audio while the room is not silent. Clients can change it "
+        "with the noise_gate configuration",
+    )
+    parser.add_argument(
+        "--clip-dir",
+        dest="clipDir",
+        help="Directory for the clips recorded on activity. Default: in the temp directory",
+    )
+    parser.add_argument(
+        "--history-db",
+        dest="historyDb",
+        help="SQLite file keeping the volume and movement history. Default: in the temp directory",
+    )
+    parser.add_argument(
+        "--simulate",
+        action="store_true",
+        help="Use simulated camera, microphone and lights to run without a Raspberry Pi",
     )
-    
+    parser.add_argument(
+        "--sim-video",
+        dest="simVideo",
+        help="raw h264 file the simulated camera replays. Default: synthetic frames",
+    )
+    parser.add_argument(
+        "--sim-audio",
+        dest="simAudio",
+        help="wav file the simulated microphone replays. Default: synthetic tone",
+    )
+    parser.add_argument(
+        "--sim-motion",
+        dest="simMotion",
+        help="motion vectors (raspivid -x) the simulated camera replays. Default: synthetic",
+    )
+    parser.add_argument(
+        "--sim-speed",
+        dest="simSpeed",
+        type=float,
+        default=1.0,
+        help="Replay speed of the simulated media, 1.0 is real time",
+    )
+    parser.add_argument(
+        "--port", type=int, default=8080, help="Port of the websocket server"
+    )
+    parser.add_argument(
+        "--http-port",
+        dest="httpPort",
+        type=int,
+        default=8081,
+        help="Port of the http server",
+    )
+    parser.add_argument(
+        "--no-discovery",
+        dest="discovery",
+        action="store_false",
+        help="Do not answer discovery requests",
+    )
+    parser.add_argument(
+        "--hub",
+        action="store_true",
+        help="Run as hub for the babyphones found in the network instead of as "
+        "babyphone. Clients connect to /nodes/<name> of the websocket server",
+    )
+    parser.add_argument(
+        "--node-port",
+        dest="nodePort",
+        type=int,
+        default=8080,
+        help="Port of the nodes' websocket servers, for nodes not advertising it",
+    )
+
     args = parser.parse_args()
     babyphone.initLogger()
     log.info("starting Server")
+    bp = None
+    hubServer = None
     try:
-        bp = babyphone.Babyphone(loop)
-        if args.writeStats:
-            asyncio.ensure_future(writeStats())
-
         loop.add_signal_handler(signal.SIGINT, signalStop)
-        log.info("starting websockets server")
-        discovery.createDiscoveryServer(loop)
-        loop.run_until_complete(websockets.serve(bp.connect, "0.0.0.0", 8080))
-        loop.run_until_complete(runWebserver(bp))
+        watchdog = looplag.LoopWatchdog(loop)
+        watchdog.start()
+        if args.hub:
+            log.info("starting hub")
+            hubServer = hub.Hub(loop, port=args.port, nodePort=args.nodePort)
+            loop.run_until_complete(hubServer.start())
+            loop.run_until_complete(
+                websockets.serve(hubServer.connect, "0.0.0.0", args.port)
+            )
+        else:
+            hw = None
+            if args.simulate:
+                log.info("using simulated hardware")
+                hw = hardware.SimulatedHardware(
+                    video=args.simVideo,
+                    audio=args.simAudio,
+                    motion=args.simMotion,
+                    speed=args.simSpeed,
+                )
+            bp = babyphone.Babyphone(
+                loop,
+                hardware=hw,
+                audioLatency=args.audioLatency,
+                motionOptions=dict(metric=args.motionMetric, roi=args.motionRoi),
+                clipDirectory=args.clipDir,
+                historyPath=args.historyDb,
+                noiseGate=args.noiseGate,
+            )
+            if args.writeStats:
+                log.warning("--write-stats is deprecated, see /metrics instead")
+
+            log.info("starting websockets server")
+            if args.discovery:
+                discovery.createDiscoveryServer(loop, args.port)
+            loop.run_until_complete(websockets.serve(bp.connect, "0.0.0.0", args.port))
+            loop.run_until_complete(runWebserver(bp, watchdog, args.httpPort))
         loop.run_forever()
     finally:
-        bp.close()
+        if hubServer is not None:
+            hubServer.close()
+        if bp is not None:
+            bp.close()
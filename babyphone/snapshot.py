@@ -0,0 +1,123 @@
+import asyncio
+import collections
+import email.utils
+import logging
+
+import cv2
+
+from babyphone import camera, metrics
+
+log = logging.getLogger("babyphone")
+
+FORMAT_PNG = "png"
+FORMAT_JPEG = "jpeg"
+FORMAT_WEBP = "webp"
+
+# format -> (extension for cv2, content type, encoding parameters)
+FORMATS = {
+    FORMAT_PNG: (".png", "image/png", []),
+    FORMAT_JPEG: (".jpg", "image/jpeg", [cv2.IMWRITE_JPEG_QUALITY, 85]),
+    FORMAT_WEBP: (".webp", "image/webp", [cv2.IMWRITE_WEBP_QUALITY, 80]),
+}
+
+THUMBNAIL_WIDTH = 160
+
+Snapshot = collections.namedtuple(
+    "Snapshot", ["body", "contentType", "etag", "timestamp", "lastModified"]
+)
+
+
+def encodePicture(picture, format, width=None):
+    """Encodes the picture, scaled down to width if given. Runs in an executor"""
+    with metrics.SNAPSHOT_ENCODE.labels(format).time():
+        if width and width < picture.shape[1]:
+            height = max(
+                int(round(picture.shape[0] * width / float(picture.shape[1]))), 1
+            )
+            picture = cv2.resize(picture, (width, height), interpolation=cv2.INTER_AREA)
+        extension, _, params = FORMATS[format]
+        ok, encoded = cv2.imencode(extension, picture, params)
+    if not ok:
+        raise ValueError("could not encode picture as %s" % format)
+    return encoded.tobytes()
+
+
+class SnapshotCache(object):
+    """Encoded versions of the last picture of the motion detection.
+
+    Each (format, width) is encoded once per picture, in the babyphone's
+    executor, and concurrent requests for the same version wait for the same
+    encoding. Concurrent refreshes share one capture.
+    """
+
+    def __init__(self, babyphone):
+        self._bp = babyphone
+        # the picture the cached encodings belong to
+        self._picture = None
+        # increases with every picture, distinguishes pictures of the same second
+        self._generation = 0
+        # (format, width) -> future of the encoded bytes
+        self._encodings = {}
+        self._refreshing = None
+
+    @asyncio.coroutine
+    def get(self, format=FORMAT_PNG, width=None, refresh=False):
+        """Returns the Snapshot of the last picture or None if there's no picture"""
+        if format not in FORMATS:
+            raise ValueError("unsupported format %s" % format)
+
+        if refresh:
+            yield from self.refresh()
+
+        picture = self._bp.motion.lastPicture
+        if picture is None:
+            return None
+
+        if picture is not self._picture:
+            self._picture = picture
+            self._generation += 1
+            self._encodings = {}
+        # a new picture may be stored while encoding, the snapshot describes
+        # this one
+        timestamp = self._bp.motion.lastPictureTimestamp
+        generation = self._generation
+
+        key = (format, width)
+        encoding = self._encodings.get(key)
+        if encoding is None:
+            encoding = asyncio.get_event_loop().run_in_executor(
+                self._bp.executor, encodePicture, picture, format, width
+            )
+            self._encodings[key] = encoding
+        try:
+            # shielded, a client going away must not cancel the encoding for others
+            body = yield from asyncio.shield(encoding)
+        except ValueError:
+            if self._encodings.get(key) is encoding:
+                del self._encodings[key]
+            raise
+
+        return Snapshot(
+            body=body,
+            contentType=FORMATS[format][1],
+            etag='"%d-%d-%s-%s"' % (timestamp, generation, format, width or "full"),
+            timestamp=timestamp,
+            lastModified=email.utils.formatdate(timestamp, usegmt=True),
+        )
+
+    @asyncio.coroutine
+    def refresh(self):
+        """Takes a new picture, or waits for the one being taken"""
+        if self._refreshing is None:
+            self._refreshing = asyncio.ensure_future(
+                self._bp.motion.updatePicture(
+                    highRes=True, priority=camera.PRIORITY_REFRESH
+                )
+            )
+            self._refreshing.add_done_callback(self._refreshDone)
+        else:
+            log.debug("joining the picture refresh in progress")
+        yield from asyncio.shield(self._refreshing)
+
+    def _refreshDone(self, future):
+        self._refreshing = None
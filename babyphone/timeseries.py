@@ -0,0 +1,236 @@
+import asyncio
+import logging
+import os
+import sqlite3
+import struct
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger("babyphone")
+
+SERIES_VOLUME = "volume"
+SERIES_MOVEMENT = "movement"
+SERIES = (SERIES_VOLUME, SERIES_MOVEMENT)
+
+# seconds per point of the stored resolutions, each rolled up from the values
+LEVELS = (1, 60, 900)
+
+# seconds each resolution is kept
+RETENTION = {1: 2 * 86400, 60: 30 * 86400, 900: 365 * 86400}
+
+# one point in the binary format: time, mean, min, max
+POINT = struct.Struct("<Ifff")
+
+
+def toBinary(points):
+    """Points as consecutive little endian records of uint32 time and float32
+    mean, min and max"""
+    return b"".join(POINT.pack(*point) for point in points)
+
+
+class TimeSeriesStore(object):
+    """Append-only history of the volume levels and movement scores.
+
+    Values are aggregated per second in memory and written in batches every
+    `flushInterval` seconds, in a thread of its own, so the SD card never
+    blocks the loop. Every batch updates the rollups per second, minute and 15
+    minutes at once (count, sum, min and max). Each resolution is kept for its
+    retention, and the oldest points are dropped when the database grows over
+    `maxBytes`.
+    """
+
+    def __init__(
+        self,
+        path=None,
+        flushInterval=10.0,
+        retention=None,
+        maxBytes=64 * 1024 * 1024,
+        maxPoints=1000,
+        pruneInterval=300.0,
+    ):
+        self.path = path or os.path.join(
+            tempfile.gettempdir(), "babyphone-history.sqlite"
+        )
+        self.flushInterval = flushInterval
+        self.retention = dict(RETENTION, **(retention or {}))
+        self.maxBytes = maxBytes
+        self.maxPoints = maxPoints
+        self.pruneInterval = pruneInterval
+
+        # (series, second) -> [count, sum, min, max], not written yet
+        self._pending = {}
+        self._flusher = None
+        # sqlite connections must stay in their thread, all access goes here
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._db = None
+        self._lastPrune = 0.0
+
+    def add(self, series, value, now=None):
+        second = int(now or time.time())
+        bucket = self._pending.get((series, second))
+        if bucket is None:
+            self._pending[(series, second)] = [1, value, value, value]
+        else:
+            bucket[0] += 1
+            bucket[1] += value
+            bucket[2] = min(bucket[2], value)
+            bucket[3] = max(bucket[3], value)
+
+        if self._flusher is None:
+            self._flusher = asyncio.ensure_future(self._flushPeriodically())
+
+    @asyncio.coroutine
+    def _flushPeriodically(self):
+        while True:
+            yield from asyncio.sleep(self.flushInterval)
+            try:
+                yield from self.flush()
+            except Exception as e:
+                log.error("could not write the history")
+                log.exception(e)
+
+    @asyncio.coroutine
+    def flush(self):
+        batch, self._pending = self._pending, {}
+        if batch:
+            yield from asyncio.get_event_loop().run_in_executor(
+                self._executor, self._write, batch
+            )
+
+    @asyncio.coroutine
+    def query(self, series, start, end, resolution=None):
+        """Points (time, mean, min, max) between start and end, in the given
+        resolution or the finest one with at most maxPoints points that still
+        covers start. Returns the resolution and the points"""
+        # includes what's not written yet
+        yield from self.flush()
+        return (
+            yield from asyncio.get_event_loop().run_in_executor(
+                self._executor, self._query, series, start, end, resolution
+            )
+        )
+
+    def close(self):
+        if self._flusher is not None:
+            self._flusher.cancel()
+            self._flusher = None
+        batch, self._pending = self._pending, {}
+        try:
+            if batch:
+                self._executor.submit(self._write, batch).result()
+            self._executor.submit(self._close).result()
+        except Exception as e:
+            log.error("could not write the history on close")
+            log.exception(e)
+        self._executor.shutdown()
+
+    def _connect(self):
+        if self._db is not None:
+            return self._db
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        db = sqlite3.connect(self.path)
+        # fewer syncs, the last seconds may get lost on power loss
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        for level in LEVELS:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS points_%d ("
+                "series TEXT NOT NULL, t INTEGER NOT NULL, "
+                "count INTEGER NOT NULL, sum REAL NOT NULL, "
+                "min REAL NOT NULL, max REAL NOT NULL, "
+                "PRIMARY KEY (series, t)) WITHOUT ROWID" % level
+            )
+        db.commit()
+        self._db = db
+        return db
+
+    def _close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def _write(self, batch):
+        db = self._connect()
+        with db:
+            for level in LEVELS:
+                rows = {}
+                for (series, second), (count, total, low, high) in batch.items():
+                    key = (series, second - second % level)
+                    row = rows.get(key)
+                    if row is None:
+                        rows[key] = [count, total, low, high]
+                    else:
+                        row[0] += count
+                        row[1] += total
+                        row[2] = min(row[2], low)
+                        row[3] = max(row[3], high)
+                db.executemany(
+                    "INSERT INTO points_%d VALUES (?, ?, ?, ?, ?, ?) "
+                    "ON CONFLICT (series, t) DO UPDATE SET "
+                    "count = count + excluded.count, sum = sum + excluded.sum, "
+                    "min = min(min, excluded.min), max = max(max, excluded.max)"
+                    % level,
+                    [key + tuple(row) for key, row in rows.items()],
+                )
+
+        if time.time() - self._lastPrune >= self.pruneInterval:
+            self._lastPrune = time.time()
+            self._prune(db)
+
+    def _usedBytes(self, db):
+        pageSize = db.execute("PRAGMA page_size").fetchone()[0]
+        pages = db.execute("PRAGMA page_count").fetchone()[0]
+        free = db.execute("PRAGMA freelist_count").fetchone()[0]
+        return (pages - free) * pageSize
+
+    def _prune(self, db):
+        now = time.time()
+        with db:
+            for level in LEVELS:
+                db.execute(
+                    "DELETE FROM points_%d WHERE t < ?" % level,
+                    (int(now - self.retention[level]),),
+                )
+
+        # freed pages are reused, so the file stops growing once we delete
+        for level in LEVELS:
+            while self._usedBytes(db) > self.maxBytes:
+                first, last = db.execute(
+                    "SELECT min(t), max(t) FROM points_%d" % level
+                ).fetchone()
+                if first is None:
+                    break
+                # the oldest tenth of this resolution
+                cut = first + max((last - first) // 10, level)
+                log.info(
+                    "history over %d bytes, dropping the %ds points before %d",
+                    self.maxBytes,
+                    level,
+                    cut,
+                )
+                with db:
+                    db.execute("DELETE FROM points_%d WHERE t < ?" % level, (cut,))
+
+    def _query(self, series, start, end, resolution):
+        if resolution is None:
+            oldest = time.time() - start
+            resolution = LEVELS[-1]
+            for level in LEVELS:
+                if (
+                    (end - start) / level <= self.maxPoints
+                    and oldest <= self.retention[level]
+                ):
+                    resolution = level
+                    break
+        elif resolution not in LEVELS:
+            raise ValueError("unsupported resolution %s" % resolution)
+
+        rows = self._connect().execute(
+            "SELECT t, sum / count, min, max FROM points_%d "
+            "WHERE series = ? AND t >= ? AND t <= ? ORDER BY t" % resolution,
+            (series, int(start) - int(start) % resolution, int(end)),
+        )
+        return resolution, rows.fetchall()
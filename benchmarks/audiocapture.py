@@ -0,0 +1,75 @@
+"""Shows the latency/cpu trade-off of the audio capture period.
+
+Runs the per-period work of the audio monitoring thread (dsp pipeline and
+packetizing) for every latency setting on a synthetic or wav source and reports
+the cpu time and wakeups per second of audio.
+
+    python -m benchmarks.audiocapture --seconds 60
+"""
+
+import argparse
+import json
+import time
+
+from babyphone import audiodsp, audiosource
+
+
+def createSource(args, latency):
+    if args.wav:
+        source = audiosource.WavSource(args.wav, realtime=False, loop=False)
+        source.periodSize = audiosource.periodSize(source.rate, latency)
+        return source
+    return audiosource.SyntheticSource(
+        periodSize=audiosource.periodSize(48000, latency), realtime=False
+    )
+
+
+def measure(source, seconds):
+    pipeline = audiodsp.AudioPipeline(
+        channels=source.channels, inRate=source.rate, outRate=audiosource.OUTPUT_RATE
+    )
+    packetizer = audiosource.Packetizer(
+        audiosource.OUTPUT_RATE * audiosource.PACKET_MILLIS // 1000
+    )
+
+    periods = int(seconds * source.rate / source.periodSize)
+    wakeups, packets = 0, 0
+    cpu = 0.0
+    for _ in range(periods):
+        data = source.read()
+        if data is None:
+            break
+        start = time.process_time()
+        alaw, rms = pipeline.process(data)
+        packets += len(packetizer.add(alaw))
+        cpu += time.process_time() - start
+        wakeups += 1
+
+    audioSeconds = wakeups * source.periodSize / float(source.rate)
+    return dict(
+        cpu_ms_per_second=cpu * 1000.0 / audioSeconds,
+        wakeups_per_second=wakeups / audioSeconds,
+        packets_per_second=packets / audioSeconds,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser("audio capture benchmark")
+    parser.add_argument("--wav", help="wav file to use instead of a synthetic tone")
+    parser.add_argument("--seconds", type=int, default=30)
+    args = parser.parse_args()
+
+    results = {}
+    for latency in audiosource.LATENCIES:
+        source = createSource(args, latency)
+        source.open()
+        try:
+            results["%dms" % latency] = measure(source, args.seconds)
+        finally:
+            source.close()
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""Compares the numpy audio pipeline with the former audioop chain.
+
+Processes captured audio period by period like the audio monitoring thread and
+reports the CPU time per second of audio and how close the results are. The
+input is either a stereo S32_LE wav file or a synthetic tone with noise.
+The audioop reference is skipped if audioop is not available (python >= 3.13).
+
+    python -m benchmarks.audiodsp --wav night.wav
+"""
+
+import argparse
+import json
+import time
+import wave
+
+import numpy as np
+
+from babyphone import audiodsp
+
+try:
+    import audioop
+except ImportError:
+    audioop = None
+
+RATE = 48000
+CHANNELS = 2
+
+
+def loadWav(path):
+    with wave.open(path, "rb") as w:
+        if (
+            w.getnchannels() != CHANNELS
+            or w.getsampwidth() != 4
+            or w.getframerate() != RATE
+        ):
+            raise ValueError("expected a stereo 32bit 48kHz wav file")
+        return w.readframes(w.getnframes())
+
+
+def synthetic(seconds):
+    t = np.arange(seconds * RATE) / float(RATE)
+    tone = np.sin(2 * np.pi * 440 * t) * (1 << 27)
+    noise = np.random.RandomState(0).normal(0, 1 << 22, (len(t), CHANNELS))
+    return (noise + tone[:, None]).astype("<i4").tobytes()
+
+
+def periods(data, periodSize):
+    step = periodSize * CHANNELS * 4
+    return [data[i : i + step] for i in range(0, len(data), step)]
+
+
+def runAudioop(chunks):
+    state = None
+    alaw, levels = [], []
+    for data in chunks:
+        data = audioop.tomono(data, 4, 1, 1)
+        data, state = audioop.ratecv(data, 4, 1, RATE, 8000, state)
+        data = audioop.mul(data, 4, 2)
+        levels.append(audioop.rms(data, 4))
+        alaw.append(audioop.lin2alaw(data, 4))
+    return b"".join(alaw), levels
+
+
+def runNumpy(chunks):
+    pipeline = audiodsp.AudioPipeline(channels=CHANNELS, inRate=RATE, outRate=8000)
+    alaw, levels = [], []
+    for data in chunks:
+        encoded, level = pipeline.process(data)
+        levels.append(level)
+        alaw.append(encoded)
+    return b"".join(alaw), levels
+
+
+def timed(func, chunks, seconds):
+    start = time.process_time()
+    result = func(chunks)
+    return result, (time.process_time() - start) * 1000.0 / seconds
+
+
+def main():
+    parser = argparse.ArgumentParser("audio pipeline benchmark")
+    parser.add_argument("--wav", help="stereo S32_LE 48kHz wav file")
+    parser.add_argument("--seconds", type=int, default=30)
+    parser.add_argument("--period-size", dest="periodSize", type=int, default=320)
+    args = parser.parse_args()
+
+    data = loadWav(args.wav) if args.wav else synthetic(args.seconds)
+    seconds = len(data) / float(RATE * CHANNELS * 4)
+    chunks = periods(data, args.periodSize)
+
+    (alaw, levels), cpu = timed(runNumpy, chunks, seconds)
+    result = dict(seconds=seconds, numpy=dict(cpu_ms_per_second=cpu))
+
+    if audioop is not None:
+        (refAlaw, refLevels), refCpu = timed(runAudioop, chunks, seconds)
+        result["audioop"] = dict(cpu_ms_per_second=refCpu)
+
+        levels, refLevels = np.array(levels), np.array(refLevels, dtype=np.float64)
+        result["comparison"] = dict(
+            alaw_bytes=[len(alaw), len(refAlaw)],
+            mean_level_deviation=float(
+                np.mean(np.abs(levels - refLevels)) / max(np.mean(refLevels), 1.0)
+            ),
+        )
+
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""Compares the frame assembler with the former list based implementation.
+
+Feeds a sequence of encoder chunks and reports throughput and the bytes
+allocated per frame. The chunks are either synthetic or taken from a raw h264
+recording (e.g. `raspivid -o recording.h264`), which is split into frames at
+the NAL unit start codes and into chunks of at most --chunk-size bytes, like
+picamera hands them to the output.
+
+    python -m benchmarks.frameassembler --recording recording.h264
+"""
+
+import argparse
+import json
+import os
+import time
+import tracemalloc
+
+from babyphone import frameassembler
+
+
+class ListAssembler(object):
+    """The former implementation in Babyphone.write"""
+
+    def __init__(self):
+        self._data = []
+
+    def append(self, data):
+        self._data.extend(data)
+
+    def take(self):
+        frame = bytes(self._data)
+        self._data = []
+        return frame
+
+
+def loadRecording(path, chunkSize):
+    with open(path, "rb") as f:
+        stream = f.read()
+
+    frames = []
+    start = 0
+    while start < len(stream):
+        end = stream.find(b"\x00\x00\x00\x01", start + 4)
+        if end < 0:
+            end = len(stream)
+        frames.append(splitChunks(stream[start:end], chunkSize))
+        start = end
+    return frames
+
+
+def syntheticFrames(count, intraPeriod, iFrameSize, pFrameSize, chunkSize):
+    frames = []
+    for i in range(count):
+        size = iFrameSize if i % intraPeriod == 0 else pFrameSize
+        frames.append(splitChunks(os.urandom(size), chunkSize))
+    return frames
+
+
+def splitChunks(frame, chunkSize):
+    return [frame[i : i + chunkSize] for i in range(0, len(frame), chunkSize)]
+
+
+def measure(name, assembler, frames, rounds):
+    totalBytes = sum(len(c) for chunks in frames for c in chunks) * rounds
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for chunks in frames:
+            for chunk in chunks:
+                assembler.append(chunk)
+            assembler.take()
+    duration = time.perf_counter() - start
+
+    # measure allocations separately, tracing slows down the run
+    tracemalloc.start()
+    peakPerFrame = 0
+    for chunks in frames:
+        tracemalloc.clear_traces()
+        base = tracemalloc.get_traced_memory()[0]
+        for chunk in chunks:
+            assembler.append(chunk)
+        assembler.take()
+        peakPerFrame += tracemalloc.get_traced_memory()[1] - base
+    tracemalloc.stop()
+
+    return dict(
+        implementation=name,
+        mb_per_second=totalBytes / duration / (1024 * 1024),
+        alloc_bytes_per_frame=peakPerFrame / float(len(frames)),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser("frame assembler benchmark")
+    parser.add_argument("--recording", help="raw h264 file to replay")
+    parser.add_argument("--frames", type=int, default=300)
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--chunk-size", dest="chunkSize", type=int, default=65536)
+    parser.add_argument("--intra-period", dest="intraPeriod", type=int, default=10)
+    parser.add_argument("--iframe-size", dest="iFrameSize", type=int, default=12000)
+    parser.add_argument("--pframe-size", dest="pFrameSize", type=int, default=2000)
+    args = parser.parse_args()
+
+    if args.recording:
+        frames = loadRecording(args.recording, args.chunkSize)
+    else:
+        frames = syntheticFrames(
+            args.frames, args.intraPeriod, args.iFrameSize, args.pFrameSize, args.chunkSize
+        )
+
+    results = [
+        measure("list", ListAssembler(), frames, args.rounds),
+        measure("assembler", frameassembler.FrameAssembler(), frames, args.rounds),
+    ]
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
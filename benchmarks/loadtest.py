@@ -0,0 +1,213 @@
+"""Load test of the server with many concurrent viewers.
+
+Starts the server with simulated hardware and opens an increasing number of
+websocket clients, which all request the stream and audio. For every number of
+clients it measures
+
+ - throughput: video frames and bytes received per client and second
+ - frame latency: receive time minus the `now` the server stamped the frame with
+ - heartbeat jitter: deviation of the heartbeat intervals from one second
+ - cpu and rss of the server process
+
+and writes the results as json, so runs of different versions can be compared.
+Frames replayed from the server's cache when a client starts receiving video
+(primed) are counted separately, they are neither live nor part of the
+throughput. Requires psutil.
+
+    python -m benchmarks.loadtest --clients 1 2 4 8 16 --output results.json
+"""
+
+import argparse
+import asyncio
+import json
+import subprocess
+import sys
+import time
+
+import numpy as np
+import psutil
+import websockets
+
+from babyphone import protocol, renditions
+
+
+class Client(object):
+    def __init__(self, url, binary, rendition=None):
+        self._url = url
+        self._binary = binary
+        self._rendition = rendition
+        self.frames = 0
+        self.primedFrames = 0
+        self.audio = 0
+        self.bytes = 0
+        self.latencies = []
+        self.heartbeats = []
+
+    @asyncio.coroutine
+    def run(self, duration):
+        ws = yield from websockets.connect(self._url, max_size=None)
+        try:
+            if self._binary:
+                yield from ws.send(json.dumps(dict(action="protocol", media="binary")))
+            if self._rendition:
+                yield from ws.send(
+                    json.dumps(dict(action="rendition", rendition=self._rendition))
+                )
+            yield from ws.send(json.dumps(dict(action="_startstream")))
+            yield from ws.send(json.dumps(dict(action="startaudio")))
+
+            end = time.time() + duration
+            while time.time() < end:
+                try:
+                    message = yield from asyncio.wait_for(ws.recv(), end - time.time())
+                except asyncio.TimeoutError:
+                    break
+                self._handle(message)
+        finally:
+            yield from ws.close()
+
+    def _handle(self, message):
+        received = time.time()
+        if isinstance(message, bytes):
+            header, _ = protocol.decodeBinary(message)
+            if header["primed"]:
+                self.primedFrames += 1
+                return
+            self.bytes += len(message)
+            if header["stream"] == protocol.STREAM_AUDIO:
+                self.audio += 1
+                return
+            self.frames += 1
+            self.latencies.append(received * 1000 - header["now"])
+            return
+
+        msg = json.loads(message)
+        if msg.get("primed"):
+            self.primedFrames += 1
+            return
+        self.bytes += len(message)
+        if msg["action"] == "vframe":
+            self.frames += 1
+            self.latencies.append(received * 1000 - msg["now"])
+        elif msg["action"] == "audio":
+            self.audio += 1
+        elif msg["action"] == "heartbeat":
+            self.heartbeats.append(received)
+
+
+def percentiles(values):
+    if not values:
+        return None
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return dict(p50=p50, p95=p95, p99=p99, max=max(values))
+
+
+@asyncio.coroutine
+def sampleProcess(proc, samples, interval):
+    proc.cpu_percent(interval=None)
+    while True:
+        yield from asyncio.sleep(interval)
+        samples.append((proc.cpu_percent(interval=None), proc.memory_info().rss))
+
+
+@asyncio.coroutine
+def runStep(url, serverProc, numClients, duration, binary, rendition=None):
+    clients = [Client(url, binary, rendition) for _ in range(numClients)]
+    samples = []
+    sampler = asyncio.ensure_future(sampleProcess(serverProc, samples, 0.5))
+    yield from asyncio.gather(*[c.run(duration) for c in clients])
+    sampler.cancel()
+
+    latencies = [l for c in clients for l in c.latencies]
+    intervals = [
+        b - a for c in clients for a, b in zip(c.heartbeats, c.heartbeats[1:])
+    ]
+    return dict(
+        clients=numClients,
+        frames_per_client_second=sum(c.frames for c in clients)
+        / float(numClients * duration),
+        primed_frames_per_client=sum(c.primedFrames for c in clients)
+        / float(numClients),
+        audio_packets_per_client_second=sum(c.audio for c in clients)
+        / float(numClients * duration),
+        bytes_per_second=sum(c.bytes for c in clients) / float(duration),
+        frame_latency_ms=percentiles(latencies),
+        heartbeat_jitter_ms=percentiles([abs(i - 1.0) * 1000 for i in intervals]),
+        cpu_percent=percentiles([s[0] for s in samples]),
+        rss_mb=max(s[1] for s in samples) / (1024.0 * 1024.0) if samples else None,
+    )
+
+
+def startServer(args):
+    cmd = [
+        sys.executable,
+        "-m",
+        "babyphone.server",
+        "--simulate",
+        "--no-discovery",
+        "--port",
+        str(args.port),
+        "--http-port",
+        str(args.port + 1),
+    ]
+    if args.video:
+        cmd += ["--sim-video", args.video]
+    if args.audio:
+        cmd += ["--sim-audio", args.audio]
+    return subprocess.Popen(cmd, stdout=subprocess.DEVNULL)
+
+
+def main():
+    parser = argparse.ArgumentParser("load test")
+    parser.add_argument("--clients", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    parser.add_argument(
+        "--duration", type=float, default=20, help="seconds per number of clients"
+    )
+    parser.add_argument("--binary", action="store_true", help="use the binary protocol")
+    parser.add_argument(
+        "--rendition",
+        choices=renditions.NAMES + [renditions.AUTO],
+        help="video quality the clients ask for. Default: the server's default",
+    )
+    parser.add_argument("--port", type=int, default=18080)
+    parser.add_argument("--video", help="raw h264 file for the simulated camera")
+    parser.add_argument("--audio", help="wav file for the simulated microphone")
+    parser.add_argument("--output", help="write the results to this file")
+    args = parser.parse_args()
+
+    server = startServer(args)
+    try:
+        # give the server some time to start up
+        time.sleep(3)
+        proc = psutil.Process(server.pid)
+        url = "ws://127.0.0.1:%d" % args.port
+
+        loop = asyncio.get_event_loop()
+        steps = []
+        for numClients in args.clients:
+            step = loop.run_until_complete(
+                runStep(
+                    url, proc, numClients, args.duration, args.binary, args.rendition
+                )
+            )
+            print(json.dumps(step), file=sys.stderr)
+            steps.append(step)
+    finally:
+        server.terminate()
+        server.wait()
+
+    result = dict(
+        timestamp=time.time(),
+        protocol=protocol.MODE_BINARY if args.binary else protocol.MODE_JSON,
+        duration=args.duration,
+        steps=steps,
+    )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+    else:
+        print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
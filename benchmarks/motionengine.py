@@ -0,0 +1,124 @@
+"""Compares the motion metrics with the former full resolution SSIM.
+
+Scores consecutive frames of a sequence with every metric, detects movement
+with the 2-sigma rule of the motion detection and reports precision/recall
+against the ground truth and the time per frame.
+
+The sequence is either a directory of pictures (sorted by name) with a json
+list of the indexes of frames that show movement, or synthetic frames with
+noise, flickering light and a moving object at known frames.
+
+    python -m benchmarks.motionengine --frames pictures/ --labels moving.json
+"""
+
+import argparse
+import json
+import os
+import time
+
+import cv2
+import numpy as np
+from skimage.measure import compare_ssim
+
+from babyphone import motionengine
+
+
+def loadSequence(directory, labels):
+    names = sorted(os.listdir(directory))
+    frames = [
+        cv2.imread(os.path.join(directory, name), cv2.IMREAD_GRAYSCALE)
+        for name in names
+    ]
+    with open(labels) as f:
+        moving = set(json.load(f))
+    return frames, moving
+
+
+def syntheticSequence(count, width, height, seed=0):
+    random = np.random.RandomState(seed)
+    background = np.tile(np.linspace(40, 200, width), (height, 1))
+    frames, moving = [], set()
+    x, y = width // 3, height // 3
+    size = min(width, height) // 8
+    for i in range(count):
+        frame = background * random.uniform(0.97, 1.03)
+        if i % 25 in (10, 11, 12):
+            x = (x + random.randint(5, 15)) % (width - size)
+            moving.add(i)
+        frame[y : y + size, x : x + size] = 230
+        frame += random.normal(0, 4, frame.shape)
+        frames.append(np.clip(frame, 0, 255).astype(np.uint8))
+    return frames, moving
+
+
+def legacySsim(frames):
+    return [None] + [1.0 - compare_ssim(a, b) for a, b in zip(frames, frames[1:])]
+
+
+def engine(metric, levels, roi):
+    def run(frames):
+        scores, previous = [], None
+        for frame in frames:
+            previous, score = motionengine.analyse(previous, frame, metric, levels, roi)
+            scores.append(score)
+        return scores
+
+    return run
+
+
+def evaluate(scores, moving):
+    stats = motionengine.RunningStats(20)
+    tp = fp = fn = 0
+    for i, score in enumerate(scores):
+        if score is None:
+            continue
+        stats.add(score)
+        detected = stats.isOutlier(score, 2.0)
+        tp += detected and i in moving
+        fp += detected and i not in moving
+        fn += not detected and i in moving
+    return dict(
+        precision=float(tp) / (tp + fp) if tp + fp else 0.0,
+        recall=float(tp) / (tp + fn) if tp + fn else 0.0,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser("motion engine benchmark")
+    parser.add_argument("--frames", help="directory with the pictures of a sequence")
+    parser.add_argument("--labels", help="json list of frame indexes with movement")
+    parser.add_argument("--count", type=int, default=200)
+    parser.add_argument(
+        "--resolution", type=int, nargs=2, default=[320, 240], metavar=("W", "H")
+    )
+    parser.add_argument("--levels", type=int, default=2)
+    parser.add_argument(
+        "--roi", type=float, nargs=4, action="append", metavar=("X", "Y", "W", "H")
+    )
+    args = parser.parse_args()
+
+    if args.frames:
+        frames, moving = loadSequence(args.frames, args.labels)
+    else:
+        frames, moving = syntheticSequence(args.count, *args.resolution)
+
+    methods = [("legacy-ssim", legacySsim)]
+    for metric in motionengine.METRICS:
+        methods.append((metric, engine(metric, args.levels, None)))
+        if args.roi:
+            methods.append((metric + "-roi", engine(metric, args.levels, args.roi)))
+
+    results = []
+    for name, method in methods:
+        start = time.perf_counter()
+        scores = method(frames)
+        duration = time.perf_counter() - start
+        result = dict(method=name, ms_per_frame=duration * 1000.0 / len(frames))
+        result.update(evaluate(scores, moving))
+        results.append(result)
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""Measures the event loop lag caused by motion analysis.
+
+Decodes and compares pictures like the motion detection does, once directly on
+the loop (the former behavior) and once offloaded to the analysis executor, and
+reports the loop lag measured while doing so.
+
+    python -m benchmarks.motionoffload --resolution 800 600
+"""
+
+import argparse
+import asyncio
+import json
+
+import cv2
+import numpy as np
+
+from babyphone import looplag, motiondetect, motionengine
+
+
+def syntheticJpeg(width, height, offset):
+    image = np.zeros((height, width, 3), dtype=np.uint8)
+    image[:] = np.linspace(40, 200, width, dtype=np.uint8)[None, :, None]
+    size = min(width, height) // 6
+    image[height // 2 : height // 2 + size, offset : offset + size] = 255
+    return cv2.imencode(".jpg", image)[1].tobytes()
+
+
+@asyncio.coroutine
+def inline(pictures, args):
+    probe = looplag.LoopLagProbe()
+    probe.start()
+    for _ in range(args.rounds):
+        img1 = motiondetect.decodePicture(pictures[0])
+        img2 = motiondetect.decodePicture(pictures[1])
+        small, _ = motionengine.analyse(None, img1, args.metric, 0)
+        motionengine.analyse(small, img2, args.metric, 0)
+        # let the probe run in between, like the motion detection sleeps
+        yield from asyncio.sleep(0.02)
+    return probe.stop()
+
+
+@asyncio.coroutine
+def offloaded(pictures, args, useProcesses):
+    motion = motiondetect.MotionDetect(None, useProcesses=useProcesses)
+    # start the executor before measuring
+    yield from motion._analyse(motiondetect.decodePicture, pictures[0])
+
+    probe = looplag.LoopLagProbe()
+    probe.start()
+    for _ in range(args.rounds):
+        img1 = yield from motion._analyse(motiondetect.decodePicture, pictures[0])
+        img2 = yield from motion._analyse(motiondetect.decodePicture, pictures[1])
+        small, _ = yield from motion._analyse(
+            motionengine.analyse, None, img1, args.metric, 0
+        )
+        yield from motion._analyse(motionengine.analyse, small, img2, args.metric, 0)
+        yield from asyncio.sleep(0.02)
+    stats = probe.stop()
+    motion.close()
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser("motion analysis loop lag benchmark")
+    parser.add_argument("--rounds", type=int, default=20)
+    parser.add_argument(
+        "--metric", choices=motionengine.METRICS, default=motionengine.METRIC_SSIM
+    )
+    parser.add_argument(
+        "--resolution", type=int, nargs=2, default=[320, 240], metavar=("W", "H")
+    )
+    args = parser.parse_args()
+
+    width, height = args.resolution
+    pictures = [syntheticJpeg(width, height, 0), syntheticJpeg(width, height, 20)]
+
+    loop = asyncio.get_event_loop()
+    results = dict(
+        inline=loop.run_until_complete(inline(pictures, args)),
+        threads=loop.run_until_complete(offloaded(pictures, args, False)),
+        processes=loop.run_until_complete(offloaded(pictures, args, True)),
+    )
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
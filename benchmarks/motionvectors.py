@@ -0,0 +1,60 @@
+"""Replays motion vectors through the motion vector analysis.
+
+Reads a fixture in the format the encoder writes (`raspivid -x motion.dat`) or
+generates a synthetic one and reports the motion score per frame and the time
+the analysis takes per frame. --write-fixture stores the synthetic data, e.g.
+to replay it with the simulated camera (server --simulate --sim-motion).
+
+    python -m benchmarks.motionvectors --fixture motion.dat --resolution 320 240
+"""
+
+import argparse
+import json
+import time
+
+from babyphone import motionvectors
+
+
+def main():
+    parser = argparse.ArgumentParser("motion vector benchmark")
+    parser.add_argument("--fixture", help="motion data recorded by the encoder")
+    parser.add_argument("--write-fixture", dest="writeFixture")
+    parser.add_argument("--frames", type=int, default=500)
+    parser.add_argument(
+        "--resolution", type=int, nargs=2, default=[320, 240], metavar=("W", "H")
+    )
+    args = parser.parse_args()
+    resolution = tuple(args.resolution)
+
+    if args.fixture:
+        with open(args.fixture, "rb") as f:
+            data = f.read()
+    else:
+        data = motionvectors.syntheticMotion(resolution, args.frames)
+
+    if args.writeFixture:
+        with open(args.writeFixture, "wb") as f:
+            f.write(data)
+
+    scores = []
+    # report every frame
+    analyzer = motionvectors.MotionVectorAnalyzer(resolution, scores.append, interval=0)
+    start = time.perf_counter()
+    analyzer.write(data)
+    duration = time.perf_counter() - start
+
+    print(
+        json.dumps(
+            dict(
+                frames=len(scores),
+                ms_per_frame=duration * 1000.0 / max(len(scores), 1),
+                frames_with_motion=sum(1 for s in scores if s > 0),
+                max_score=max(scores or [0]),
+            ),
+            indent=2,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
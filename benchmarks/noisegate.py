@@ -0,0 +1,176 @@
+"""Measures what the noise gate saves on night audio.
+
+Runs the captured audio period by period through the audio pipeline and the
+noise gate like the audio monitoring thread and reports
+
+ - the share of audio packets sent and the bytes per hour and client
+ - the CPU time per second of audio of the gate itself and of publishing the
+   packets to the clients on the loop, with and without the gate
+ - for the synthetic audio, whether the onsets of the cries were sent and how
+   much audio before them, thanks to the pre-roll
+
+The input is a stereo S32_LE 48kHz wav file of a night or a synthetic night: low
+noise, a fan turning on after a while and a few cries.
+
+    python -m benchmarks.noisegate --wav night.wav
+"""
+
+import argparse
+import json
+import time
+
+import numpy as np
+
+from babyphone import audiodsp, audiosource, fanout, protocol
+from benchmarks.audiodsp import CHANNELS, RATE, loadWav, periods
+
+PACKET_SIZE = audiosource.OUTPUT_RATE * audiosource.PACKET_MILLIS // 1000
+# websocket frame header of a small binary frame
+WS_OVERHEAD = 2
+
+
+class Subscriber(object):
+    subscribes = staticmethod(lambda kind: True)
+    mediaMode = protocol.MODE_BINARY
+    rendition = None
+    videoPrimed = True
+
+    def __init__(self):
+        self.bytes = 0
+
+    def enqueue(self, kind, data, sps=False):
+        self.bytes += len(data) + WS_OVERHEAD
+
+
+def syntheticNight(seconds, seed=0):
+    """Quiet noise, a fan from a third on and a cry every few minutes. Returns
+    the audio and the start times of the cries"""
+    random = np.random.RandomState(seed)
+    n = seconds * RATE
+    audio = random.normal(0, 1 << 17, n)
+
+    # the fan: louder, steady noise
+    fanStart = n // 3
+    audio[fanStart:] += random.normal(0, 1 << 19, n - fanStart)
+
+    cries = []
+    t = np.arange(int(1.5 * RATE)) / float(RATE)
+    starts = np.arange(20, seconds - 5, 90) + random.uniform(0, 30, 1)[0] + 0.013
+    # only cries that fit in the audio
+    for start in starts[starts <= seconds - len(t) / float(RATE)]:
+        # rises within 50ms, a fundamental with harmonics
+        envelope = np.minimum(t / 0.05, 1.0) * np.exp(-t)
+        cry = sum(np.sin(2 * np.pi * 450 * k * t) / k for k in (1, 2, 3))
+        begin = int(start * RATE)
+        audio[begin : begin + len(t)] += cry * envelope * (1 << 25)
+        cries.append(float(start))
+
+    stereo = np.repeat(audio[:, None], CHANNELS, axis=1)
+    return np.clip(stereo, -(1 << 31), (1 << 31) - 1).astype("<i4").tobytes(), cries
+
+
+def run(chunks, periodSeconds, gated):
+    pipeline = audiodsp.AudioPipeline(channels=CHANNELS, inRate=RATE, outRate=8000)
+    packetizer = audiosource.Packetizer(PACKET_SIZE)
+    gate = audiodsp.NoiseGate(
+        period=periodSeconds, packetSeconds=audiosource.PACKET_MILLIS / 1000.0
+    )
+
+    captured = 0
+    sent = []
+    gateCpu = 0.0
+    samples = 0
+    for data in chunks:
+        alaw, rms = pipeline.process(data)
+        packets = packetizer.add(alaw)
+        pts = samples * 1000000 // audiosource.OUTPUT_RATE
+        samples += len(packets) * PACKET_SIZE
+        captured += len(packets)
+
+        start = time.process_time()
+        result = gate.process(packets, pts, rms / float((1 << 31) - 1))
+        gateCpu += time.process_time() - start
+        if not gated:
+            result = [(packets, pts)] if packets else []
+        sent.extend(result)
+    return captured, sent, gateCpu
+
+
+def publish(sent, clients):
+    """CPU of what the loop does with the packets, and the bytes per client"""
+    subscribers = [Subscriber() for _ in range(clients)]
+    out = fanout.Fanout(subscribers)
+    start = time.process_time()
+    for packets, pts in sent:
+        for data in packets:
+            packet = protocol.MediaPacket(protocol.STREAM_AUDIO, data, pts=pts)
+            out.publish(fanout.AUDIO, packet)
+            pts += audiosource.PACKET_MILLIS * 1000
+    return time.process_time() - start, subscribers[0].bytes
+
+
+def onsets(sent, cries):
+    """Per cry: whether its start was sent and how much audio before it (the
+    pre-roll) was sent in ms"""
+    packetSeconds = audiosource.PACKET_MILLIS / 1000.0
+    starts = set()
+    for packets, pts in sent:
+        for i in range(len(packets)):
+            starts.add(int(round(pts / 1e6 / packetSeconds)) + i)
+    result = []
+    for cry in cries:
+        index = int(cry / packetSeconds)
+        lead = None
+        if index in starts:
+            # back to the start of the sent audio, at most a second
+            first = index
+            while first - 1 in starts and index - first < 1.0 / packetSeconds:
+                first -= 1
+            lead = round((cry - first * packetSeconds) * 1000.0)
+        result.append(dict(at=round(cry, 2), onset_sent=index in starts, lead_ms=lead))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser("noise gate benchmark")
+    parser.add_argument("--wav", help="stereo S32_LE 48kHz wav file of a night")
+    parser.add_argument("--seconds", type=int, default=600)
+    parser.add_argument(
+        "--latency",
+        type=int,
+        choices=audiosource.LATENCIES,
+        default=audiosource.DEFAULT_LATENCY,
+    )
+    parser.add_argument("--clients", type=int, default=2)
+    args = parser.parse_args()
+
+    cries = None
+    if args.wav:
+        data = loadWav(args.wav)
+    else:
+        data, cries = syntheticNight(args.seconds)
+    seconds = len(data) / float(RATE * CHANNELS * 4)
+    chunks = periods(data, audiosource.periodSize(RATE, args.latency))
+    periodSeconds = args.latency / 1000.0
+
+    result = dict(seconds=seconds, clients=args.clients)
+    for name, gated in (("ungated", False), ("gated", True)):
+        captured, sent, gateCpu = run(chunks, periodSeconds, gated)
+        publishCpu, clientBytes = publish(sent, args.clients)
+        packets = sum(len(p) for p, _ in sent)
+        result[name] = dict(
+            packets_sent=packets,
+            sent_share=packets / float(max(captured, 1)),
+            client_kbytes_per_hour=clientBytes * 3600.0 / seconds / 1024.0,
+            publish_cpu_ms_per_second=publishCpu * 1000.0 / seconds,
+        )
+        if gated:
+            result[name]["gate_cpu_ms_per_second"] = gateCpu * 1000.0 / seconds
+            if cries is not None:
+                result[name]["onsets"] = onsets(sent, cries)
+
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
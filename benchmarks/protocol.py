@@ -0,0 +1,104 @@
+"""Compares the json and the binary media protocol.
+
+Encodes synthetic media resembling the default stream (320x240@10fps h264,
+intra period 10, 8kHz A-law audio) and reports bytes and CPU time per second
+of media for both modes.
+
+    python -m benchmarks.protocol --seconds 60
+"""
+
+import argparse
+import json
+import os
+import time
+
+from babyphone import protocol
+
+
+def generateMedia(seconds, iFrameSize, pFrameSize, fps, intraPeriod, audioPacketSize):
+    packets = []
+    audioPackets = int(8000 / audioPacketSize)
+    for second in range(seconds):
+        for f in range(fps):
+            pts = int((second + float(f) / fps) * 1000000)
+            if f % intraPeriod == 0:
+                packets.append(
+                    protocol.MediaPacket(
+                        protocol.STREAM_VIDEO,
+                        os.urandom(32),
+                        pts=None,
+                        frameType=protocol.FRAME_TYPE_SPS_HEADER,
+                    )
+                )
+                size, frameType = iFrameSize, protocol.FRAME_TYPE_KEY_FRAME
+            else:
+                size, frameType = pFrameSize, protocol.FRAME_TYPE_FRAME
+            packets.append(
+                protocol.MediaPacket(
+                    protocol.STREAM_VIDEO,
+                    os.urandom(size),
+                    pts=pts,
+                    frameType=frameType,
+                    now=int(time.time() * 1000),
+                )
+            )
+        for a in range(audioPackets):
+            packets.append(
+                protocol.MediaPacket(
+                    protocol.STREAM_AUDIO,
+                    os.urandom(audioPacketSize),
+                    pts=int((second + float(a) / audioPackets) * 1000000),
+                )
+            )
+    return packets
+
+
+def measure(packets, mode, seconds):
+    totalBytes = 0
+    start = time.process_time()
+    for packet in packets:
+        totalBytes += len(packet.encode(mode))
+    cpu = time.process_time() - start
+    return dict(
+        mode=mode,
+        bytes_per_second=totalBytes / float(seconds),
+        cpu_ms_per_second=cpu * 1000.0 / seconds,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser("protocol benchmark")
+    parser.add_argument("--seconds", type=int, default=30)
+    parser.add_argument("--fps", type=int, default=10)
+    parser.add_argument("--intra-period", dest="intraPeriod", type=int, default=10)
+    parser.add_argument("--iframe-size", dest="iFrameSize", type=int, default=12000)
+    parser.add_argument("--pframe-size", dest="pFrameSize", type=int, default=2000)
+    parser.add_argument(
+        "--audio-packet-size", dest="audioPacketSize", type=int, default=53
+    )
+    parser.add_argument("--json", action="store_true", help="print results as json")
+    args = parser.parse_args()
+
+    packets = generateMedia(
+        args.seconds,
+        args.iFrameSize,
+        args.pFrameSize,
+        args.fps,
+        args.intraPeriod,
+        args.audioPacketSize,
+    )
+    results = [measure(packets, mode, args.seconds) for mode in protocol.MODES]
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    for r in results:
+        print(
+            "%-7s %10.0f bytes/s %8.3f ms cpu/s"
+            % (r["mode"], r["bytes_per_second"], r["cpu_ms_per_second"])
+        )
+
+
+if __name__ == "__main__":
+    main()
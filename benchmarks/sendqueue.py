@@ -0,0 +1,90 @@
+"""Feeds a send queue with video and audio while a slow client drains it.
+
+Reports the queue stats and the traced memory over time, which should stay
+flat even if the client can only receive a fraction of the stream.
+
+    python -m benchmarks.sendqueue --bandwidth 10000 --seconds 120
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import tracemalloc
+
+from babyphone import fanout, sendqueue
+
+
+@asyncio.coroutine
+def produce(queue, seconds, speedup, fps, intraPeriod, iFrameSize, pFrameSize):
+    audioPerFrame = 4
+    for i in range(seconds * fps):
+        if i % intraPeriod == 0:
+            queue.put(fanout.VIDEO, os.urandom(32), sps=True)
+            queue.put(fanout.VIDEO, os.urandom(iFrameSize))
+        else:
+            queue.put(fanout.VIDEO, os.urandom(pFrameSize))
+        for a in range(audioPerFrame):
+            queue.put(fanout.AUDIO, os.urandom(8000 // (fps * audioPerFrame)))
+        yield from asyncio.sleep(1.0 / fps / speedup)
+
+
+@asyncio.coroutine
+def consume(queue, bandwidth, speedup):
+    while True:
+        data = yield from queue.get()
+        yield from asyncio.sleep(float(len(data)) / bandwidth / speedup)
+
+
+@asyncio.coroutine
+def sampleMemory(samples, interval):
+    while True:
+        samples.append(tracemalloc.get_traced_memory()[0])
+        yield from asyncio.sleep(interval)
+
+
+def main():
+    parser = argparse.ArgumentParser("send queue benchmark")
+    parser.add_argument("--seconds", type=int, default=120)
+    parser.add_argument("--speedup", type=float, default=20.0)
+    parser.add_argument(
+        "--bandwidth", type=int, default=10000, help="client bandwidth in bytes/s"
+    )
+    parser.add_argument("--fps", type=int, default=10)
+    parser.add_argument("--intra-period", dest="intraPeriod", type=int, default=10)
+    parser.add_argument("--iframe-size", dest="iFrameSize", type=int, default=12000)
+    parser.add_argument("--pframe-size", dest="pFrameSize", type=int, default=2000)
+    args = parser.parse_args()
+
+    loop = asyncio.get_event_loop()
+    tracemalloc.start()
+    queue = sendqueue.SendQueue()
+    memory = []
+
+    consumer = asyncio.ensure_future(consume(queue, args.bandwidth, args.speedup))
+    sampler = asyncio.ensure_future(sampleMemory(memory, 1.0 / args.speedup))
+    loop.run_until_complete(
+        produce(
+            queue,
+            args.seconds,
+            args.speedup,
+            args.fps,
+            args.intraPeriod,
+            args.iFrameSize,
+            args.pFrameSize,
+        )
+    )
+    consumer.cancel()
+    sampler.cancel()
+
+    half = len(memory) // 2
+    result = dict(
+        queue=queue.stats(),
+        memory_peak_first_half=max(memory[:half] or [0]),
+        memory_peak_second_half=max(memory[half:] or [0]),
+    )
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -32,7 +32,7 @@ setup(
 
     keywords='rpi raspberry camera babyphone microphone',
 
-    packages=find_packages(exclude=['contrib', 'docs', 'tests']),
+    packages=find_packages(exclude=['contrib', 'docs', 'tests', 'benchmarks']),
     package_data={
     },
 